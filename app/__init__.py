@@ -8,4 +8,18 @@ handwritten_prompt = f"Below is the image of one page of a document, as well as
 f"Just return the plain text representation of this document as if you were reading it naturally.\n"
 f"Do not hallucinate.\n"
 
-__all__ = ["system_prompt", "handwritten_prompt"]
\ No newline at end of file
+# First, OCR-less extraction pass: Gemma answers alone unless it asks for the olmOCR transcription
+# (servers without response_format support may still answer with the bare NEED_OCR word)
+NEED_OCR = "NEED_OCR"
+triage_prompt = f"If any part of the receipt is handwritten, or you cannot read an item with confidence, answer only {{\"needs_ocr\": true, \"items\": []}}; otherwise set needs_ocr to false.\n"
+
+# Last resort for malformed output: only the broken fragment is sent back, without the image
+reask_prompt = "This fragment of a JSON answer listing receipt items is malformed or cut off. Return only valid JSON of the form {\"items\": [...]} with the items it contains; do not invent items that are not in the fragment.\n"
+
+# Bump whenever the prompts above change, so cached extractions from older prompts are not reused
+PROMPT_VERSION = "4"
+
+# Follow-up questions are answered from the extracted receipt JSON, without the image (not cached, so not versioned)
+followup_prompt = "You answer questions about a receipt that has already been read. Its contents as JSON are below. Answer briefly, using only this data; if it does not contain the answer, say so.\n"
+
+__all__ = ["system_prompt", "handwritten_prompt", "triage_prompt", "reask_prompt", "followup_prompt", "NEED_OCR", "PROMPT_VERSION"]
\ No newline at end of file
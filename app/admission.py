@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from app.config import (
+    ADMISSION_MAX_DEPTH,
+    ADMISSION_MAX_RETRY_AFTER,
+    ADMISSION_MAX_WAIT,
+    ADMISSION_REFRESH_INTERVAL,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_MAX_CLIENTS,
+    RATE_LIMIT_PER_SECOND,
+)
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+
+class RateLimiter:
+    """Token bucket per client (issued API key, else IP). Idle clients' buckets are dropped least recently used first"""
+    def __init__(self, rate: float = RATE_LIMIT_PER_SECOND, burst: float = RATE_LIMIT_BURST,
+                 max_clients: int = RATE_LIMIT_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.max_clients = max_clients
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client: str, cost: float = 1) -> float:
+        """Take cost tokens; returns 0 if admitted, otherwise the seconds until they would be available"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.pop(client, None) or TokenBucket(self.burst, now)
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets[client] = bucket
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            if cost > self.burst:
+                # A batch larger than the burst can never fit; let it through once the bucket is full
+                cost = self.burst
+            if bucket.tokens >= cost:
+                bucket.tokens -= cost
+                return 0.0
+            return (cost - bucket.tokens) / self.rate
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"clients": len(self._buckets)}
+
+
+class AdmissionController:
+    """Sheds uploads while image_requests is too far behind.
+
+    Depth comes from a cached passive queue_declare. The drain rate is estimated from how fast the depth
+    falls, counting what this API published in between. Other API replicas' publishes only make it look
+    lower, which errs towards shedding. Estimated wait = depth / drain rate.
+    """
+    def __init__(self, publisher, queue: str = "image_requests", max_wait: float = ADMISSION_MAX_WAIT,
+                 max_depth: int = ADMISSION_MAX_DEPTH, interval: float = ADMISSION_REFRESH_INTERVAL,
+                 smoothing: float = 0.3):
+        self.publisher = publisher
+        self.queue = queue
+        self.max_wait = max_wait
+        self.max_depth = max_depth
+        self.interval = interval
+        self.smoothing = smoothing
+        self.depth: Optional[int] = None
+        self.drain_rate = 0.0  # messages/s, EWMA
+        self._published = 0
+        self._sampled_at = 0.0
+
+    def record_published(self, count: int = 1):
+        self._published += count
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"Cannot sample depth of {self.queue}: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def refresh(self):
+        if not self.publisher.is_connected:
+            return
+        depth = await self.publisher.queue_depth(self.queue)
+        now = time.monotonic()
+        published, self._published = self._published, 0
+        if self.depth is not None and (self.depth or depth):
+            # An empty queue at both ends says nothing about capacity, only about arrivals
+            drained = max(0, self.depth + published - depth)
+            rate = drained / max(now - self._sampled_at, 1e-3)
+            self.drain_rate = rate if not self.drain_rate else (
+                self.smoothing * rate + (1 - self.smoothing) * self.drain_rate)
+        self.depth, self._sampled_at = depth, now
+
+    def estimated_wait(self) -> Optional[float]:
+        if not self.depth:
+            return 0.0
+        if self.drain_rate <= 0:
+            return None
+        return self.depth / self.drain_rate
+
+    def check(self) -> Optional[int]:
+        """None to admit, otherwise a Retry-After in seconds"""
+        wait = self.estimated_wait()
+        if wait is None:
+            # Nothing drained yet (workers down or just started): fall back to a plain depth cap
+            if self.depth > self.max_depth:
+                return min(ADMISSION_MAX_RETRY_AFTER, max(1, int(self.interval * 6)))
+            return None
+        if wait <= self.max_wait:
+            return None
+        # Long enough for the backlog to drain back under the threshold
+        return min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(wait - self.max_wait)))
+
+    def stats(self) -> dict:
+        wait = self.estimated_wait()
+        return {"queue_depth": self.depth or 0, "drain_rate": self.drain_rate,
+                "estimated_wait_seconds": -1 if wait is None else wait}
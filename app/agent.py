@@ -1,53 +1,109 @@
-from langgraph.graph import StateGraph
-from typing import TypedDict, List
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from langgraph.graph import StateGraph, END
+from langchain_core.runnables import RunnableConfig
+from typing import Any, Callable, NamedTuple, Optional, TypedDict, List
 import base64
-import requests
 import json
-from app import system_prompt, handwritten_prompt
+import logging
+import re
+from contextlib import nullcontext
+from app import system_prompt, handwritten_prompt, triage_prompt, reask_prompt, followup_prompt, NEED_OCR
+from app.config import GEMMA_ENDPOINT, OLM_ENDPOINT, GEMMA_MODEL, OLM_MODEL, GEMMA_READ_TIMEOUT, OLM_READ_TIMEOUT, GEMMA_STREAM, LIMITER_ENABLED, CASCADE_ROUTER
+from app.config import STRUCTURED_OUTPUT, REPAIR_REASK, REPAIR_REASK_MAX_CHARS, CHECKPOINT_ENABLED, FOLLOWUP_MAX_TOKENS
+from app.checkpoints import CheckpointStore
+from app.concurrency import get_limiter
+from app.metrics import MODEL_CALL_LATENCY, REPAIRS, ROUTES, timed
+from app.inference import InferenceError, get_client, default_timeout
+from app.jsonstream import IncrementalJSONParser, parse_model_json, repair_json
+from app.models import Receipt, ReceiptItem, receipt_json_schema
+
+class ExtractionError(ValueError):
+    """Model output could not be turned into a receipt, even after repair and re-ask"""
+
 
 class AgentState(TypedDict):
-    messages: List[BaseMessage]
-    should_continue: bool 
+    messages: List[dict]  # chat messages: receipt context, earlier turns, the question, then the answer
+    should_continue: bool  # True until the model has answered
+
+class ReceiptState(TypedDict, total=False):
+    """Checkpointed after every node, so it holds only small values; images and callbacks travel in ReceiptInputs"""
+    include_items: str
+    streamed: int  # items the triage pass already reported through on_item
+    handwritten_text: str
+    route: str  # direct | ocr_requested | ocr_unparseable | ocr_always
+    result: dict  # Receipt.model_dump(), so checkpoints hold plain data
+
+class ReceiptInputs(NamedTuple):
+    """Per-invocation inputs passed through config["configurable"]["inputs"]: re-supplied on every (re)delivery"""
+    image_data_url: str
+    ocr_image_url: Optional[str]
+    on_item: Optional[Callable[[Any], None]]
 
 class LangGraphAgent:
     def __init__(self):
-        self.model = "gemma-3-4b-it"
-        self.api_url = "http://host.docker.internal:1234/v1/chat/completions" # "http://localhost:1234/v1/chat/completions"
+        self.model = GEMMA_MODEL
+        self.olm_model = OLM_MODEL
+        # Shared keep-alive clients; one pool and concurrency limit per endpoint
+        self.gemma_client = get_client(GEMMA_ENDPOINT)
+        self.olm_client = get_client(OLM_ENDPOINT)
+        # Adaptive in-flight limits, shared by every thread in this process
+        self.gemma_limiter = get_limiter(GEMMA_ENDPOINT, self.model) if LIMITER_ENABLED else None
+        self.olm_limiter = get_limiter(OLM_ENDPOINT, self.olm_model) if LIMITER_ENABLED else None
+        # Redelivered tasks resume from the last completed node; checkpoints are cleared once the result is acked
+        self.checkpoints = CheckpointStore() if CHECKPOINT_ENABLED else None
         self.workflow = self._create_workflow()
+        self.receipt_workflow = self._create_receipt_workflow()
+        self.checkpointed_workflow = (self._create_receipt_workflow(self.checkpoints.saver)
+                                      if self.checkpoints else None)
+        # Cleared the first time the server rejects a json_schema response_format (STRUCTURED_OUTPUT=auto)
+        self.structured_output = STRUCTURED_OUTPUT != "off"
     
     def _create_workflow(self):
+        """Follow-up questions: agent answers once, then should_continue ends the run"""
         workflow = StateGraph(AgentState)
-        
+
         workflow.add_node("agent", self._agent_node)
-        workflow.add_node("human", self._human_node)
-        
-        workflow.add_edge("agent", "human")
-        workflow.add_edge("human", "agent")
-        
+
         workflow.set_entry_point("agent")
+        workflow.add_conditional_edges("agent", self._should_continue, {"continue": "agent", "end": END})
         return workflow.compile()
-    
+
+    def _create_receipt_workflow(self, checkpointer=None):
+        """triage (Gemma alone) -> [ocr (olmOCR) -> extract (Gemma with the transcription)] -> validate -> publish"""
+        workflow = StateGraph(ReceiptState)
+
+        workflow.add_node("triage", self._triage_node)
+        workflow.add_node("ocr", self._ocr_node)
+        workflow.add_node("extract", self._extract_node)
+        workflow.add_node("validate", self._validate_node)
+        workflow.add_node("publish", self._publish_node)
+
+        workflow.set_entry_point("triage")
+        workflow.add_conditional_edges("triage", self._route_after_triage, {"done": "validate", "ocr": "ocr"})
+        workflow.add_edge("ocr", "extract")
+        workflow.add_edge("extract", "validate")
+        workflow.add_edge("validate", "publish")
+        workflow.add_edge("publish", END)
+        return workflow.compile(checkpointer=checkpointer)
+
     def _call_olm(self, messages: List[dict], max_tokens: int = 1200, temperature: float = 0.1):
         """Helper method to call local olm model"""
-        headers = {"Content-Type": "application/json"}
         payload = {
-            "model": 'olmocr-7b-0225-preview',
+            "model": self.olm_model,
             "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens,
             "stream": False
         }
         
-        response = requests.post(self.api_url, headers=headers, json=payload)
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content']
-        raise Exception(f"Gemma API error: {response.status_code} - {response.text}")
+        with self.olm_limiter.slot() if self.olm_limiter else nullcontext():
+            with MODEL_CALL_LATENCY.labels(self.olm_model).time():
+                response = self.olm_client.chat(payload, timeout=default_timeout(OLM_READ_TIMEOUT))
+        return response['choices'][0]['message']['content']
     
     
-    def _call_gemma(self, messages: List[dict], max_tokens: int = 1200, temperature: float = 0.1):
+    def _call_gemma(self, messages: List[dict], max_tokens: int = 1200, temperature: float = 0.1,
+                    response_format: Optional[dict] = None):
         """Helper method to call local Gemma model"""
-        headers = {"Content-Type": "application/json"}
         payload = {
             "model": self.model,
             "messages": messages,
@@ -55,96 +111,281 @@ class LangGraphAgent:
             "max_tokens": max_tokens,
             "stream": False
         }
+        if response_format:
+            payload["response_format"] = response_format
         
-        response = requests.post(self.api_url, headers=headers, json=payload)
-        if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content']
-        raise Exception(f"Gemma API error: {response.status_code} - {response.text}")
+        with self.gemma_limiter.slot() if self.gemma_limiter else nullcontext():
+            with MODEL_CALL_LATENCY.labels(self.model).time():
+                response = self.gemma_client.chat(payload, timeout=default_timeout(GEMMA_READ_TIMEOUT))
+        return response['choices'][0]['message']['content']
     
+    def _stream_gemma_json(self, messages: List[dict], on_item: Callable[[Any], None],
+                           max_tokens: int = 1200, temperature: float = 0.1, response_format: Optional[dict] = None) -> Any:
+        """Stream Gemma's answer through the incremental parser, reporting each item as it closes"""
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if response_format:
+            payload["response_format"] = response_format
+        parser = IncrementalJSONParser()
+        with self.gemma_limiter.slot() if self.gemma_limiter else nullcontext():
+            with MODEL_CALL_LATENCY.labels(self.model).time():
+                for delta in self.gemma_client.stream_chat(payload, timeout=default_timeout(GEMMA_READ_TIMEOUT)):
+                    for item in parser.feed(delta):
+                        on_item(item)
+        return parser.result()
+
     def _agent_node(self, state: AgentState):
-        """Process messages through Gemma model"""
-        last_message = state['messages'][-1]
-        
-        # Convert LangChain messages to Gemma format
-        messages = [{
-            "role": "user" if isinstance(msg, HumanMessage) else "assistant",
-            "content": msg.content
-        } for msg in state['messages']]
-        
-        response_content = self._call_gemma(messages)
-        return {"messages": [AIMessage(content=response_content)]}
-    
-    def _human_node(self, state: AgentState):
-        """Process human input (from RabbitMQ)"""
-        last_message = state['messages'][-1].content
-        return {"messages": [HumanMessage(content=last_message)]}
-    
-    def process_message(self, message: str):
-        """Entry point for text processing"""
-        initial_state = {"messages": [HumanMessage(content=message)]}
-        result = self.workflow.invoke(initial_state)
-        return result['messages'][-1].content
-    
-    def process_image(self, image_url: str, include_items: str) -> str:
-        """Specialized image-to-JSON processor"""
+        """One Gemma call over the receipt context and the bounded history"""
+        with timed("followup"):
+            answer = self._call_gemma(state["messages"], max_tokens=FOLLOWUP_MAX_TOKENS)
+        return {"messages": state["messages"] + [{"role": "assistant", "content": answer}], "should_continue": False}
+
+    def _should_continue(self, state: AgentState) -> str:
+        return "continue" if state["should_continue"] else "end"
+
+    def _download(self, image_url: str) -> bytes:
+        """Fetch a remote image through the pooled session, bounded by the connect/read timeouts"""
+        response = self.gemma_client.session.get(image_url, timeout=default_timeout(GEMMA_READ_TIMEOUT))
+        response.raise_for_status()
+        return response.content
+
+    def _as_data_url(self, image_url: str) -> str:
+        """Normalise an image reference to a data URL the chat API accepts"""
+        if image_url.startswith("data:"):
+            return image_url
         if image_url.startswith(('http://', 'https://')):
             # Download image
-            img_data = requests.get(image_url).content
+            img_data = self._download(image_url)
             encoded_image = base64.b64encode(img_data).decode('utf-8')
         else:
             # Assume base64
             encoded_image = image_url
+        return f"data:image/jpeg;base64,{encoded_image}"
 
-        handwritten_text = self.process_handwritten_image(image_url=image_url)
-        messages = [
-            {
-                "role": "system",
-                "content": [{"type": "text", "text": system_prompt + f"Return a json of jsonl, list each items inside the invoice/receipt as independent  item, please include {include_items} for each jsonl. \n"}]
-                },
-            {
-            "role": "user",
-            "content": [
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}},
-                {"type": "text", "text": f"Here is the hand writting detected text result: {handwritten_text} for helping you. Make sure all json item is totatlly correct. Return a json of jsonl, list each items inside the invoice/receipt as independent item inside the same json, please include {include_items} for each jsonl."},
-            ]
-        }]
-        
+    def process_message(self, question: str, receipt: Any, history: Optional[List[dict]] = None) -> str:
+        """Answer a follow-up question about an extracted receipt; history is the earlier turns as chat messages"""
+        context = followup_prompt + json.dumps(receipt, ensure_ascii=False, separators=(",", ":"))
+        messages = [{"role": "system", "content": context}] + list(history or []) + [{"role": "user", "content": question}]
+        state = self.workflow.invoke({"messages": messages, "should_continue": True})
+        return state["messages"][-1]["content"]
+
+    def process_image(self, image_url: str, include_items: str, ocr_image_url: str = None,
+                      on_item: Optional[Callable[[Any], None]] = None, trace: Optional[dict] = None,
+                      thread_id: Optional[str] = None) -> Receipt:
+        """Specialized image-to-JSON processor, returning the validated receipt.
+
+        image_url may be an http(s) URL, a data URL or bare base64. ocr_image_url optionally
+        gives the olmOCR stage its own (differently preprocessed) copy of the image. With on_item
+        (and GEMMA_STREAM on) the answer is streamed and each line item is reported as soon as it closes.
+        The cascade route taken is counted and, if given, written to trace["route"].
+        With a thread_id (and CHECKPOINT_ENABLED) every node's output is checkpointed, and a second call
+        with the same thread_id resumes at the first node that had not completed.
+        Raises ExtractionError if the output cannot be repaired into a receipt.
+        """
+        def _emit(item):
+            if isinstance(item, dict):
+                on_item(ReceiptItem.model_validate(item).model_dump(exclude_none=True))
+
+        inputs = ReceiptInputs(self._as_data_url(image_url), ocr_image_url, _emit if on_item else None)
+        graph = self.receipt_workflow
+        config = {"configurable": {"inputs": inputs}}
+        initial = {"include_items": include_items, "streamed": 0}
+        if thread_id and self.checkpoints is not None:
+            graph = self.checkpointed_workflow
+            config["configurable"]["thread_id"] = thread_id
+            self.checkpoints.track(thread_id)
+            snapshot = graph.get_state(config)
+            if snapshot.next:
+                logging.info(f"Resuming {thread_id} at {', '.join(snapshot.next)}")
+                self.checkpoints.resumed()
+                initial = None
+            elif snapshot.values.get("result") is not None:
+                # Finished before the worker died, but the result was never acked
+                logging.info(f"Reusing the checkpointed result of {thread_id}")
+                self.checkpoints.resumed()
+                state = snapshot.values
+                if trace is not None:
+                    trace["route"] = state.get("route")
+                return Receipt.model_validate(state["result"])
+
+        state = graph.invoke(initial, config)
+        if trace is not None:
+            trace["route"] = state["route"]
+        return Receipt.model_validate(state["result"])
+
+    def clear_checkpoints(self, owner: str):
+        """Drop the checkpoints of a task (all its parts) once its result is safely published"""
+        if self.checkpoints is not None:
+            self.checkpoints.clear(owner)
+
+    def _extraction_messages(self, state: ReceiptState, inputs: ReceiptInputs, triage: bool = False) -> List[dict]:
+        include_items = state["include_items"]
+        instructions = system_prompt + f"Return a json of jsonl, list each items inside the invoice/receipt as independent  item, please include {include_items} for each jsonl. \n"
+        if triage:
+            instructions += triage_prompt
+        if state.get("handwritten_text"):
+            request = f"Here is the hand writting detected text result: {state['handwritten_text']} for helping you. Make sure all json item is totatlly correct. Return a json of jsonl, list each items inside the invoice/receipt as independent item inside the same json, please include {include_items} for each jsonl."
+        else:
+            request = f"Make sure all json item is totatlly correct. Return a json of jsonl, list each items inside the invoice/receipt as independent item inside the same json, please include {include_items} for each jsonl."
+        return [
+            {"role": "system", "content": [{"type": "text", "text": instructions}]},
+            {"role": "user", "content": [
+                {"type": "image_url", "image_url": {"url": inputs.image_data_url}},
+                {"type": "text", "text": request},
+            ]},
+        ]
+
+    def _response_format(self, include_items: str, triage: bool = False) -> Optional[dict]:
+        """json_schema response_format built from include_items, unless the server has shown it can't take one"""
+        if STRUCTURED_OUTPUT == "off" or not self.structured_output:
+            return None
+        return {"type": "json_schema", "json_schema": {
+            "name": "receipt", "strict": True, "schema": receipt_json_schema(include_items, triage)}}
+
+    def _extract_json(self, messages: List[dict], on_item: Optional[Callable[[Any], None]] = None,
+                      response_format: Optional[dict] = None, stage: str = "extract") -> Any:
+        """One Gemma pass. Raises json.JSONDecodeError (with the raw text as e.doc) if unparseable"""
         try:
-            response = self._call_gemma(messages)
-            
-            # Clean Markdown code blocks before validation
-            cleaned_response = response.replace("```json", "").replace("```", "").replace("```jsonl", "").strip()
-            
-            # Validate JSON
-            json.loads(cleaned_response)
-            return cleaned_response
-            
-        except json.JSONDecodeError:
-            return json.dumps({
-                "error": "AI response was not valid JSON", 
-                "raw": response[:200]
-            })
+            return self._gemma_json(messages, on_item, response_format, stage)
+        except InferenceError as e:
+            if response_format is None or STRUCTURED_OUTPUT != "auto" or e.status_code not in (400, 422):
+                raise
+            # Rejected before any output, so nothing was streamed yet
+            logging.warning(f"{self.model} rejected response_format; using repair parsing from now on: {e}")
+            self.structured_output = False
+            return self._gemma_json(messages, on_item, None, stage)
+
+    def _gemma_json(self, messages: List[dict], on_item, response_format: Optional[dict], stage: str) -> Any:
+        if on_item is not None and GEMMA_STREAM:
+            # Parsing is interleaved with generation, so it is part of the extract stage here
+            with timed(stage):
+                return self._stream_gemma_json(messages, on_item, response_format=response_format)
+        with timed(stage):
+            response = self._call_gemma(messages, response_format=response_format)
+        with timed("parse"):
+            return parse_model_json(response)
+
+    def _extract_receipt(self, messages: List[dict], include_items: str,
+                         on_item: Optional[Callable[[Any], None]] = None, triage: bool = False) -> Receipt:
+        """Gemma pass -> Receipt: schema-constrained where supported, otherwise repaired, re-asked as a last resort"""
+        try:
+            data = self._extract_json(messages, on_item, self._response_format(include_items, triage))
+        except json.JSONDecodeError as e:
+            raw = e.doc or ""
+            if triage and NEED_OCR in raw:
+                return Receipt(needs_ocr=True)
+            data = self._repair(raw, include_items, reask=not triage)
+        try:
+            return Receipt.from_output(data)
+        except ValueError as e:
+            raise ExtractionError(f"Model output is not a receipt: {str(e)[:200]}") from e
+
+    def _repair(self, raw: str, include_items: str, reask: bool = True) -> Any:
+        """Salvage malformed output locally; re-ask Gemma for just the broken fragment as a last resort"""
+        with timed("parse"):
+            try:
+                data, dropped = repair_json(raw)
+            except json.JSONDecodeError:
+                data, dropped = None, raw
+        if data is not None and not re.search(r"\w", dropped):
+            REPAIRS.labels("repaired").inc()
+            return data
+        if not (reask and REPAIR_REASK):
+            REPAIRS.labels("failed").inc()
+            raise ExtractionError(f"AI response was not valid JSON: {raw[:200]}")
+
+        messages = [{"role": "user", "content": [{"type": "text", "text":
+                     reask_prompt + f"Fields for each item: {include_items}\n\n" + dropped[-REPAIR_REASK_MAX_CHARS:]}]}]
+        try:
+            fixed = self._extract_json(messages, response_format=self._response_format(include_items), stage="reask")
+        except json.JSONDecodeError as e:
+            try:
+                fixed, _ = repair_json(e.doc or "")
+            except json.JSONDecodeError:
+                REPAIRS.labels("failed").inc()
+                raise ExtractionError(f"AI response was not valid JSON, even after a re-ask: {raw[:200]}")
+        REPAIRS.labels("reasked").inc()
+        if data is None:
+            return fixed
+        # Keep what was salvaged locally and add the items recovered from the broken tail
+        receipt = Receipt.from_output(data)
+        receipt.items += Receipt.from_output(fixed).items
+        return receipt.model_dump(exclude_none=True)
+
+    def _triage_node(self, state: ReceiptState, config: RunnableConfig):
+        """Cheap first pass: Gemma alone, allowed to ask for the olmOCR transcription instead of answering"""
+        if CASCADE_ROUTER == "off":
+            return {"route": "ocr_always"}
+        inputs = config["configurable"]["inputs"]
+        on_item = inputs.on_item
+        streamed = []
+
+        def _report(item):
+            streamed.append(item)
+            on_item(item)
+        try:
+            receipt = self._extract_receipt(self._extraction_messages(state, inputs, triage=True), state["include_items"],
+                                            _report if on_item else None, triage=True)
+        except ExtractionError:
+            return {"route": "ocr_unparseable", "streamed": len(streamed)}
+        if receipt.needs_ocr:
+            return {"route": "ocr_requested", "streamed": len(streamed)}
+        return {"route": "direct", "result": receipt.model_dump()}
+
+    def _route_after_triage(self, state: ReceiptState) -> str:
+        return "done" if state["route"] == "direct" else "ocr"
+
+    def _ocr_node(self, state: ReceiptState, config: RunnableConfig):
+        inputs = config["configurable"]["inputs"]
+        return {"handwritten_text": self.process_handwritten_image(inputs.ocr_image_url or inputs.image_data_url)}
+
+    def _extract_node(self, state: ReceiptState, config: RunnableConfig):
+        """Second pass with the olmOCR transcription fed back in"""
+        inputs = config["configurable"]["inputs"]
+        # Items the first pass already reported would be duplicated by a second stream
+        on_item = inputs.on_item if not state.get("streamed") else None
+        receipt = self._extract_receipt(self._extraction_messages(state, inputs), state["include_items"], on_item)
+        return {"result": receipt.model_dump()}
+
+    def _validate_node(self, state: ReceiptState):
+        """Drop empty items and flag receipts whose items don't add up to the printed total"""
+        receipt = Receipt.model_validate(state["result"])
+        items = [item for item in receipt.items if item.item_name or item.price is not None]
+        if len(items) != len(receipt.items):
+            logging.info(f"Dropped {len(receipt.items) - len(items)} empty items")
+            receipt.items = items
+        prices = [item.price for item in items if isinstance(item.price, (int, float))]
+        total = receipt.subtotal if receipt.subtotal is not None else receipt.total
+        if prices and isinstance(total, (int, float)) and abs(sum(prices) - total) > max(0.05, abs(total) * 0.01):
+            logging.info(f"Items sum to {sum(prices):.2f} but the receipt says {total}")
+        return {"result": receipt.model_dump()}
+
+    def _publish_node(self, state: ReceiptState):
+        """Last node: the receipt is final. The worker publishes it from the connection thread (pika is not
+        thread-safe) and then clears the checkpoints, so a crash before the ack replays from here"""
+        ROUTES.labels(state["route"]).inc()
+        return {}
+
     def process_handwritten_image(self, image_url: str) -> str:
         """Specialized image-to-JSON processor"""
-        if image_url.startswith(('http://', 'https://')):
-            # Download image
-            img_data = requests.get(image_url).content
-            encoded_image = base64.b64encode(img_data).decode('utf-8')
-        else:
-            # Assume base64
-            encoded_image = image_url
+        image_data_url = self._as_data_url(image_url)
 
         messages = [
             {
             "role": "user",
             "content": [
                 {"type": "text", "text": handwritten_prompt},
-                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded_image}"}},
+                {"type": "image_url", "image_url": {"url": image_data_url}},
             ]
         }]
         
         try:
-            response = self._call_olm(messages)
+            with timed("ocr"):
+                response = self._call_olm(messages)
     
             return response
             
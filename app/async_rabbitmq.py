@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+import aio_pika
+from aio_pika.abc import AbstractChannel, AbstractRobustConnection
+from aio_pika.pool import Pool
+
+from app.config import (
+    PUBLISH_CHANNEL_POOL,
+    PUBLISH_CONFIRM_TIMEOUT,
+    PUBLISH_DRAIN_TIMEOUT,
+    PUBLISH_MAX_INFLIGHT,
+)
+from app.rabbitmq import QUEUE_ARGUMENTS
+
+
+class AsyncRabbitMQPublisher:
+    """asyncio-native publisher for the API: pooled channels, publisher confirms, bounded in-flight window"""
+    def __init__(self, host: str = 'rabbitmq',
+                 pool_size: int = PUBLISH_CHANNEL_POOL,
+                 max_inflight: int = PUBLISH_MAX_INFLIGHT):
+        self.host = host
+        self.pool_size = pool_size
+        self.connection: Optional[AbstractRobustConnection] = None
+        self.channel_pool: Optional[Pool] = None
+        self._window = asyncio.Semaphore(max_inflight)
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._connected = asyncio.Event()
+        self._connect_task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def is_connected(self) -> bool:
+        return self._connected.is_set() and self.connection is not None and not self.connection.is_closed
+
+    def start(self):
+        """Connect in the background; the API can start serving before the broker is reachable"""
+        self._connect_task = asyncio.create_task(self._connect_with_backoff())
+
+    async def _connect_with_backoff(self):
+        delay = 1
+        while not self._closing:
+            try:
+                await self.connect()
+                return
+            except Exception as e:
+                logging.error(f"Async RabbitMQ connect failed: {e} - retrying in {delay}s")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+    async def connect(self):
+        # connect_robust re-establishes the connection and its channels on its own after the first success
+        self.connection = await aio_pika.connect_robust(
+            host=self.host,
+            login=os.getenv("RABBITMQ_USER", "admin"),
+            password=os.getenv("RABBITMQ_PASS", "securepassword"),
+            heartbeat=600,
+        )
+        self.channel_pool = Pool(self._new_channel, max_size=self.pool_size)
+        async with self.channel_pool.acquire() as channel:
+            for queue, arguments in QUEUE_ARGUMENTS.items():
+                await channel.declare_queue(queue, durable=True, arguments=arguments or None)
+        self._connected.set()
+        logging.info("Async publisher connected to RabbitMQ")
+
+    async def _new_channel(self) -> AbstractChannel:
+        return await self.connection.channel(publisher_confirms=True)
+
+    def _message(self, body: bytes, headers: dict = None, content_type: str = 'application/json',
+                 persistent: bool = True, priority: int = None) -> aio_pika.Message:
+        return aio_pika.Message(
+            body=body,
+            headers=headers or {'x-version': '1.0'},
+            content_type=content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT if persistent else aio_pika.DeliveryMode.NOT_PERSISTENT,
+            priority=priority,
+        )
+
+    async def _publish_on(self, channel: AbstractChannel, queue: str, message: aio_pika.Message, timeout: float):
+        """Publish inside the in-flight window and wait for the confirm"""
+        async with self._window:
+            self._inflight += 1
+            self._idle.clear()
+            try:
+                await channel.default_exchange.publish(message, routing_key=queue, mandatory=True, timeout=timeout)
+            finally:
+                self._inflight -= 1
+                if self._inflight == 0:
+                    self._idle.set()
+
+    async def publish(self, queue: str, body: bytes, timeout: float = PUBLISH_CONFIRM_TIMEOUT, **kwargs):
+        """Publish and wait for the broker's confirm. Raises ConnectionError if the broker is unavailable"""
+        if not self.is_connected:
+            raise ConnectionError("Cannot publish - no active RabbitMQ connection")
+        async with self.channel_pool.acquire() as channel:
+            await self._publish_on(channel, queue, self._message(body, **kwargs), timeout)
+
+    async def publish_batch(self, queue: str, messages: list, timeout: float = PUBLISH_CONFIRM_TIMEOUT, **kwargs) -> list:
+        """Publish many messages on one channel with their confirms pipelined.
+
+        messages are (body, options) pairs; options (e.g. headers) override kwargs for that message.
+        Returns one entry per message: None if confirmed, otherwise the exception.
+        """
+        if not self.is_connected:
+            raise ConnectionError("Cannot publish - no active RabbitMQ connection")
+        async with self.channel_pool.acquire() as channel:
+            return await asyncio.gather(
+                *(self._publish_on(channel, queue, self._message(body, **(kwargs | options)), timeout)
+                  for body, options in messages),
+                return_exceptions=True,
+            )
+
+    async def publish_image_task(self, request: str | bytes, **kwargs):
+        body = request.encode('utf-8') if isinstance(request, str) else request
+        await self.publish('image_requests', body, **kwargs)
+
+    async def queue_depth(self, queue: str) -> int:
+        """Ready messages in a queue, from a passive declare (the queue is never created or changed)"""
+        if not self.is_connected:
+            raise ConnectionError("Cannot inspect queue - no active RabbitMQ connection")
+        async with self.channel_pool.acquire() as channel:
+            declared = await channel.declare_queue(queue, passive=True)
+        return declared.declaration_result.message_count
+
+    async def close(self, drain_timeout: float = PUBLISH_DRAIN_TIMEOUT):
+        """Wait for in-flight confirms, then close channels and the connection"""
+        self._closing = True
+        if self._connect_task and not self._connect_task.done():
+            self._connect_task.cancel()
+        try:
+            await asyncio.wait_for(self._idle.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Closing publisher with {self._inflight} unconfirmed messages")
+        if self.channel_pool is not None:
+            await self.channel_pool.close()
+        if self.connection is not None:
+            await self.connection.close()
+        self._connected.clear()
@@ -0,0 +1,275 @@
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from app.config import BLOB_DIR, BLOB_STORE, BLOB_TTL_SECONDS, S3_BUCKET, S3_ENDPOINT_URL
+
+REF_PREFIX = "sha256:"
+
+
+def digest_of(ref: str) -> str:
+    if not ref.startswith(REF_PREFIX):
+        raise ValueError(f"Unsupported blob reference: {ref[:80]}")
+    digest = ref[len(REF_PREFIX):]
+    if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+        raise ValueError(f"Malformed blob reference: {ref[:80]}")
+    return digest
+
+
+class BlobWriter(ABC):
+    """Incremental upload: write() chunks as they arrive, then commit() for the content reference"""
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        self._write(chunk)
+
+    @abstractmethod
+    def _write(self, chunk: bytes): ...
+
+    @abstractmethod
+    def commit(self, owner: str) -> str: ...
+
+    @abstractmethod
+    def abort(self): ...
+
+
+class BlobStore(ABC):
+    """Content-addressed image storage shared by the API (writer) and the workers (readers)"""
+
+    @abstractmethod
+    def writer(self) -> BlobWriter: ...
+
+    @abstractmethod
+    @contextmanager
+    def open(self, ref: str) -> Iterator[memoryview]:
+        """Yield the blob as a read-only buffer, valid only inside the with-block"""
+
+    @abstractmethod
+    def release(self, ref: str, owner: str):
+        """Drop owner's reference; the blob is deleted once nobody references it"""
+
+    @abstractmethod
+    def gc(self, max_age: float = BLOB_TTL_SECONDS) -> int:
+        """Delete blobs nobody has referenced for max_age seconds (a reference that old counts as abandoned);
+        returns the count"""
+
+
+class _LocalWriter(BlobWriter):
+    def __init__(self, store: "LocalBlobStore"):
+        super().__init__()
+        self._store = store
+        self._file = tempfile.NamedTemporaryFile(dir=store.tmp_dir, delete=False)
+
+    def _write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def commit(self, owner: str) -> str:
+        self._file.close()
+        digest = self._hash.hexdigest()
+        path = self._store._path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._store._locked(digest):  # a concurrent release() or gc() cannot delete the blob in between
+            self._store._add_ref(digest, owner)
+            if os.path.exists(path):
+                os.unlink(self._file.name)  # identical content already stored
+                os.utime(path)
+            else:
+                os.replace(self._file.name, path)
+        return REF_PREFIX + digest
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.unlink(self._file.name)
+
+
+class LocalBlobStore(BlobStore):
+    """Filesystem backend (a volume shared between containers); reads are mmap'ed, not copied"""
+    def __init__(self, root: str = BLOB_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.lock_dir = os.path.join(root, "locks")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _refs_dir(self, digest: str) -> str:
+        return self._path(digest) + ".refs"
+
+    @contextmanager
+    def _locked(self, digest: str):
+        """Serialise reference changes to a blob across processes sharing the volume (256 striped flock files)"""
+        with open(os.path.join(self.lock_dir, digest[:2]), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _add_ref(self, digest: str, owner: str):
+        refs = self._refs_dir(digest)
+        os.makedirs(refs, exist_ok=True)
+        marker = os.path.join(refs, owner)
+        open(marker, "w").close()
+        os.utime(marker)  # gc() ages references out by their mtime
+
+    def writer(self) -> BlobWriter:
+        return _LocalWriter(self)
+
+    @contextmanager
+    def open(self, ref: str) -> Iterator[memoryview]:
+        with open(self._path(digest_of(ref)), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+
+    def release(self, ref: str, owner: str):
+        digest = digest_of(ref)
+        refs = self._refs_dir(digest)
+        with self._locked(digest):
+            try:
+                os.unlink(os.path.join(refs, owner))
+                os.rmdir(refs)  # fails while other owners still reference the blob
+            except OSError:
+                return
+            try:
+                os.unlink(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def gc(self, max_age: float = BLOB_TTL_SECONDS) -> int:
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.tmp_dir):  # uploads that never committed
+            try:
+                if os.path.getmtime(os.path.join(self.tmp_dir, name)) < cutoff:
+                    os.unlink(os.path.join(self.tmp_dir, name))
+            except FileNotFoundError:
+                continue
+        for shard in os.listdir(self.root):
+            if len(shard) != 2:
+                continue  # tmp, locks
+            digests = {name[:64] for name in os.listdir(os.path.join(self.root, shard))}
+            for digest in digests:
+                with self._locked(digest):
+                    removed += self._collect(digest, cutoff)
+        if removed:
+            logging.info(f"Blob GC removed {removed} blobs unreferenced for {max_age}s")
+        return removed
+
+    def _collect(self, digest: str, cutoff: float) -> int:
+        """Caller holds the digest's lock. Ages out stale references, then deletes the blob if none are left"""
+        refs = self._refs_dir(digest)
+        live = 0
+        for owner in (os.listdir(refs) if os.path.isdir(refs) else ()):
+            marker = os.path.join(refs, owner)
+            try:
+                if os.path.getmtime(marker) >= cutoff:
+                    live += 1
+                else:
+                    os.unlink(marker)
+            except FileNotFoundError:
+                continue
+        if live:
+            return 0
+        try:
+            os.rmdir(refs)
+        except OSError:
+            pass
+        path = self._path(digest)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                return 1
+        except FileNotFoundError:
+            pass
+        return 0
+
+
+class _S3Writer(BlobWriter):
+    def __init__(self, store: "S3BlobStore"):
+        super().__init__()
+        self._store = store
+        # Spill to disk past 8MB so large uploads are never held in RAM
+        self._file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+
+    def _write(self, chunk: bytes):
+        self._file.write(chunk)
+
+    def commit(self, owner: str) -> str:
+        digest = self._hash.hexdigest()
+        self._file.seek(0)
+        self._store.client.upload_fileobj(self._file, self._store.bucket, digest)
+        self._file.close()
+        return REF_PREFIX + digest
+
+    def abort(self):
+        self._file.close()
+
+
+class S3BlobStore(BlobStore):
+    """S3-compatible backend (AWS, MinIO, ...). Lifetime is TTL-based: use gc() or a bucket lifecycle rule"""
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: Optional[str] = S3_ENDPOINT_URL):
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError("BLOB_STORE=s3 requires boto3 (pip install boto3)") from e
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def writer(self) -> BlobWriter:
+        return _S3Writer(self)
+
+    @contextmanager
+    def open(self, ref: str) -> Iterator[memoryview]:
+        body = self.client.get_object(Bucket=self.bucket, Key=digest_of(ref))["Body"].read()
+        yield memoryview(body)
+
+    def release(self, ref: str, owner: str):
+        # Objects are shared by identical uploads, so they are only removed by TTL
+        pass
+
+    def gc(self, max_age: float = BLOB_TTL_SECONDS) -> int:
+        cutoff = time.time() - max_age
+        removed = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket):
+            for obj in page.get("Contents", []):
+                if obj["LastModified"].timestamp() < cutoff:
+                    self.client.delete_object(Bucket=self.bucket, Key=obj["Key"])
+                    removed += 1
+        return removed
+
+
+def create_blob_store(kind: str = BLOB_STORE) -> Optional[BlobStore]:
+    """None means 'inline': images travel base64-encoded inside the message as before"""
+    if kind in ("auto", "local"):
+        try:
+            return LocalBlobStore()
+        except OSError as e:
+            if kind == "local":
+                raise ValueError(f"BLOB_STORE=local needs a writable BLOB_DIR ({BLOB_DIR}): {e}") from e
+            logging.warning(f"BLOB_DIR {BLOB_DIR} is not writable ({e}); sending images inline. "
+                            f"Set BLOB_DIR, or BLOB_STORE=inline to silence this")
+            return None
+    if kind == "s3":
+        return S3BlobStore()
+    if kind == "inline":
+        return None
+    raise ValueError(f"Unknown BLOB_STORE: {kind}")
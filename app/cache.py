@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.config import CACHE_MAX_BYTES, CACHE_MEMORY_ENTRIES, CACHE_PATH, CACHE_TTL_SECONDS
+
+
+def extraction_key(image_bytes: bytes, include_items: str, models: Tuple[str, ...], prompt_version: str) -> str:
+    """Content address of one extraction: same image + same fields + same models/prompts -> same answer"""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    meta = json.dumps([include_items.strip().lower(), list(models), prompt_version])
+    return hashlib.sha256(f"{digest}:{meta}".encode("utf-8")).hexdigest()
+
+
+class _Flight:
+    """A computation in progress that duplicate requests can wait on"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class ExtractionCache:
+    """Two-tier cache of extraction results: in-memory LRU backed by a SQLite file with TTL and size eviction"""
+    def __init__(self, path: str = CACHE_PATH,
+                 memory_entries: int = CACHE_MEMORY_ENTRIES,
+                 ttl_seconds: int = CACHE_TTL_SECONDS,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _Flight] = {}
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS extractions_accessed ON extractions(accessed)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+            row = self._db.execute("SELECT value, created FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if now - row[1] <= self.ttl_seconds:
+                    self._db.execute("UPDATE extractions SET accessed = ? WHERE key = ?", (now, key))
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self._counters["disk_hits"] += 1
+                    return value
+                self._db.execute("DELETE FROM extractions WHERE key = ?", (key,))
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        now = time.time()
+        encoded = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, now, value)
+            self._db.execute(
+                "INSERT OR REPLACE INTO extractions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), now, now),
+            )
+            self._evict_disk(now)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any],
+                       cacheable: Callable[[Any], bool] = lambda value: True) -> Tuple[Any, bool]:
+        """Return (value, hit). Concurrent calls for the same key share a single compute()"""
+        value = self.get(key)
+        if value is not None:
+            return value, True
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            else:
+                self._counters["coalesced"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = compute()
+            if cacheable(flight.value):
+                self.put(key, flight.value)
+            return flight.value, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            disk_entries, disk_bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extractions"
+            ).fetchone()
+            return dict(self._counters, memory_entries=len(self._memory),
+                        disk_entries=disk_entries, disk_bytes=disk_bytes)
+
+    def _remember(self, key: str, created: float, value: Any):
+        # Caller holds self._lock
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float):
+        # Caller holds self._lock
+        expired = self._db.execute(
+            "DELETE FROM extractions WHERE created < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            row = self._db.execute(
+                "SELECT key, size FROM extractions ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            self._db.execute("DELETE FROM extractions WHERE key = ?", (row[0],))
+            total -= row[1]
+            evicted += 1
+        if expired or evicted:
+            self._counters["evictions"] += expired + evicted
+            logging.info(f"Extraction cache evicted {expired} expired and {evicted} LRU entries")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,88 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict
+
+from app.config import CHECKPOINT_PATH, CHECKPOINT_TTL_SECONDS
+
+
+class CheckpointStore:
+    """SQLite checkpointer for the receipt graph, plus an index of threads by task for cleanup.
+
+    Thread ids are "<conversation_id>" or "<conversation_id>/<part>"; clear(conversation_id) drops them all.
+    Threads never cleared (the task was acked by another worker, or failed for good) expire after the TTL.
+    """
+    def __init__(self, path: str = CHECKPOINT_PATH, ttl_seconds: int = CHECKPOINT_TTL_SECONDS,
+                 sweep_interval: float = 600):
+        try:
+            from langgraph.checkpoint.sqlite import SqliteSaver
+        except ImportError as e:
+            raise ImportError("CHECKPOINT_ENABLED=1 requires langgraph-checkpoint-sqlite "
+                              "(pip install langgraph-checkpoint-sqlite)") from e
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._counters = {"resumed": 0, "cleared": 0, "expired": 0}
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        self.saver = SqliteSaver(conn)
+        # The saver serialises access to the connection with its own lock; every query here goes through it too
+        with self.saver.cursor() as cur:
+            cur.execute("CREATE TABLE IF NOT EXISTS checkpoint_threads ("
+                        " thread_id TEXT PRIMARY KEY, owner TEXT NOT NULL, created REAL NOT NULL)")
+            cur.execute("CREATE INDEX IF NOT EXISTS checkpoint_threads_owner ON checkpoint_threads(owner)")
+            cur.execute("CREATE INDEX IF NOT EXISTS checkpoint_threads_created ON checkpoint_threads(created)")
+
+    def track(self, thread_id: str):
+        """Record a thread before its first checkpoint is written"""
+        with self.saver.cursor() as cur:
+            cur.execute("INSERT OR IGNORE INTO checkpoint_threads (thread_id, owner, created) VALUES (?, ?, ?)",
+                        (thread_id, thread_id.split("/", 1)[0], time.time()))
+        self._sweep()
+
+    def resumed(self):
+        with self._lock:
+            self._counters["resumed"] += 1
+
+    def clear(self, owner: str):
+        """Delete every checkpoint of a task (the whole upload and each of its parts)"""
+        with self.saver.cursor() as cur:
+            threads = [row[0] for row in cur.execute(
+                "SELECT thread_id FROM checkpoint_threads WHERE owner = ?", (owner,)).fetchall()]
+        self._delete(threads)
+        with self._lock:
+            self._counters["cleared"] += len(threads)
+
+    def _delete(self, threads):
+        for thread_id in threads:
+            self.saver.delete_thread(thread_id)
+            with self.saver.cursor() as cur:
+                cur.execute("DELETE FROM checkpoint_threads WHERE thread_id = ?", (thread_id,))
+
+    def _sweep(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_sweep < self.sweep_interval:
+                return
+            self._last_sweep = now
+        with self.saver.cursor() as cur:
+            expired = [row[0] for row in cur.execute(
+                "SELECT thread_id FROM checkpoint_threads WHERE created < ?",
+                (time.time() - self.ttl_seconds,)).fetchall()]
+        if expired:
+            self._delete(expired)
+            with self._lock:
+                self._counters["expired"] += len(expired)
+            logging.info(f"Checkpoint store expired {len(expired)} orphaned threads")
+
+    def stats(self) -> Dict[str, int]:
+        with self.saver.cursor(transaction=False) as cur:
+            threads = cur.execute("SELECT COUNT(*) FROM checkpoint_threads").fetchone()[0]
+        with self._lock:
+            return dict(self._counters, threads=threads)
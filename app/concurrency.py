@@ -0,0 +1,228 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from app.config import (
+    LIMITER_BACKOFF, LIMITER_INITIAL, LIMITER_LATENCY_TOLERANCE, LIMITER_MAX,
+    LIMITER_MAX_QUEUE_WAIT, LIMITER_MIN, LIMITER_SHARED_FILE,
+)
+from app.inference import InferenceError
+
+
+class LimiterRejected(InferenceError):
+    """The request waited longer than LIMITER_MAX_QUEUE_WAIT for an inference slot"""
+
+
+class SharedLimitFile:
+    """Coordinates one endpoint's limit across worker processes on the same host (or a shared volume).
+
+    The file holds the canonical limit plus every live process's in-flight count; each process
+    may use `limit - in-flight of everyone else`. AIMD runs on the shared limit itself: processes report
+    their successes (+1/limit each, so +1 per window of `limit` calls however many processes make them)
+    and ask for decreases, which are applied once per window for everyone.
+    """
+    def __init__(self, path: str, key: str, stale_after: float = 30):
+        self.path = path
+        self.key = key
+        self.stale_after = stale_after
+        self.member = f"{os.uname().nodename}:{os.getpid()}"
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def sync(self, successes: int, decrease: bool, window: float, backoff: float, inflight: int,
+             initial: float, lo: float, hi: float) -> tuple:
+        """Apply our pending adjustment, publish our in-flight count; returns (shared_limit, others_inflight)"""
+        now = time.time()
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state = json.loads(raw) if raw.strip() else {}
+                entry = state.setdefault(self.key, {"limit": initial, "members": {}})
+                limit = entry["limit"] + successes / entry["limit"]
+                # Every process that saw the same overload asks; only the first in a window cuts
+                if decrease and now - entry.get("decreased_at", 0) > window:
+                    limit *= backoff
+                    entry["decreased_at"] = now
+                entry["limit"] = min(hi, max(lo, limit))
+                members = {m: v for m, v in entry["members"].items() if now - v["seen"] < self.stale_after}
+                members[self.member] = {"inflight": inflight, "seen": now}
+                entry["members"] = members
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        others = sum(v["inflight"] for m, v in members.items() if m != self.member)
+        return entry["limit"], others
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit for one model endpoint.
+
+    Each call that finishes within LIMITER_LATENCY_TOLERANCE x the baseline latency grows the limit
+    by ~1 per window of `limit` calls; an error or a slow call cuts it by LIMITER_BACKOFF (at most
+    once per window). Callers beyond the limit queue; past LIMITER_MAX_QUEUE_WAIT they are rejected.
+    """
+    def __init__(self, name: str,
+                 initial: float = LIMITER_INITIAL,
+                 min_limit: float = LIMITER_MIN,
+                 max_limit: float = LIMITER_MAX,
+                 tolerance: float = LIMITER_LATENCY_TOLERANCE,
+                 backoff: float = LIMITER_BACKOFF,
+                 max_queue_wait: float = LIMITER_MAX_QUEUE_WAIT,
+                 shared_file: Optional[str] = LIMITER_SHARED_FILE,
+                 sync_interval: float = 1.0):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.max_queue_wait = max_queue_wait
+        self.limit = min(max_limit, max(min_limit, initial))
+        self._initial = self.limit
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._queued = 0
+        self._baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._counters = {"completed": 0, "errors": 0, "slow": 0, "rejected": 0,
+                          "queue_wait_total": 0.0, "queue_wait_max": 0.0}
+
+        self._shared = SharedLimitFile(shared_file, name) if shared_file else None
+        self._pending_successes = 0
+        self._pending_decrease = False
+        self._others_inflight = 0
+        self._last_sync = 0.0
+        self._sync_interval = sync_interval
+
+    def _capacity(self) -> float:
+        return max(self.min_limit, self.limit - self._others_inflight)
+
+    def acquire(self):
+        started = time.monotonic()
+        with self._cond:
+            self._queued += 1
+            try:
+                while self._inflight >= self._capacity():
+                    remaining = self.max_queue_wait - (time.monotonic() - started)
+                    if remaining <= 0:
+                        self._counters["rejected"] += 1
+                        raise LimiterRejected(f"{self.name}: no inference slot after {self.max_queue_wait:.0f}s "
+                                              f"(limit={self.limit:.1f}, in-flight={self._inflight})")
+                    self._cond.wait(min(remaining, self._sync_interval))
+                    self._maybe_sync()
+                self._inflight += 1
+            finally:
+                self._queued -= 1
+            waited = time.monotonic() - started
+            self._counters["queue_wait_total"] += waited
+            self._counters["queue_wait_max"] = max(self._counters["queue_wait_max"], waited)
+
+    def release(self, latency: float, error: bool = False, sample: bool = True):
+        """sample=False frees the slot without feeding the limit (the call told nothing about the server's load)"""
+        with self._cond:
+            self._inflight -= 1
+            self._counters["completed"] += 1
+            if not sample:
+                self._cond.notify_all()
+                return
+            old_limit = self.limit
+            slow = self._baseline is not None and latency > self._baseline * self.tolerance
+            if not error:
+                # Baseline follows the fastest recent calls, drifting up slowly so it can re-learn
+                self._baseline = latency if self._baseline is None else min(latency, self._baseline * 1.01)
+            if error or slow:
+                self._counters["errors" if error else "slow"] += 1
+                now = time.monotonic()
+                # One decrease per window of in-flight calls, not one per failing call
+                if now - self._last_decrease > (self._baseline or latency):
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+                    self._pending_decrease = True
+            else:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._pending_successes += 1
+            self._maybe_sync(force=self.limit < old_limit)
+            self._cond.notify_all()
+
+    def _maybe_sync(self, force: bool = False):
+        # Caller holds self._cond
+        if self._shared is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_sync < self._sync_interval:
+            return
+        try:
+            self.limit, self._others_inflight = self._shared.sync(
+                self._pending_successes, self._pending_decrease, self._baseline or self._sync_interval,
+                self.backoff, self._inflight, self._initial, self.min_limit, self.max_limit)
+            self._pending_successes = 0
+            self._pending_decrease = False
+        except OSError as e:
+            logging.warning(f"Limiter {self.name}: shared state unavailable: {e}")
+        self._last_sync = now
+
+    @contextmanager
+    def slot(self):
+        """with limiter.slot(): call the model - latency and failures feed the limit"""
+        self.acquire()
+        started = time.monotonic()
+        error, sample = False, True
+        try:
+            yield
+        except InferenceError as e:
+            # 4xx means a bad request, not an overloaded server
+            error = e.status_code is None or e.status_code >= 500
+            sample = error
+            raise
+        except OSError:
+            error = True  # timeouts and transport errors not wrapped in InferenceError (requests' are OSErrors)
+            raise
+        except Exception:
+            sample = False  # decode errors, a failing on_item callback: no latency worth learning from
+            raise
+        finally:
+            self.release(time.monotonic() - started, error, sample)
+
+    def stats(self) -> dict:
+        with self._cond:
+            completed = self._counters["completed"] or 1
+            return {
+                "limit": round(self.limit, 2),
+                "inflight": self._inflight,
+                "queued": self._queued,
+                "others_inflight": self._others_inflight,
+                "baseline_latency": self._baseline,
+                "avg_queue_wait": self._counters["queue_wait_total"] / completed,
+                "max_queue_wait": self._counters["queue_wait_max"],
+                "completed": self._counters["completed"],
+                "errors": self._counters["errors"],
+                "slow": self._counters["slow"],
+                "rejected": self._counters["rejected"],
+            }
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(endpoint: str, model: str) -> AdaptiveLimiter:
+    """One limiter per (endpoint, model) per process"""
+    name = f"{model}@{endpoint}"
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name)
+        return _limiters[name]
+
+
+def limiter_stats() -> Dict[str, dict]:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
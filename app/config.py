@@ -0,0 +1,170 @@
+import os
+
+# Worker
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "1"))
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", "0"))  # 0 -> same as concurrency
+WORKER_DRAIN_TIMEOUT = float(os.getenv("WORKER_DRAIN_TIMEOUT", "120"))  # on SIGTERM, wait this long for in-flight tasks
+# Transient failures go back to image_requests through one TTL queue per attempt; then to image_requests.dead
+RETRY_DELAYS = [float(d) for d in os.getenv("RETRY_DELAYS", "5,30,120").split(",") if d.strip()]  # seconds, one per retry
+RABBITMQ_RECONNECT_MAX = float(os.getenv("RABBITMQ_RECONNECT_MAX", "30"))  # cap of the reconnect backoff
+
+# Inference endpoints (OpenAI-compatible chat completions, e.g. LM Studio)
+GEMMA_ENDPOINT = os.getenv("GEMMA_ENDPOINT", "http://host.docker.internal:1234")
+OLM_ENDPOINT = os.getenv("OLM_ENDPOINT", "http://host.docker.internal:1234")
+GEMMA_MODEL = os.getenv("GEMMA_MODEL", "gemma-3-4b-it")
+OLM_MODEL = os.getenv("OLM_MODEL", "olmocr-7b-0225-preview")
+
+# Inference client: timeouts in seconds, retries on 5xx / connection errors
+INFERENCE_CONNECT_TIMEOUT = float(os.getenv("INFERENCE_CONNECT_TIMEOUT", "5"))
+GEMMA_READ_TIMEOUT = float(os.getenv("GEMMA_READ_TIMEOUT", "180"))
+OLM_READ_TIMEOUT = float(os.getenv("OLM_READ_TIMEOUT", "240"))
+INFERENCE_MAX_RETRIES = int(os.getenv("INFERENCE_MAX_RETRIES", "2"))
+INFERENCE_BACKOFF_BASE = float(os.getenv("INFERENCE_BACKOFF_BASE", "0.5"))
+INFERENCE_BACKOFF_MAX = float(os.getenv("INFERENCE_BACKOFF_MAX", "10"))
+INFERENCE_MAX_CONCURRENCY = int(os.getenv("INFERENCE_MAX_CONCURRENCY", "4"))  # per endpoint
+INFERENCE_POOL_SIZE = int(os.getenv("INFERENCE_POOL_SIZE", "8"))
+
+# Extraction cache (in-memory LRU in front of an on-disk SQLite tier)
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "1") == "1"
+CACHE_PATH = os.getenv("CACHE_PATH", "/tmp/receipt_cache/extractions.sqlite3")
+CACHE_MEMORY_ENTRIES = int(os.getenv("CACHE_MEMORY_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Per-node LangGraph checkpoints of the receipt graph, so a redelivered task resumes where the last worker stopped
+CHECKPOINT_ENABLED = os.getenv("CHECKPOINT_ENABLED", "1") == "1"
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "/tmp/receipt_cache/checkpoints.sqlite3")
+CHECKPOINT_TTL_SECONDS = int(os.getenv("CHECKPOINT_TTL_SECONDS", str(24 * 3600)))  # orphans (e.g. acked elsewhere)
+
+# Image preprocessing before inference, configured per model stage
+PREPROCESS_ENABLED = os.getenv("PREPROCESS_ENABLED", "1") == "1"
+OLM_MAX_SIDE = int(os.getenv("OLM_MAX_SIDE", "1536"))
+OLM_GRAYSCALE = os.getenv("OLM_GRAYSCALE", "1") == "1"
+OLM_IMAGE_FORMAT = os.getenv("OLM_IMAGE_FORMAT", "JPEG")
+OLM_IMAGE_QUALITY = int(os.getenv("OLM_IMAGE_QUALITY", "85"))
+GEMMA_MAX_SIDE = int(os.getenv("GEMMA_MAX_SIDE", "1024"))
+GEMMA_GRAYSCALE = os.getenv("GEMMA_GRAYSCALE", "0") == "1"
+GEMMA_IMAGE_FORMAT = os.getenv("GEMMA_IMAGE_FORMAT", "JPEG")
+GEMMA_IMAGE_QUALITY = int(os.getenv("GEMMA_IMAGE_QUALITY", "85"))
+# Receipt localisation (needs numpy): crop, deskew and straighten the receipt out of a photo before both stages
+LOCALIZE_ENABLED = os.getenv("LOCALIZE_ENABLED", "1") == "1"
+LOCALIZE_WORK_SIDE = int(os.getenv("LOCALIZE_WORK_SIDE", "512"))  # detection runs on a copy this size
+LOCALIZE_MIN_CONFIDENCE = float(os.getenv("LOCALIZE_MIN_CONFIDENCE", "0.7"))  # below this the full frame is kept
+LOCALIZE_MAX_CROP_RATIO = float(os.getenv("LOCALIZE_MAX_CROP_RATIO", "0.9"))  # receipt fills more: no crop
+LOCALIZE_MARGIN = float(os.getenv("LOCALIZE_MARGIN", "0.02"))  # padding around the detected receipt
+LOCALIZE_MAX_SATURATION = int(os.getenv("LOCALIZE_MAX_SATURATION", "60"))  # paper is grey-ish; tables often aren't
+
+# Claim-check blob store: the queue carries a content hash, the image bytes live here
+BLOB_STORE = os.getenv("BLOB_STORE", "auto")  # auto (local if BLOB_DIR is writable, else inline) | local | s3 | inline (base64 inside the message)
+BLOB_DIR = os.getenv("BLOB_DIR", "/data/blobs")
+BLOB_TTL_SECONDS = int(os.getenv("BLOB_TTL_SECONDS", str(24 * 3600)))
+BLOB_GC_INTERVAL = int(os.getenv("BLOB_GC_INTERVAL", "600"))
+BLOB_CHUNK_SIZE = int(os.getenv("BLOB_CHUNK_SIZE", str(1024 * 1024)))
+S3_BUCKET = os.getenv("S3_BUCKET", "receipts")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. a local MinIO stand-in
+
+# Result index served by GET /result/{conversation_id}
+RESULT_MAX_ENTRIES = int(os.getenv("RESULT_MAX_ENTRIES", "10000"))
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", "3600"))
+RESULT_DB_PATH = os.getenv("RESULT_DB_PATH", "")  # empty -> memory only
+RESULT_MAX_WAIT = float(os.getenv("RESULT_MAX_WAIT", "30"))
+# Each API replica consumes every result through its own queue, image_results.<replica id>
+RESULT_REPLICA_ID = os.getenv("RESULT_REPLICA_ID", "")  # empty -> hostname; keep it stable across restarts
+RESULT_QUEUE_EXPIRES = int(os.getenv("RESULT_QUEUE_EXPIRES", "3600"))  # seconds a replica's queue outlives it
+
+# Receipt store behind GET /receipts: every completed extraction, kept indefinitely, one row per line item
+RECEIPT_STORE_ENABLED = os.getenv("RECEIPT_STORE_ENABLED", "1") == "1"
+RECEIPT_DB_PATH = os.getenv("RECEIPT_DB_PATH", "/tmp/receipt_cache/receipts.sqlite3")
+RECEIPT_BATCH_SIZE = int(os.getenv("RECEIPT_BATCH_SIZE", "500"))  # receipts per write transaction, at most
+RECEIPT_MAX_PENDING = int(os.getenv("RECEIPT_MAX_PENDING", "10000"))  # then the result consumer waits for the writer
+RECEIPT_DAY_FIRST = os.getenv("RECEIPT_DAY_FIRST", "1") == "1"  # how to read 03/04/2024 on a receipt
+RECEIPT_PAGE_MAX = int(os.getenv("RECEIPT_PAGE_MAX", "500"))
+
+# image_requests envelope: "binary" (x-version 2.0, fields in headers, raw image body) or "json" (1.0).
+# Workers accept both; keep "json" until every worker runs a version that reads 2.0
+WIRE_FORMAT = os.getenv("WIRE_FORMAT", "binary")
+WIRE_COMPRESSION = os.getenv("WIRE_COMPRESSION", "none")  # none | zstd (needs zstandard)
+WIRE_COMPRESS_MIN_BYTES = int(os.getenv("WIRE_COMPRESS_MIN_BYTES", "4096"))
+
+# Async publisher used by the API
+PUBLISH_CHANNEL_POOL = int(os.getenv("PUBLISH_CHANNEL_POOL", "4"))
+PUBLISH_MAX_INFLIGHT = int(os.getenv("PUBLISH_MAX_INFLIGHT", "64"))
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("PUBLISH_CONFIRM_TIMEOUT", "10"))
+PUBLISH_DRAIN_TIMEOUT = float(os.getenv("PUBLISH_DRAIN_TIMEOUT", "15"))
+
+# Batch uploads (/process-images)
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "200"))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", str(25 * 1024 * 1024)))
+
+# Stream Gemma's answer and publish line items to image_partials as they complete
+GEMMA_STREAM = os.getenv("GEMMA_STREAM", "1") == "1"
+
+# Model cascade: "gemma" lets a first Gemma pass decide whether olmOCR is needed; "off" always runs olmOCR first
+CASCADE_ROUTER = os.getenv("CASCADE_ROUTER", "gemma")
+
+# Follow-up questions about an extracted receipt: bounded per-conversation history kept by the API
+FOLLOWUP_HISTORY_TOKENS = int(os.getenv("FOLLOWUP_HISTORY_TOKENS", "1500"))  # approximate, per conversation
+FOLLOWUP_MAX_SESSIONS = int(os.getenv("FOLLOWUP_MAX_SESSIONS", "10000"))
+FOLLOWUP_SESSION_TTL = int(os.getenv("FOLLOWUP_SESSION_TTL", "3600"))  # idle seconds before history is dropped
+FOLLOWUP_MAX_TOKENS = int(os.getenv("FOLLOWUP_MAX_TOKENS", "400"))  # answer length
+
+# Structured output: "auto" sends a json_schema response_format until the server rejects one, "on" always, "off" never
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "auto")
+REPAIR_REASK = os.getenv("REPAIR_REASK", "1") == "1"  # re-ask Gemma with the broken fragment when local repair fails
+REPAIR_REASK_MAX_CHARS = int(os.getenv("REPAIR_REASK_MAX_CHARS", "4000"))
+
+# Adaptive (AIMD) concurrency limit per model endpoint, shared by all threads of a worker
+LIMITER_ENABLED = os.getenv("LIMITER_ENABLED", "1") == "1"
+LIMITER_INITIAL = float(os.getenv("LIMITER_INITIAL", "2"))
+LIMITER_MIN = float(os.getenv("LIMITER_MIN", "1"))
+LIMITER_MAX = float(os.getenv("LIMITER_MAX", str(INFERENCE_MAX_CONCURRENCY)))
+LIMITER_LATENCY_TOLERANCE = float(os.getenv("LIMITER_LATENCY_TOLERANCE", "2.0"))  # x baseline latency
+LIMITER_BACKOFF = float(os.getenv("LIMITER_BACKOFF", "0.7"))  # multiplicative decrease
+LIMITER_MAX_QUEUE_WAIT = float(os.getenv("LIMITER_MAX_QUEUE_WAIT", "300"))
+LIMITER_SHARED_FILE = os.getenv("LIMITER_SHARED_FILE", "")  # e.g. /data/limits/limiter.json to share across replicas
+
+# Metrics / profiling
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))  # 0 disables the worker's /metrics server
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT", "/tmp/receipt_profile.folded")
+DEBUG_ENDPOINTS = os.getenv("DEBUG_ENDPOINTS", "0") == "1"  # exposes /debug/profile on the API
+
+# Priority lanes on image_requests (x-max-priority) and task deadlines
+TASK_MAX_PRIORITY = int(os.getenv("TASK_MAX_PRIORITY", "10"))
+INTERACTIVE_PRIORITY = int(os.getenv("INTERACTIVE_PRIORITY", "8"))  # /process-image default; >= this is the interactive lane
+BULK_PRIORITY = int(os.getenv("BULK_PRIORITY", "2"))  # /process-images default
+QUEUE_DEPTH_INTERVAL = float(os.getenv("QUEUE_DEPTH_INTERVAL", "15"))  # how often workers sample queue depth
+
+# API admission control: shed uploads when image_requests is too far behind, and rate-limit each client
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "600"))  # estimated queue wait (s) beyond which uploads get 429
+ADMISSION_MAX_DEPTH = int(os.getenv("ADMISSION_MAX_DEPTH", "5000"))  # cap while no drain rate has been measured yet
+ADMISSION_REFRESH_INTERVAL = float(os.getenv("ADMISSION_REFRESH_INTERVAL", "5"))  # passive queue_declare period
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", "600"))
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "10"))  # receipts per client; 0 disables
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "100"))
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER", "X-API-Key")
+# Issued keys (comma-separated) that get a bucket of their own; any other or missing key is keyed by IP
+RATE_LIMIT_API_KEYS = frozenset(key.strip() for key in os.getenv("RATE_LIMIT_API_KEYS", "").split(",") if key.strip())
+RATE_LIMIT_MAX_CLIENTS = int(os.getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+
+# python -m app.supervisor: autoscaled Worker processes on one host
+SUPERVISOR_MIN_WORKERS = int(os.getenv("SUPERVISOR_MIN_WORKERS", "1"))
+SUPERVISOR_MAX_WORKERS = int(os.getenv("SUPERVISOR_MAX_WORKERS", "4"))
+SUPERVISOR_INTERVAL = float(os.getenv("SUPERVISOR_INTERVAL", "10"))  # seconds between observations
+SUPERVISOR_TARGET_BACKLOG = int(os.getenv("SUPERVISOR_TARGET_BACKLOG", "20"))  # ready messages per worker before scaling up
+SUPERVISOR_SCALE_UP_UTILISATION = float(os.getenv("SUPERVISOR_SCALE_UP_UTILISATION", "0.75"))
+SUPERVISOR_SCALE_DOWN_UTILISATION = float(os.getenv("SUPERVISOR_SCALE_DOWN_UTILISATION", "0.25"))
+SUPERVISOR_SCALE_DOWN_STABLE = int(os.getenv("SUPERVISOR_SCALE_DOWN_STABLE", "6"))  # consecutive idle observations
+SUPERVISOR_SCALE_UP_COOLDOWN = float(os.getenv("SUPERVISOR_SCALE_UP_COOLDOWN", "30"))
+SUPERVISOR_SCALE_DOWN_COOLDOWN = float(os.getenv("SUPERVISOR_SCALE_DOWN_COOLDOWN", "300"))
+SUPERVISOR_MAX_MODEL_LATENCY = float(os.getenv("SUPERVISOR_MAX_MODEL_LATENCY", "30"))  # mean s/call: model server is the bottleneck
+SUPERVISOR_METRICS_PORT = int(os.getenv("SUPERVISOR_METRICS_PORT", "9099"))  # workers get WORKER_METRICS_PORT + slot
+
+# Multi-page PDFs (needs pypdfium2) and long receipts are split into parts extracted concurrently
+PDF_RENDER_DPI = int(os.getenv("PDF_RENDER_DPI", "150"))
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "20"))
+STRIP_MAX_ASPECT = float(os.getenv("STRIP_MAX_ASPECT", "3.0"))  # split images taller than this x their width
+STRIP_ASPECT = float(os.getenv("STRIP_ASPECT", "1.5"))  # strip height / width
+STRIP_OVERLAP = float(os.getenv("STRIP_OVERLAP", "0.12"))  # fraction of a strip repeated in the next one
+PART_CONCURRENCY = int(os.getenv("PART_CONCURRENCY", "8"))  # parts of one task extracted in parallel
@@ -0,0 +1,66 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+from app.config import FOLLOWUP_HISTORY_TOKENS, FOLLOWUP_MAX_SESSIONS, FOLLOWUP_SESSION_TTL
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough count (about 4 characters per token); only used to keep prompts inside a budget"""
+    return len(text) // 4 + 1
+
+
+class ConversationMemory:
+    """Follow-up Q&A history per conversation: LRU over sessions, idle TTL, and a token budget per session.
+
+    Fed by the API's result listener; each follow-up task carries the trimmed history, so any worker can answer it.
+    """
+    def __init__(self, max_sessions: int = FOLLOWUP_MAX_SESSIONS, ttl_seconds: int = FOLLOWUP_SESSION_TTL,
+                 token_budget: int = FOLLOWUP_HISTORY_TOKENS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.token_budget = token_budget
+        # conversation_id -> (last used, [(question, answer, tokens)])
+        self._sessions: "OrderedDict[str, Tuple[float, Deque[tuple]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def append(self, conversation_id: str, question: str, answer: str):
+        now = time.time()
+        tokens = estimate_tokens(question) + estimate_tokens(answer)
+        with self._lock:
+            _, turns = self._sessions.pop(conversation_id, (now, deque()))
+            turns.append((question, answer, tokens))
+            # Oldest turns go first; the newest one is kept even if it alone is over budget
+            while len(turns) > 1 and sum(turn[2] for turn in turns) > self.token_budget:
+                turns.popleft()
+            self._sessions[conversation_id] = (now, turns)
+            self._prune(now)
+
+    def history(self, conversation_id: str) -> List[Dict[str, str]]:
+        """Chat messages (oldest first) of the turns that fit the token budget"""
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(conversation_id)
+            if entry is None:
+                return []
+            if now - entry[0] > self.ttl_seconds:
+                del self._sessions[conversation_id]
+                return []
+            messages = []
+            for question, answer, _ in entry[1]:
+                messages += [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+            return messages
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions),
+                    "turns": sum(len(turns) for _, turns in self._sessions.values())}
+
+    def _prune(self, now: float):
+        # Caller holds self._lock; sessions are in last-used order
+        while self._sessions:
+            oldest_id, (used, _) = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - used <= self.ttl_seconds:
+                break
+            del self._sessions[oldest_id]
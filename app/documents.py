@@ -0,0 +1,116 @@
+import io
+import re
+from typing import List, NamedTuple
+
+from PIL import Image, ImageOps
+
+from app.config import PDF_MAX_PAGES, PDF_RENDER_DPI, STRIP_ASPECT, STRIP_MAX_ASPECT, STRIP_OVERLAP
+from app.models import Receipt, ReceiptItem
+
+# Header fields printed at the bottom of a receipt (or on the last page) win from later parts
+_FOOTER_FIELDS = {"subtotal", "tax", "total"}
+
+
+class Part(NamedTuple):
+    """One model-sized piece of an upload: a PDF page or an image, possibly cut into strips"""
+    data: bytes
+    page: int
+    strip: int
+
+
+def is_pdf(data) -> bool:
+    return bytes(data[:5]) == b"%PDF-"
+
+
+def _encode(image: Image.Image, fmt: str) -> bytes:
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        image.save(buffer, format="PNG", optimize=True)
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def render_pdf(data) -> List[Image.Image]:
+    try:
+        import pypdfium2 as pdfium
+    except ImportError as e:
+        raise ImportError("PDF uploads require pypdfium2 (pip install pypdfium2)") from e
+    pdf = pdfium.PdfDocument(bytes(data))
+    try:
+        if len(pdf) > PDF_MAX_PAGES:
+            raise ValueError(f"PDF has {len(pdf)} pages; at most {PDF_MAX_PAGES} are processed per task")
+        return [pdf[i].render(scale=PDF_RENDER_DPI / 72).to_pil() for i in range(len(pdf))]
+    finally:
+        pdf.close()
+
+
+def split_strips(image: Image.Image) -> List[Image.Image]:
+    """Cut a receipt taller than STRIP_MAX_ASPECT x its width into overlapping horizontal strips"""
+    width, height = image.size
+    if height <= width * STRIP_MAX_ASPECT:
+        return [image]
+    strip_height = int(width * STRIP_ASPECT)
+    step = max(1, int(strip_height * (1 - STRIP_OVERLAP)))
+    strips = []
+    top = 0
+    while True:
+        bottom = min(height, top + strip_height)
+        strips.append(image.crop((0, top, width, bottom)))
+        if bottom >= height:
+            return strips
+        top += step
+
+
+def split_document(data) -> List[Part]:
+    """PDF pages and/or tall-receipt strips; an ordinary image comes back untouched as a single part"""
+    if is_pdf(data):
+        pages, fmt = render_pdf(data), "JPEG"
+    else:
+        image = Image.open(io.BytesIO(data))  # reads the header only
+        width, height = image.size
+        if image.getexif().get(0x0112, 1) in (5, 6, 7, 8):  # EXIF orientation rotated by 90 degrees
+            width, height = height, width
+        if height <= width * STRIP_MAX_ASPECT:
+            return [Part(bytes(data), 0, 0)]
+        fmt = "PNG" if image.format == "PNG" else "JPEG"
+        pages = [ImageOps.exif_transpose(image)]
+
+    parts = []
+    for page_number, page in enumerate(pages):
+        for strip_number, strip in enumerate(split_strips(page)):
+            parts.append(Part(_encode(strip, fmt), page_number, strip_number))
+    return parts
+
+
+def _item_key(item: ReceiptItem) -> tuple:
+    name = re.sub(r"\W+", "", (item.item_name or "").lower())
+    return name, item.price
+
+
+def merge_receipts(parts: List[Part], receipts: List[Receipt], window: int = 6) -> Receipt:
+    """Concatenate per-part items in reading order. Where two strips of one page overlap, items at the end
+    of the upper strip that reappear (same name and price) at the start of the lower one are dropped once"""
+    merged = Receipt()
+    previous_tail: List[tuple] = []
+    for index, (part, receipt) in enumerate(zip(parts, receipts)):
+        items = list(receipt.items)
+        overlaps = index > 0 and parts[index - 1].page == part.page
+        if overlaps and previous_tail:
+            tail = list(previous_tail)
+            head, rest = items[:window], items[window:]
+            kept = []
+            for item in head:
+                key = _item_key(item)
+                if key in tail and key != ("", None):
+                    tail.remove(key)
+                else:
+                    kept.append(item)
+            items = kept + rest
+        merged.items += items
+        previous_tail = [_item_key(item) for item in receipt.items[-window:]]
+
+        for field, value in receipt.model_dump(exclude={"items", "needs_ocr"}, exclude_none=True).items():
+            if field in _FOOTER_FIELDS or getattr(merged, field, None) is None:
+                setattr(merged, field, value)
+    return merged
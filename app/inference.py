@@ -0,0 +1,194 @@
+import asyncio
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterator, Optional, Tuple
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from app.config import (
+    INFERENCE_BACKOFF_BASE,
+    INFERENCE_BACKOFF_MAX,
+    INFERENCE_CONNECT_TIMEOUT,
+    INFERENCE_MAX_CONCURRENCY,
+    INFERENCE_MAX_RETRIES,
+    INFERENCE_POOL_SIZE,
+)
+
+CHAT_COMPLETIONS_PATH = "/v1/chat/completions"
+RETRYABLE_STATUS = {500, 502, 503, 504}
+
+
+class InferenceError(Exception):
+    """Raised when the model server returns an error or cannot be reached after all retries"""
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def chat_completions_url(endpoint: str) -> str:
+    """Accept either a base URL (GEMMA_ENDPOINT style) or a full chat completions URL"""
+    endpoint = endpoint.rstrip("/")
+    if endpoint.endswith(CHAT_COMPLETIONS_PATH):
+        return endpoint
+    return endpoint + CHAT_COMPLETIONS_PATH
+
+
+def _backoff(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(INFERENCE_BACKOFF_MAX, INFERENCE_BACKOFF_BASE * (2 ** attempt)))
+
+
+class InferenceClient:
+    """Pooled keep-alive client for one OpenAI-compatible endpoint, shared by all threads of a process"""
+    def __init__(self, endpoint: str,
+                 max_retries: int = INFERENCE_MAX_RETRIES,
+                 max_concurrency: int = INFERENCE_MAX_CONCURRENCY,
+                 pool_size: int = INFERENCE_POOL_SIZE):
+        self.url = chat_completions_url(endpoint)
+        self.max_retries = max_retries
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def chat(self, payload: dict, timeout: Tuple[float, float]) -> dict:
+        """POST a chat completion request; timeout is (connect, read) seconds"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._semaphore:
+                    response = self.session.post(self.url, json=payload, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = InferenceError(f"{payload.get('model')} request failed: {type(e).__name__}: {e}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                error = InferenceError(
+                    f"{payload.get('model')} API error: {response.status_code} - {response.text[:500]}",
+                    status_code=response.status_code,
+                )
+                if response.status_code not in RETRYABLE_STATUS:
+                    raise error
+
+            if attempt < self.max_retries:
+                delay = _backoff(attempt)
+                logging.warning(f"{error} - retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+        raise error
+
+    def stream_chat(self, payload: dict, timeout: Tuple[float, float]) -> Iterator[str]:
+        """Stream a chat completion (SSE) and yield content deltas.
+
+        Retries only happen before the first token arrives; the read timeout applies between chunks.
+        """
+        payload = dict(payload, stream=True)
+        started = False
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self._semaphore:
+                    with self.session.post(self.url, json=payload, timeout=timeout, stream=True) as response:
+                        if response.status_code != 200:
+                            error = InferenceError(
+                                f"{payload.get('model')} API error: {response.status_code} - {response.text[:500]}",
+                                status_code=response.status_code,
+                            )
+                            if response.status_code not in RETRYABLE_STATUS:
+                                raise error
+                        else:
+                            for content in _iter_sse_content(response.iter_lines(decode_unicode=True)):
+                                started = True
+                                yield content
+                            return
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = InferenceError(f"{payload.get('model')} request failed: {type(e).__name__}: {e}")
+                if started:
+                    raise error  # tokens already handed out; a retry would duplicate them
+
+            if attempt < self.max_retries:
+                delay = _backoff(attempt)
+                logging.warning(f"{error} - retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                time.sleep(delay)
+        raise error
+
+    def close(self):
+        self.session.close()
+
+
+def _iter_sse_content(lines: Iterator[str]) -> Iterator[str]:
+    """Pull choices[0].delta.content out of an OpenAI-style event stream"""
+    for line in lines:
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return
+        chunk = json.loads(data)
+        choices = chunk.get("choices") or []
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+class AsyncInferenceClient:
+    """asyncio counterpart of InferenceClient, for use inside the FastAPI event loop"""
+    def __init__(self, endpoint: str,
+                 max_retries: int = INFERENCE_MAX_RETRIES,
+                 max_concurrency: int = INFERENCE_MAX_CONCURRENCY,
+                 pool_size: int = INFERENCE_POOL_SIZE):
+        self.url = chat_completions_url(endpoint)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def chat(self, payload: dict, timeout: Tuple[float, float]) -> dict:
+        connect_timeout, read_timeout = timeout
+        httpx_timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    response = await self.client.post(self.url, json=payload, timeout=httpx_timeout)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                error = InferenceError(f"{payload.get('model')} request failed: {type(e).__name__}: {e}")
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                error = InferenceError(
+                    f"{payload.get('model')} API error: {response.status_code} - {response.text[:500]}",
+                    status_code=response.status_code,
+                )
+                if response.status_code not in RETRYABLE_STATUS:
+                    raise error
+
+            if attempt < self.max_retries:
+                delay = _backoff(attempt)
+                logging.warning(f"{error} - retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(delay)
+        raise error
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+_clients: Dict[str, InferenceClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(endpoint: str) -> InferenceClient:
+    """One client (connection pool + concurrency semaphore) per endpoint URL per process"""
+    url = chat_completions_url(endpoint)
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = InferenceClient(url)
+        return _clients[url]
+
+
+def default_timeout(read_timeout: float) -> Tuple[float, float]:
+    return (INFERENCE_CONNECT_TIMEOUT, read_timeout)
@@ -0,0 +1,159 @@
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+
+class IncrementalJSONParser:
+    """Scan model output as it streams in and hand back each receipt item as soon as it closes.
+
+    Understands the shapes the model actually produces: a JSON array of items, an object holding
+    item arrays, or JSONL (one object per line) - with or without ``` fences around it. Text outside
+    JSON values (fences, "json" language tags, chatter) is ignored.
+    """
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._stack: List[str] = []   # open containers: '{' or '['
+        self._starts: List[int] = []  # text offset where each open container began
+        self._in_string = False
+        self._escape = False
+        self._top_level: List[tuple] = []  # (start, end) spans of complete top-level values
+        self._pending_top: Optional[Any] = None  # first top-level object, emitted once JSONL is detected
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Consume more text; returns items completed by it"""
+        self.text += chunk
+        items = []
+        text = self.text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                continue
+            if not self._stack:
+                if c in '{[':
+                    self._open(c, i)
+                continue
+            if c == '"':
+                self._in_string = True
+            elif c in '{[':
+                self._open(c, i)
+            elif c in '}]':
+                self._close(c, i, items)
+        self._pos = len(text)
+        return items
+
+    def _open(self, c: str, i: int):
+        self._stack.append(c)
+        self._starts.append(i)
+
+    def _close(self, c: str, i: int, items: list):
+        if not self._stack or (c == '}') != (self._stack[-1] == '{'):
+            return  # unbalanced model output; the final parse reports it
+        opener = self._stack.pop()
+        start = self._starts.pop()
+        if not self._stack:
+            self._top_level.append((start, i + 1))
+            if opener == '{':
+                value = self._load(start, i + 1)
+                if len(self._top_level) == 1:
+                    # Might be the whole document rather than an item - wait and see
+                    self._pending_top = value
+                else:
+                    # A second top-level object: this is JSONL, so the first one was an item after all
+                    if self._pending_top is not None:
+                        items.append(self._pending_top)
+                        self._pending_top = None
+                    if value is not None:
+                        items.append(value)
+        elif opener == '{' and self._stack[-1] == '[':
+            value = self._load(start, i + 1)
+            if value is not None:
+                items.append(value)
+
+    def _load(self, start: int, end: int) -> Any:
+        try:
+            return json.loads(self.text[start:end])
+        except json.JSONDecodeError:
+            return None
+
+    def result(self) -> Any:
+        """The consolidated document. Raises json.JSONDecodeError if nothing parseable was produced"""
+        values = []
+        for start, end in self._top_level:
+            values.append(json.loads(self.text[start:end]))
+        if not values:
+            # Surface a real decode error (with the raw text attached) for callers to report
+            return json.loads(self.text.strip().removeprefix("```json").removeprefix("```").removesuffix("```"))
+        if self._stack:
+            # A value left open after complete ones (a JSONL answer cut off mid-item): malformed, so the
+            # caller repairs or re-asks instead of silently losing the tail
+            raise json.JSONDecodeError("Unterminated JSON value", self.text, self._starts[0])
+        return values[0] if len(values) == 1 else values
+
+
+def parse_model_json(text: str) -> Any:
+    """One-shot parse of a complete model response (fences, JSON or JSONL)"""
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.result()
+
+
+def _clean(text: str) -> Tuple[str, List[Tuple[int, str]]]:
+    """Drop code fences and trailing commas (outside strings). Also returns the cut points: offsets just
+    after each closed container, with the brackets that would close everything still open there"""
+    text = re.sub(r"```(?:json|jsonl)?", "", text)
+    out: List[str] = []
+    cuts: List[Tuple[int, str]] = []
+    stack: List[str] = []
+    in_string = escape = False
+    for i, c in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string = False
+            out.append(c)
+            continue
+        if c == '"':
+            in_string = True
+        elif c == ',':
+            following = text[i + 1:].lstrip()
+            if not following or following[0] in '}]':
+                continue  # trailing comma
+        elif c in '{[':
+            stack.append(c)
+        elif c in '}]' and stack:
+            stack.pop()
+            out.append(c)
+            cuts.append((len(out), "".join('}' if o == '{' else ']' for o in reversed(stack))))
+            continue
+        out.append(c)
+    return "".join(out), cuts
+
+
+def repair_json(text: str, max_cuts: int = 50) -> Tuple[Any, str]:
+    """Tolerant parse of malformed model output: code fences, trailing commas, JSONL vs array, truncation.
+
+    Returns (value, dropped) where dropped is the tail that had to be cut off to get valid JSON
+    ("" if nothing was lost). Raises json.JSONDecodeError if nothing can be salvaged.
+    """
+    cleaned, cuts = _clean(text)
+    try:
+        return parse_model_json(cleaned), ""
+    except json.JSONDecodeError as e:
+        error = e
+    # Truncated or broken at the end: back off to the last complete element and close what is open
+    for end, closers in reversed(cuts[-max_cuts:]):
+        try:
+            return parse_model_json(cleaned[:end] + closers), cleaned[end:]
+        except json.JSONDecodeError:
+            continue
+    raise error
@@ -0,0 +1,394 @@
+"""Load generator and latency report for the receipt pipeline.
+
+    # Open loop: 5 receipts/s for 60s through the API, results correlated from image_responses/image_errors
+    python -m app.loadgen --images samples/ --rate 5 --duration 60 --api http://localhost:8000
+    # Closed loop: 8 clients back to back, straight onto image_requests (no API)
+    python -m app.loadgen --images samples/ --concurrency 8 --requests 200 --mode queue
+
+Latencies are measured from the *intended* send time, so a stalled system is charged for the requests
+it delayed (coordinated omission). With `--results queue` (the default) results are read from a private
+queue bound to the image_results exchange, next to the API's own consumers rather than competing with them.
+"""
+import argparse
+import csv
+import glob
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+
+from app.models import ImageRequestPrompt
+from app.mqreceiver_test import RabbitMQReceiver
+from app.rabbitmq import RabbitMQClient
+from app.wire import encode_task
+
+
+class Sample:
+    __slots__ = ("conversation_id", "intended", "sent", "accepted", "done", "outcome")
+
+    def __init__(self, intended: float):
+        self.conversation_id: Optional[str] = None
+        self.intended = intended
+        self.sent: Optional[float] = None
+        self.accepted: Optional[float] = None
+        self.done: Optional[float] = None
+        self.outcome: Optional[str] = None
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return math.nan
+    return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+
+def error_kind(error: Optional[str]) -> str:
+    """"Processing failed: InferenceError: ..." -> "InferenceError"; other messages up to the first colon"""
+    parts = [p.strip() for p in str(error or "error").split(":")]
+    return parts[1] if parts[0] == "Processing failed" and len(parts) > 1 else parts[0][:60]
+
+
+def corrected_latencies(latencies: List[float], expected_interval: float) -> List[float]:
+    """HdrHistogram-style correction for closed-loop runs: a response that took N expected intervals
+    stands in for the N-1 requests a steady client would have issued meanwhile"""
+    if expected_interval <= 0:
+        return list(latencies)
+    corrected = []
+    for latency in latencies:
+        corrected.append(latency)
+        missing = latency - expected_interval
+        while missing >= expected_interval:
+            corrected.append(missing)
+            missing -= expected_interval
+    return corrected
+
+
+def histogram(latencies: List[float], width: int = 50) -> List[str]:
+    """Log-scale text histogram, buckets doubling from 50ms"""
+    if not latencies:
+        return []
+    bounds = [0.05 * 2 ** i for i in range(12)]
+    counts = Counter(next((b for b in bounds if latency <= b), math.inf) for latency in latencies)
+    peak = max(counts.values())
+    lines = []
+    for bound in bounds + [math.inf]:
+        if not counts.get(bound):
+            continue
+        label = f"<= {bound:7.2f}s" if bound != math.inf else f" > {bounds[-1]:7.2f}s"
+        lines.append(f"  {label} {counts[bound]:6d} {'#' * max(1, counts[bound] * width // peak)}")
+    return lines
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.images = self._load_images(args.images)
+        self.samples: List[Sample] = []
+        self.pending: Dict[str, Sample] = {}
+        self.early: Dict[str, tuple] = {}  # results that beat the POST response back: id -> (time, outcome)
+        self.lock = threading.Lock()
+        self.completed = threading.Condition(self.lock)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(args.concurrency, args.max_outstanding))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.receivers: List[RabbitMQReceiver] = []
+        self.publisher: Optional[RabbitMQClient] = None
+        self.publish_lock = threading.Lock()
+
+    @staticmethod
+    def _load_images(pattern: str) -> List[tuple]:
+        paths = sorted(glob.glob(os.path.join(pattern, "*")) if os.path.isdir(pattern) else glob.glob(pattern))
+        paths = [p for p in paths if p.lower().endswith((".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"))]
+        if not paths:
+            raise SystemExit(f"No images found at {pattern}")
+        images = []
+        for path in paths:
+            with open(path, "rb") as f:
+                images.append((os.path.basename(path), f.read()))
+        return images
+
+    # -- results ----------------------------------------------------------------------------------
+
+    def _start_receivers(self):
+        for queue, outcome in (("image_responses", "ok"), ("image_errors", None)):
+            receiver = RabbitMQReceiver(queue_name=queue)
+            callback = (lambda message, outcome=outcome: self._on_result(message, outcome))
+            threading.Thread(target=receiver.start_consuming, args=(callback, self.args.rabbitmq_host),
+                             name=f"loadgen-{queue}", daemon=True).start()
+            self.receivers.append(receiver)
+
+    def _on_result(self, message: dict, outcome: Optional[str]):
+        if not isinstance(message, dict):
+            return
+        self._finish(message.get("conversation_id"), outcome or error_kind(message.get("error")))
+
+    def _finish(self, conversation_id: Optional[str], outcome: str, sample: Optional[Sample] = None):
+        with self.completed:
+            sample = sample or self.pending.pop(conversation_id, None)
+            if sample is None:
+                if conversation_id and len(self.early) < 10000:
+                    self.early[conversation_id] = (time.monotonic(), outcome)
+                return
+            if sample.done is not None:
+                return  # already settled (e.g. timed out)
+            self.pending.pop(sample.conversation_id, None)
+            sample.done = time.monotonic()
+            sample.outcome = outcome
+            self.completed.notify_all()
+
+    def _register(self, sample: Sample):
+        with self.completed:
+            if sample.done is not None:
+                return
+            early = self.early.pop(sample.conversation_id, None)
+            if early is None:
+                self.pending[sample.conversation_id] = sample
+            else:
+                sample.done, sample.outcome = early
+
+    def _poll_result(self, sample: Sample):
+        deadline = sample.sent + self.args.timeout
+        while time.monotonic() < deadline:
+            try:
+                response = self.session.get(f"{self.args.api}/result/{sample.conversation_id}",
+                                            params={"wait": min(30, max(1, int(deadline - time.monotonic())))},
+                                            timeout=(5, 40))
+            except requests.RequestException as e:
+                self._finish(None, f"poll {type(e).__name__}", sample)
+                return
+            if response.status_code == 200:
+                record = response.json()
+                failed = record.get("status") == "failed"
+                self._finish(None, error_kind(record.get("error")) if failed else "ok", sample)
+                return
+            if response.status_code != 202:
+                self._finish(None, f"poll HTTP {response.status_code}", sample)
+                return
+
+    # -- submission -------------------------------------------------------------------------------
+
+    def _submit(self, sample: Sample, image: tuple):
+        filename, data = image
+        sample.sent = time.monotonic()
+        try:
+            if self.args.mode == "http":
+                response = self.session.post(f"{self.args.api}/process-image",
+                                             files={"file": (filename, data)},
+                                             params={"include_items": self.args.include_items},
+                                             timeout=(5, 60))
+                if response.status_code != 200:
+                    self._finish(None, f"HTTP {response.status_code}", sample)
+                    return
+                sample.conversation_id = response.json()["conversation_id"]
+            else:
+                sample.conversation_id = str(uuid.uuid4())
+                task = ImageRequestPrompt(conversation_id=sample.conversation_id,
+                                          include_items=self.args.include_items)
+                body, headers, content_type = encode_task(task, data)
+                headers["x-enqueued-at"] = int(time.time() * 1000)
+                with self.publish_lock:
+                    if not self.publisher.publish("image_requests", body, headers=headers, content_type=content_type):
+                        self._finish(None, "publish failed", sample)
+                        return
+        except Exception as e:
+            self._finish(None, f"submit {type(e).__name__}", sample)
+            return
+        sample.accepted = time.monotonic()
+        if self.args.results == "http":
+            self._poll_result(sample)
+            return
+        self._register(sample)
+
+    def _wait_done(self, sample: Sample):
+        with self.completed:
+            deadline = (sample.sent or time.monotonic()) + self.args.timeout
+            while sample.done is None and time.monotonic() < deadline:
+                self.completed.wait(deadline - time.monotonic())
+        if sample.done is None:
+            self._finish(None, "timeout", sample)
+
+    def _open_loop(self, pool: ThreadPoolExecutor, images, start: float):
+        """Requests go out on schedule whether or not earlier ones have returned"""
+        interval = 1.0 / self.args.rate
+        outstanding = threading.BoundedSemaphore(self.args.max_outstanding)
+        for i in itertools.count():
+            intended = start + i * interval
+            if self._finished_sending(i, intended, start):
+                break
+            time.sleep(max(0.0, intended - time.monotonic()))
+            sample = Sample(intended)
+            self.samples.append(sample)
+            if not outstanding.acquire(blocking=False):
+                # Client-side saturation: count it rather than silently slowing the schedule down
+                self._finish(None, "client saturated", sample)
+                continue
+            pool.submit(self._run_one, sample, next(images), outstanding)
+
+    def _run_one(self, sample: Sample, image: tuple, outstanding=None):
+        try:
+            self._submit(sample, image)
+            if sample.done is None:
+                self._wait_done(sample)
+        finally:
+            if outstanding is not None:
+                outstanding.release()
+
+    def _closed_loop(self, images, start: float):
+        counter = itertools.count()
+
+        def client():
+            while True:
+                i = next(counter)
+                intended = time.monotonic()
+                if self._finished_sending(i, intended, start):
+                    return
+                sample = Sample(intended)
+                with self.lock:
+                    self.samples.append(sample)
+                self._run_one(sample, next(images))
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _finished_sending(self, i: int, now: float, start: float) -> bool:
+        if self.args.requests and i >= self.args.requests:
+            return True
+        return bool(self.args.duration) and now - start >= self.args.duration
+
+    def run(self):
+        if self.args.results == "queue":
+            self._start_receivers()
+        if self.args.mode == "queue":
+            self.publisher = RabbitMQClient()
+            if not self.publisher.connect(self.args.rabbitmq_host):
+                raise SystemExit("Cannot connect to RabbitMQ")
+        time.sleep(1 if self.receivers else 0)  # let the consumers attach before the first response can arrive
+
+        images = itertools.cycle(self.images)
+        start = time.monotonic()
+        try:
+            if self.args.rate:
+                with ThreadPoolExecutor(max_workers=self.args.max_outstanding) as pool:
+                    self._open_loop(pool, images, start)
+            else:
+                self._closed_loop(images, start)
+        except KeyboardInterrupt:
+            logging.warning("Interrupted - reporting what completed so far")
+        finally:
+            for receiver in self.receivers:
+                receiver.stop()
+            if self.publisher:
+                self.publisher.close()
+        return start
+
+    # -- reporting --------------------------------------------------------------------------------
+
+    def report(self, start: float):
+        samples = [s for s in self.samples if s.done is not None]
+        ok = [s for s in samples if s.outcome == "ok"]
+        elapsed = max((s.done for s in samples), default=start) - start
+        outcomes = Counter(s.outcome for s in samples)
+
+        # Open loop: measure from the scheduled send; closed loop: from the actual send plus synthetic samples
+        uncorrected = sorted(s.done - s.sent for s in ok)
+        if self.args.rate:
+            corrected = sorted(s.done - s.intended for s in ok)
+            expected = 1.0 / self.args.rate
+        else:
+            expected = self.args.expected_interval or (percentile(uncorrected, 0.5) if uncorrected else 0)
+            corrected = sorted(corrected_latencies(uncorrected, expected))
+
+        print(f"\n{len(samples)} requests in {elapsed:.1f}s, {len(ok)} ok "
+              f"({len(ok) / elapsed if elapsed else 0:.2f}/s)")
+        print("\noutcomes")
+        for outcome, count in outcomes.most_common():
+            print(f"  {outcome:<40} {count:6d}")
+        print(f"\nlatency (s)            {'uncorrected':>12} {'corrected':>12}")
+        for q in (0.5, 0.9, 0.95, 0.99, 0.999, 1.0):
+            name = "max" if q == 1.0 else f"p{q * 100:g}"
+            print(f"  {name:<20} {percentile(uncorrected, q):12.3f} {percentile(corrected, q):12.3f}")
+        if not self.args.rate:
+            print(f"  (closed loop, expected interval {expected:.3f}s)")
+        print("\nhistogram (corrected)")
+        for line in histogram(corrected):
+            print(line)
+
+        if self.args.csv:
+            self._write_csv(samples, start)
+            print(f"\nTime series written to {self.args.csv}")
+
+        return {"requests": len(samples), "outcomes": dict(outcomes),
+                "uncorrected": uncorrected, "corrected": corrected}
+
+    def _write_csv(self, samples: List[Sample], start: float):
+        """One row per second of the run: sent, completed, errors, in flight and latency percentiles"""
+        buckets = defaultdict(list)
+        sent = Counter(int(s.intended - start) for s in self.samples)
+        for sample in samples:
+            buckets[int(sample.done - start)].append(sample)
+        last = max(list(buckets) + list(sent) + [0])
+        with open(self.args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["second", "sent", "completed", "errors", "inflight", "p50", "p95", "p99", "max"])
+            for second in range(last + 1):
+                done = buckets.get(second, [])
+                latencies = sorted(s.done - s.intended for s in done if s.outcome == "ok")
+                t = start + second + 1
+                inflight = sum(1 for s in self.samples if s.intended < t and (s.done is None or s.done >= t))
+                writer.writerow([second, sent.get(second, 0), len(latencies), len(done) - len(latencies), inflight]
+                                + [round(percentile(latencies, q), 4) if latencies else "" for q in (0.5, 0.95, 0.99, 1.0)])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory or glob of receipt images, sent round-robin")
+    load = parser.add_mutually_exclusive_group(required=True)
+    load.add_argument("--rate", type=float, help="open loop: requests per second")
+    load.add_argument("--concurrency", type=int, help="closed loop: clients sending back to back")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, default=0, help="stop sending after this many seconds")
+    parser.add_argument("--mode", choices=("http", "queue"), default="http",
+                        help="submit through POST /process-image or publish straight to image_requests")
+    parser.add_argument("--results", choices=("queue", "http"), default="queue",
+                        help="correlate from image_responses/image_errors, or long-poll GET /result")
+    parser.add_argument("--api", default="http://localhost:8000")
+    parser.add_argument("--rabbitmq-host", default="localhost")
+    parser.add_argument("--include-items", default="price, item_name, company")
+    parser.add_argument("--timeout", type=float, default=300, help="give up on a request after this many seconds")
+    parser.add_argument("--max-outstanding", type=int, default=256, help="open loop: client-side cap on requests in flight")
+    parser.add_argument("--expected-interval", type=float, default=0,
+                        help="closed loop: interval for coordinated-omission correction (default: median latency)")
+    parser.add_argument("--csv", help="write a per-second time series here")
+    parser.add_argument("--json", help="write the summary and raw latencies here")
+    args = parser.parse_args(argv)
+    if not args.requests and not args.duration:
+        parser.error("give --requests and/or --duration")
+    args.concurrency = args.concurrency or 0
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    generator = LoadGenerator(args)
+    start = generator.run()
+    summary = generator.report(start)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Find the receipt in a phone photo and cut it out before the model calls.
+
+Works on a LOCALIZE_WORK_SIDE grayscale copy: Otsu-threshold the bright, unsaturated paper, take its oriented
+box from the mask's second moments, pull the four corners onto the paper (perspective), and score the result
+against the mask and the edge map. The decoded image is then warped with one perspective transform, which
+crops, deskews and straightens in a single resample (upright receipts are just cropped), and its contrast is
+stretched. Below LOCALIZE_MIN_CONFIDENCE the full frame is kept as it is.
+"""
+import math
+import time
+from typing import NamedTuple, Optional
+
+import numpy as np
+from PIL import Image
+
+from app.config import (
+    LOCALIZE_MARGIN, LOCALIZE_MAX_CROP_RATIO, LOCALIZE_MAX_SATURATION, LOCALIZE_MIN_CONFIDENCE, LOCALIZE_WORK_SIDE,
+)
+
+# (u, v) signs of the top-left, top-right, bottom-right and bottom-left corners in the receipt's own frame
+_CORNERS = np.array([(-1, -1), (1, -1), (1, 1), (-1, 1)], dtype=np.float32)
+
+
+class Localization(NamedTuple):
+    image: Image.Image
+    outcome: str  # cropped, full_frame (receipt already fills it) or low_confidence
+    crop_ratio: float  # output pixels / input pixels
+    confidence: float
+    angle: float  # skew that was removed, degrees
+    elapsed_ms: float
+
+
+def otsu_threshold(gray: np.ndarray) -> int:
+    """Threshold maximising the between-class variance of a uint8 image"""
+    p = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    p /= p.sum()
+    omega = np.cumsum(p)
+    mu = np.cumsum(p * np.arange(256))
+    between = (mu[-1] * omega - mu) ** 2 / (omega * (1 - omega) + 1e-12)
+    return int(np.argmax(between))
+
+
+def box_mean(a: np.ndarray, k: int) -> np.ndarray:
+    """k x k moving average (odd k, edges replicated) from a summed-area table"""
+    r = k // 2
+    c = np.pad(np.pad(a.astype(np.float32), r, mode="edge").cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    return (c[k:, k:] - c[:-k, k:] - c[k:, :-k] + c[:-k, :-k]) / (k * k)
+
+
+def _running_max(a: np.ndarray, k: int) -> np.ndarray:
+    """Moving maximum of width k (odd) down axis 0, edges replicated, in log2(k) passes"""
+    r, n = k // 2, a.shape[0]
+    out = np.pad(a, ((r, r), (0, 0)), mode="edge")
+    width = 1
+    while width * 2 <= k:
+        np.maximum(out[:-width], out[width:], out=out[:-width])  # out[i] = max(a[i:i + 2 * width])
+        width *= 2
+    # A window of k is covered by two overlapping windows of `width`
+    return np.maximum(out[:n], out[k - width:k - width + n])
+
+
+def box_max(a: np.ndarray, k: int) -> np.ndarray:
+    """k x k moving maximum (odd k), separable"""
+    return _running_max(_running_max(a, k).T, k).T
+
+
+def perspective_coefficients(size: tuple, quad: np.ndarray) -> tuple:
+    """PIL PERSPECTIVE data mapping an output rectangle of `size` onto `quad` (TL, TR, BR, BL) in the input"""
+    w, h = size
+    rows, rhs = [], []
+    for (x, y), (u, v) in zip([(0, 0), (w, 0), (w, h), (0, h)], quad.tolist()):
+        rows.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        rows.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+        rhs += [u, v]
+    return tuple(np.linalg.solve(np.array(rows, dtype=np.float64), np.array(rhs, dtype=np.float64)))
+
+
+def normalise_contrast(image: Image.Image, low: float = 1, high: float = 99) -> Image.Image:
+    """Stretch the luminance percentiles to 0..255 with one lookup table for all bands (keeps colours)"""
+    sample = image.reduce(max(1, max(image.size) // 256)).convert("L")
+    lo, hi = np.percentile(np.asarray(sample), (low, high))
+    if hi - lo < 16 or (lo <= 2 and hi >= 253):
+        return image
+    lut = np.clip((np.arange(256) - lo) * (255.0 / (hi - lo)), 0, 255).astype(np.uint8).tolist()
+    return image.point(lut * len(image.getbands()))
+
+
+class ReceiptLocalizer:
+    def __init__(self, work_side: int = LOCALIZE_WORK_SIDE, min_confidence: float = LOCALIZE_MIN_CONFIDENCE,
+                 max_crop_ratio: float = LOCALIZE_MAX_CROP_RATIO, margin: float = LOCALIZE_MARGIN,
+                 max_saturation: int = LOCALIZE_MAX_SATURATION):
+        self.work_side = work_side
+        self.min_confidence = min_confidence
+        self.max_crop_ratio = max_crop_ratio
+        self.margin = margin
+        self.max_saturation = max_saturation
+
+    def signature(self) -> str:
+        return (f"localize={self.work_side},{self.min_confidence},{self.max_crop_ratio},"
+                f"{self.margin},{self.max_saturation}")
+
+    def detect(self, image: Image.Image) -> tuple[Optional[np.ndarray], float, float]:
+        """(quad in image pixels or None, confidence, skew in degrees)"""
+        scale = max(1, -(-max(image.size) // self.work_side))
+        if scale >= 4:
+            # Sample every (scale/2)th pixel, then box-average 2 x 2: a tenth of the cost of reduce(scale) on a
+            # full photo, and the paper mask is smoothed below anyway
+            sampled = image.resize((image.size[0] * 2 // scale, image.size[1] * 2 // scale), Image.Resampling.NEAREST)
+            small = sampled.reduce(2)
+        else:
+            small = image.reduce(scale)
+        fx, fy = image.size[0] / small.size[0], image.size[1] / small.size[1]  # small -> image pixels
+        gray = np.asarray(small.convert("L"))
+        paper = gray > otsu_threshold(gray)
+        if small.mode == "RGB":
+            r, g, b = (np.asarray(band, dtype=np.int16) for band in small.split())
+            paper &= np.maximum(np.maximum(r, g), b) - np.minimum(np.minimum(r, g), b) < self.max_saturation
+        # Close the holes the printed text leaves in the paper and drop specks
+        k = max(3, (min(gray.shape) // 50) | 1)
+        paper = box_mean(paper, k) > 0.5
+        ys, xs = np.nonzero(paper)
+        if len(xs) < 0.02 * paper.size:
+            return None, 0.0, 0.0
+
+        # Oriented box from second moments; the long side of a receipt is its vertical
+        cx, cy = xs.mean(), ys.mean()
+        dx, dy = xs - cx, ys - cy
+        evals, evecs = np.linalg.eigh(np.cov(np.stack([dx, dy])))
+        major = evecs[:, 1]
+        skew = math.degrees(math.atan2(major[0], major[1]))  # angle of the long axis from vertical
+        skew = (skew + 90) % 180 - 90
+        if abs(skew) > 45:
+            skew -= math.copysign(90, skew)
+        if evals[1] < 1.2 * evals[0]:
+            skew = 0.0  # nearly square: the axis is noise
+        theta = math.radians(skew)
+        cos, sin = math.cos(theta), math.sin(theta)
+        u = dx * cos - dy * sin
+        v = dx * sin + dy * cos
+        u_lo, u_hi = np.percentile(u, (1, 99))
+        v_lo, v_hi = np.percentile(v, (1, 99))
+        inside = (u >= u_lo) & (u <= u_hi) & (v >= v_lo) & (v <= v_hi)
+        box_area = max(1.0, (u_hi - u_lo) * (v_hi - v_lo))
+        fill = min(1.0, inside.sum() / box_area)
+        concentration = inside.mean()
+
+        # Corners: the paper pixels furthest out towards each box corner. The percentile box trims the
+        # outermost 1%, so search a slightly larger one
+        uc, vc = (u_lo + u_hi) / 2, (v_lo + v_hi) / 2
+        un, vn = (u - uc) / max(1.0, (u_hi - u_lo) / 2), (v - vc) / max(1.0, (v_hi - v_lo) / 2)
+        near = (np.abs(un) <= 1.1) & (np.abs(vn) <= 1.1)
+        un, vn, px, py = un[near], vn[near], xs[near], ys[near]
+        top = max(3, len(px) // 20000)
+        quad = np.empty((4, 2), dtype=np.float64)
+        for i, (su, sv) in enumerate(_CORNERS):
+            best = np.argpartition(-(su * un + sv * vn), top)[:top]
+            quad[i] = px[best].mean(), py[best].mean()
+
+        # Edge support: the quad's sides should run along intensity steps (within k pixels), or along the frame border
+        gradient = box_max(np.hypot(*np.gradient(gray.astype(np.float32))), k)
+        step = float(gray[paper].mean()) - float(gray[~paper].mean()) if (~paper).any() else 0.0
+        t = np.linspace(0, 1, 64, endpoint=False)[:, None]
+        samples = np.concatenate([quad[i] + t * (quad[(i + 1) % 4] - quad[i]) for i in range(4)])
+        sx = np.clip(np.rint(samples[:, 0]).astype(int), 0, gray.shape[1] - 1)
+        sy = np.clip(np.rint(samples[:, 1]).astype(int), 0, gray.shape[0] - 1)
+        on_border = (sx <= 2) | (sy <= 2) | (sx >= gray.shape[1] - 3) | (sy >= gray.shape[0] - 3)
+        edge_support = float(((gradient[sy, sx] > max(4.0, step / 4)) | on_border).mean())
+
+        confidence = float(min(fill, concentration, edge_support))
+        centre = quad.mean(axis=0)
+        quad = centre + (quad - centre) * (1 + self.margin)
+        quad[:, 0] = np.clip(quad[:, 0], 0, small.size[0])
+        quad[:, 1] = np.clip(quad[:, 1], 0, small.size[1])
+        return np.minimum(quad * (fx, fy), image.size), confidence, skew
+
+    def run(self, image: Image.Image, max_side: int = None) -> Localization:
+        """The receipt cut out of `image`, at most max_side pixels on its longer side when cropped"""
+        started = time.perf_counter()
+        quad, confidence, skew = self.detect(image)
+
+        def done(result: Image.Image, outcome: str, ratio: float, angle: float) -> Localization:
+            # A full frame is mostly background, which would set the stretch, so only crops are normalised
+            result = normalise_contrast(result) if outcome == "cropped" else result
+            return Localization(result, outcome, round(ratio, 3), round(confidence, 3),
+                                round(angle, 1), round((time.perf_counter() - started) * 1000, 1))
+
+        if quad is None or confidence < self.min_confidence:
+            return done(image, "low_confidence", 1.0, 0.0)
+        width = int(round((np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])) / 2))
+        height = int(round((np.linalg.norm(quad[3] - quad[0]) + np.linalg.norm(quad[2] - quad[1])) / 2))
+        ratio = (width * height) / (image.size[0] * image.size[1])
+        if ratio > self.max_crop_ratio and abs(skew) < 1:
+            return done(image, "full_frame", 1.0, 0.0)  # nothing worth a resample
+
+        # Resample once, at output size. Bilinear sampling aliases when it shrinks, so a receipt more than twice
+        # the output size is first box-reduced by the whole factor it can spare (only its bounding box)
+        shrink = min(1.0, max_side / max(width, height)) if max_side else 1.0
+        factor = max(1, int(1 / shrink))
+        left, top = np.floor(quad.min(axis=0)).astype(int)
+        right, bottom = np.ceil(quad.max(axis=0)).astype(int)
+        source = image
+        if factor > 1:
+            source, quad = image.crop((left, top, right, bottom)).reduce(factor), (quad - (left, top)) / factor
+            left, top, right, bottom = 0, 0, source.size[0], source.size[1]
+        if np.abs(quad - [(left, top), (right, top), (right, bottom), (left, bottom)]).max() <= 0.01 * (bottom - top):
+            # upright: the crop is the answer
+            return done(source.crop((left, top, right, bottom)), "cropped", ratio, skew)
+        size = (max(1, round(width * shrink)), max(1, round(height * shrink)))
+        coefficients = perspective_coefficients(size, quad)
+        if abs(coefficients[6] * size[0]) + abs(coefficients[7] * size[1]) < 1e-3:
+            # A parallelogram (no perspective): PIL's affine path is faster
+            warped = source.transform(size, Image.Transform.AFFINE, coefficients[:6], Image.Resampling.BILINEAR)
+        else:
+            warped = source.transform(size, Image.Transform.PERSPECTIVE, coefficients, Image.Resampling.BILINEAR)
+        return done(warped, "cropped", ratio, skew)
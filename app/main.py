@@ -1,31 +1,99 @@
-import base64
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from app.rabbitmq import RabbitMQClient
+from app.async_rabbitmq import AsyncRabbitMQPublisher
 import threading
 import uvicorn
 import logging
+import math
 import os
-from typing import AsyncIterator
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
+import zipfile
 from fastapi import BackgroundTasks, UploadFile, File
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+import time
 import uuid
 import json
-from app.models import ImageRequest, ImageRequestPrompt
+from app.models import FollowUpQuestion, FollowUpRequest, ImageRequest, ImageRequestPrompt
+from app.conversation import ConversationMemory
+from app.admission import AdmissionController, RateLimiter
+from app.wire import encode_task
+from app.blobstore import create_blob_store
+from app.config import BLOB_CHUNK_SIZE, BLOB_GC_INTERVAL, RESULT_MAX_WAIT, BATCH_MAX_FILES, BATCH_MAX_FILE_BYTES
+from app.results import ResultStore, ResultConsumer
+from app.receipts import ITEM_COLUMNS, RECEIPT_COLUMNS, ReceiptStore, jsonl_chunks, parquet_chunks
+from app.metrics import ADMISSIONS, HTTP_LATENCY, INFLIGHT, TASKS_ENQUEUED, lane_of, register_stats
+from app.profiler import profiler
+from app.config import DEBUG_ENDPOINTS, TASK_MAX_PRIORITY, INTERACTIVE_PRIORITY, BULK_PRIORITY
+from app.config import ADMISSION_ENABLED, RATE_LIMIT_API_KEYS, RATE_LIMIT_KEY_HEADER
+from app.config import RECEIPT_PAGE_MAX, RECEIPT_STORE_ENABLED
+from datetime import date
+from starlette.concurrency import run_in_threadpool
+import asyncio
+
+
+async def _blob_gc_loop(blob_store):
+    """Backstop for blobs whose task never completed (TTL based)"""
+    while True:
+        await asyncio.sleep(BLOB_GC_INTERVAL)
+        try:
+            await run_in_threadpool(blob_store.gc)
+        except Exception as e:
+            logging.error(f"Blob GC failed: {e}")
+
+
+def _remember_answer(memory: ConversationMemory):
+    def _listener(key: str, record: dict):
+        if record.get("answer") is not None and record.get("question"):
+            memory.append(record["conversation_id"], record["question"], record["answer"])
+    return _listener
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
     """Lifespan handler for startup and shutdown events"""
     # Startup logic
-    app.state.rabbitmq_client = RabbitMQClient()
-    app.state.rabbitmq_client.connect(host=os.getenv("RABBITMQ_HOST", "rabbitmq"))
+    app.state.publisher = AsyncRabbitMQPublisher(host=os.getenv("RABBITMQ_HOST", "rabbitmq"))
+    app.state.publisher.start()
+    app.state.blob_store = create_blob_store()
+    gc_task = asyncio.create_task(_blob_gc_loop(app.state.blob_store)) if app.state.blob_store else None
+    # Uploads are refused with 429 while image_requests is too far behind or a client exceeds its rate
+    app.state.rate_limiter = RateLimiter()
+    app.state.admission = AdmissionController(app.state.publisher) if ADMISSION_ENABLED else None
+    admission_task = asyncio.create_task(app.state.admission.run()) if app.state.admission else None
+    register_stats("receipt_rate_limiter", app.state.rate_limiter.stats)
+    if app.state.admission:
+        register_stats("receipt_admission", app.state.admission.stats)
+
+    # Drain image_responses / image_errors into the index behind /result/{conversation_id}
+    app.state.result_store = ResultStore()
+    app.state.result_store.bind_loop(asyncio.get_running_loop())
+    app.state.result_consumer = ResultConsumer(app.state.result_store, host=os.getenv("RABBITMQ_HOST", "rabbitmq"))
+    app.state.result_consumer.start()
+    register_stats("receipt_results", app.state.result_store.stats)
+    # Follow-up answers arrive through the result consumer and are remembered per conversation
+    app.state.memory = ConversationMemory()
+    app.state.result_store.add_listener(_remember_answer(app.state.memory))
+    register_stats("receipt_followup", app.state.memory.stats)
+    # Every completed extraction is also kept in the receipt store behind GET /receipts
+    app.state.receipt_store = ReceiptStore() if RECEIPT_STORE_ENABLED else None
+    if app.state.receipt_store:
+        app.state.receipt_store.start()
+        app.state.result_store.add_listener(app.state.receipt_store.listener)
+        register_stats("receipt_store", app.state.receipt_store.stats)
     
     yield  # Application runs here
     # Shutdown logic
-    if hasattr(app.state, "rabbitmq_client"):
-        app.state.rabbitmq_client.close()
+    if gc_task:
+        gc_task.cancel()
+    if admission_task:
+        admission_task.cancel()
+    await run_in_threadpool(app.state.result_consumer.stop)
+    if app.state.receipt_store:
+        await run_in_threadpool(app.state.receipt_store.stop)
+    if hasattr(app.state, "publisher"):
+        await app.state.publisher.close()
     logging.info("RabbitMQ connection closed")
 
 app = FastAPI(lifespan=lifespan)
@@ -38,25 +106,145 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    started = time.perf_counter()
+    INFLIGHT.labels('api').inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        INFLIGHT.labels('api').dec()
+        # Label by route template, not raw path, to keep cardinality bounded
+        route = request.scope.get("route")
+        HTTP_LATENCY.labels(request.method, getattr(route, "path", "unmatched"), str(status)).observe(
+            time.perf_counter() - started)
+
+
+def _task_headers() -> dict:
+    """Stamped on every task so workers can measure time spent in the queue"""
+    return {'x-version': '1.0', 'x-enqueued-at': int(time.time() * 1000)}
+
+
+def _task_message(task: ImageRequestPrompt, image: Optional[bytes]) -> tuple:
+    """(body, publish options) of an image task in the configured wire format (WIRE_FORMAT)"""
+    body, headers, content_type = encode_task(task, image)
+    return body, {"headers": _task_headers() | headers, "content_type": content_type}
+
+
+def _task_options(priority: Optional[int], deadline: Optional[float], default_priority: int) -> tuple:
+    """Clamp priority to the queue's range; turn a relative deadline (seconds from now) into epoch seconds"""
+    if deadline is not None and deadline <= 0:
+        raise HTTPException(status_code=400, detail="deadline must be a positive number of seconds")
+    priority = default_priority if priority is None else max(0, min(priority, TASK_MAX_PRIORITY))
+    return priority, (time.time() + deadline if deadline else None)
+
+
+def _admit(request: Request, cost: int = 1):
+    """Rate limit per client, then shed load if the queue is too far behind; raises 429 with Retry-After"""
+    # An unchecked header would let a client take a fresh bucket per request (and evict real ones): only issued keys
+    key = request.headers.get(RATE_LIMIT_KEY_HEADER)
+    client = f"key:{key}" if key in RATE_LIMIT_API_KEYS else (request.client.host if request.client else "unknown")
+    retry_after = request.app.state.rate_limiter.acquire(client, cost)
+    if retry_after:
+        ADMISSIONS.labels('rate_limited').inc()
+        raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                            headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    admission = request.app.state.admission
+    retry_after = admission.check() if admission else None
+    if retry_after:
+        ADMISSIONS.labels('overloaded').inc()
+        raise HTTPException(status_code=429, detail="Receipt queue is overloaded, retry later",
+                            headers={"Retry-After": str(retry_after)})
+    ADMISSIONS.labels('admitted').inc(cost)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = 10):
+    """Sample the API's threads for N seconds; returns collapsed stacks for a flamegraph"""
+    if not DEBUG_ENDPOINTS:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if profiler.running:
+        raise HTTPException(status_code=409, detail="Profiler already running")
+    return PlainTextResponse(await run_in_threadpool(profiler.profile_for, max(0.1, min(seconds, 60))))
+
+async def _stage_image(blob_store, read: Callable[[int], Awaitable[bytes]], conversation_id: str,
+                       max_bytes: int = None) -> tuple:
+    """Returns (image, image_ref): the raw bytes to send inline, or a reference after streaming into the blob store"""
+    if blob_store is None:
+        # One byte past the limit is enough to reject, without holding an oversized upload in memory
+        contents = await read(-1 if max_bytes is None else max_bytes + 1)
+        if max_bytes is not None and len(contents) > max_bytes:
+            raise ValueError(f"File larger than {max_bytes} bytes")
+        return contents, None
+
+    # Stream the upload into the blob store; the message only carries its content hash
+    writer = blob_store.writer()
+    try:
+        while chunk := await read(BLOB_CHUNK_SIZE):
+            if max_bytes is not None and writer.size + len(chunk) > max_bytes:
+                raise ValueError(f"File larger than {max_bytes} bytes")
+            await run_in_threadpool(writer.write, chunk)
+        return None, await run_in_threadpool(writer.commit, conversation_id)
+    except Exception:
+        writer.abort()
+        raise
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff', '.pdf')
+
+
+def _zip_image_entries(archive: zipfile.ZipFile) -> list:
+    return [
+        info for info in archive.infolist()
+        if not info.is_dir()
+        and not os.path.basename(info.filename).startswith('.')
+        and not info.filename.startswith('__MACOSX/')
+        and info.filename.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
 @app.post("/process-image")
 async def process_image(
     file: UploadFile = File(...),
     request: Request = None,
-    include_items: str = "price, item_name, company"
+    include_items: str = "price, item_name, company",
+    priority: Optional[int] = None,
+    deadline: Optional[float] = None
 ):
-    """convert receipt (with/without hand writting) image to json"""
+    """convert receipt (with/without hand writting) image to json.
+    priority: 0..TASK_MAX_PRIORITY (default interactive); deadline: seconds after which the result is no longer wanted"""
+    priority, deadline_at = _task_options(priority, deadline, INTERACTIVE_PRIORITY)
+    _admit(request)
     conversation_id = str(uuid.uuid4())
-    contents = await file.read()
-    encoded_image = base64.b64encode(contents).decode('utf-8')
+    blob_store = request.app.state.blob_store
+    try:
+        image, image_ref = await _stage_image(blob_store, file.read, conversation_id)
+    except Exception as e:
+        logging.error(f"Storing upload failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
     
     # Always queue through RabbitMQ for consistency
     try:
         task = ImageRequestPrompt(
             conversation_id=conversation_id,
-            image_url=encoded_image,
-            include_items=include_items
+            include_items=include_items,
+            image_ref=image_ref,
+            deadline=deadline_at
         )
-        request.app.state.rabbitmq_client.publish_image_task(task.model_dump_json())
+        body, options = _task_message(task, image)
+        await request.app.state.publisher.publish_image_task(body, priority=priority, **options)
+        TASKS_ENQUEUED.labels(lane_of(priority)).inc()
+        if request.app.state.admission:
+            request.app.state.admission.record_published()
         return {
             "status": "queued",
             "conversation_id": conversation_id,
@@ -64,4 +252,283 @@ async def process_image(
         }
     except Exception as e:
         logging.error(f"Queueing failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        if image_ref:
+            blob_store.release(image_ref, conversation_id)
+        status_code = 503 if isinstance(e, ConnectionError) else 500
+        raise HTTPException(status_code=status_code, detail=str(e))
+
+
+@app.post("/process-images")
+async def process_images(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    include_items: str = "price, item_name, company",
+    priority: Optional[int] = None,
+    deadline: Optional[float] = None
+):
+    """Queue many receipts at once: several image files, or a single ZIP archive of images (bulk lane by default)"""
+    priority, deadline_at = _task_options(priority, deadline, BULK_PRIORITY)
+    blob_store = request.app.state.blob_store
+    staged = []  # (conversation_id, filename, image, image_ref)
+
+    async def _stage(conversation_id, filename, read):
+        image, image_ref = await _stage_image(blob_store, read, conversation_id, BATCH_MAX_FILE_BYTES)
+        staged.append((conversation_id, filename, image, image_ref))
+
+    try:
+        if len(files) == 1 and (files[0].filename or '').lower().endswith('.zip'):
+            # Read entries straight out of the (spooled) upload; nothing is extracted to disk
+            # Parsing the central directory and opening entries seek and read the spooled file, so off the loop
+            archive = await run_in_threadpool(zipfile.ZipFile, files[0].file)
+            entries = await run_in_threadpool(_zip_image_entries, archive)
+            if len(entries) > BATCH_MAX_FILES:
+                raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_FILES} receipts per batch")
+            # Refuse what can be judged from the directory before the batch costs the caller any tokens
+            if not entries:
+                raise ValueError("No receipt images in upload")
+            oversized = next((info for info in entries if info.file_size > BATCH_MAX_FILE_BYTES), None)
+            if oversized:
+                raise ValueError(f"{oversized.filename} is larger than {BATCH_MAX_FILE_BYTES} bytes")
+            _admit(request, len(entries))
+            for info in entries:
+                with await run_in_threadpool(archive.open, info) as entry:
+                    async def _read(size, entry=entry):
+                        return await run_in_threadpool(entry.read, size)
+                    await _stage(str(uuid.uuid4()), info.filename, _read)
+        else:
+            if len(files) > BATCH_MAX_FILES:
+                raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_FILES} receipts per batch")
+            _admit(request, len(files))
+            for file in files:
+                await _stage(str(uuid.uuid4()), file.filename, file.read)
+    except HTTPException:
+        raise
+    except (zipfile.BadZipFile, ValueError) as e:
+        _release_staged(blob_store, staged)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logging.error(f"Storing batch failed: {str(e)}")
+        _release_staged(blob_store, staged)
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if not staged:
+        raise HTTPException(status_code=400, detail="No receipt images in upload")
+
+    messages = [
+        _task_message(ImageRequestPrompt(
+            conversation_id=conversation_id,
+            include_items=include_items,
+            image_ref=image_ref,
+            deadline=deadline_at
+        ), image)
+        for conversation_id, _, image, image_ref in staged
+    ]
+    try:
+        outcomes = await request.app.state.publisher.publish_batch('image_requests', messages, priority=priority)
+    except ConnectionError as e:
+        _release_staged(blob_store, staged)
+        raise HTTPException(status_code=503, detail=str(e))
+
+    batch_id = str(uuid.uuid4())
+    receipts, queued_ids = [], []
+    for (conversation_id, filename, _, image_ref), outcome in zip(staged, outcomes):
+        if outcome is None:
+            queued_ids.append(conversation_id)
+            receipts.append({"filename": filename, "conversation_id": conversation_id, "status": "queued"})
+        else:
+            logging.error(f"Queueing {filename} failed: {outcome}")
+            if image_ref:
+                blob_store.release(image_ref, conversation_id)
+            receipts.append({"filename": filename, "conversation_id": conversation_id,
+                             "status": "failed", "error": str(outcome)})
+    request.app.state.result_store.put_batch(batch_id, queued_ids)
+    TASKS_ENQUEUED.labels(lane_of(priority)).inc(len(queued_ids))
+    if request.app.state.admission:
+        request.app.state.admission.record_published(len(queued_ids))
+
+    return {
+        "status": "queued",
+        "batch_id": batch_id,
+        "queued": len(queued_ids),
+        "failed": len(staged) - len(queued_ids),
+        "receipts": receipts,
+        "poll_url": f"/batch/{batch_id}"
+    }
+
+
+def _release_staged(blob_store, staged):
+    for conversation_id, _, _, image_ref in staged:
+        if image_ref:
+            blob_store.release(image_ref, conversation_id)
+
+
+@app.get("/batch/{batch_id}")
+async def get_batch(batch_id: str, request: Request, wait: float = 0):
+    """Aggregate status of a batch plus every completed receipt; ?wait=N holds until all are done or N seconds"""
+    store = request.app.state.result_store
+    conversation_ids = store.get_batch(batch_id)
+    if conversation_ids is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired batch")
+
+    deadline = asyncio.get_running_loop().time() + max(0.0, min(wait, RESULT_MAX_WAIT))
+    records = {cid: store.get(cid) for cid in conversation_ids}
+    for cid in conversation_ids:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if records[cid] is None and remaining > 0:
+            records[cid] = await store.wait(cid, remaining)
+
+    results = [record for record in records.values() if record is not None]
+    failed = sum(1 for record in results if record.get("status") == "failed")
+    pending = [cid for cid, record in records.items() if record is None]
+    return {
+        "batch_id": batch_id,
+        "status": "completed" if not pending else "processing",
+        "total": len(conversation_ids),
+        "completed": len(results) - failed,
+        "failed": failed,
+        "pending": pending,
+        "results": results
+    }
+
+
+@app.get("/result/{conversation_id}")
+async def get_result(conversation_id: str, request: Request, wait: float = 0):
+    """Fetch a receipt result; with ?wait=N the request is held up to N seconds until it is ready"""
+    store = request.app.state.result_store
+    wait = max(0.0, min(wait, RESULT_MAX_WAIT))
+    record = await store.wait(conversation_id, wait) if wait else store.get(conversation_id)
+    if record is None:
+        return JSONResponse(status_code=202, content={"status": "pending", "conversation_id": conversation_id})
+    return record
+
+
+@app.post("/followup/{conversation_id}")
+async def followup(conversation_id: str, body: FollowUpQuestion, request: Request):
+    """Ask a question about a completed receipt; poll the answer at /result/{question_id}.
+    Answered from the stored receipt JSON and recent turns, in a single model call"""
+    record = request.app.state.result_store.get(conversation_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Unknown, expired or unfinished receipt")
+    if record.get("status") != "completed" or "json_data" not in record:
+        raise HTTPException(status_code=409, detail="Receipt extraction did not complete")
+    _admit(request)
+
+    question_id = str(uuid.uuid4())
+    task = FollowUpRequest(
+        conversation_id=conversation_id,
+        question_id=question_id,
+        question=body.question,
+        json_data=record["json_data"],
+        history=request.app.state.memory.history(conversation_id)
+    )
+    try:
+        await request.app.state.publisher.publish_image_task(task.model_dump_json(), headers=_task_headers(),
+                                                             priority=INTERACTIVE_PRIORITY)
+    except Exception as e:
+        logging.error(f"Queueing follow-up failed: {str(e)}")
+        raise HTTPException(status_code=503 if isinstance(e, ConnectionError) else 500, detail=str(e))
+    TASKS_ENQUEUED.labels(lane_of(INTERACTIVE_PRIORITY)).inc()
+    if request.app.state.admission:
+        request.app.state.admission.record_published()
+    return {
+        "status": "queued",
+        "conversation_id": conversation_id,
+        "question_id": question_id,
+        "poll_url": f"/result/{question_id}"
+    }
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.get("/result/{conversation_id}/events")
+async def stream_result(conversation_id: str, request: Request):
+    """Server-Sent Events stream that ends with a 'result' event"""
+    store = request.app.state.result_store
+
+    async def events():
+        queue = store.subscribe(conversation_id)
+        try:
+            record = store.get(conversation_id)
+            while record is None:
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), 15)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+                if event == "result":
+                    record = data
+                else:
+                    yield _sse(event, data)
+            yield _sse("result", record)
+        finally:
+            store.unsubscribe(conversation_id, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _receipt_store(request: Request) -> ReceiptStore:
+    store = request.app.state.receipt_store
+    if store is None:
+        raise HTTPException(status_code=404, detail="Receipt store is disabled (RECEIPT_STORE_ENABLED=0)")
+    return store
+
+
+def _receipt_filters(company: Optional[str], currency: Optional[str], date_from: Optional[date],
+                     date_to: Optional[date], min_total: Optional[float], max_total: Optional[float],
+                     item: Optional[str]) -> dict:
+    return {"company": company, "currency": currency, "date_from": date_from and date_from.isoformat(),
+            "date_to": date_to and date_to.isoformat(), "min_total": min_total, "max_total": max_total,
+            "item": item}
+
+
+# Plain `def` endpoints: FastAPI runs them on the threadpool, off the event loop, with one SQLite reader per thread
+@app.get("/receipts")
+def list_receipts(request: Request, company: Optional[str] = None, currency: Optional[str] = None,
+                  date_from: Optional[date] = None, date_to: Optional[date] = None,
+                  min_total: Optional[float] = None, max_total: Optional[float] = None,
+                  item: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None):
+    """Stored receipts, newest first. company and item match by prefix; pass next_cursor back for the next page"""
+    store = _receipt_store(request)
+    filters = _receipt_filters(company, currency, date_from, date_to, min_total, max_total, item)
+    try:
+        receipts, next_cursor = store.query(limit=max(1, min(limit, RECEIPT_PAGE_MAX)), cursor=cursor, **filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"receipts": receipts, "next_cursor": next_cursor}
+
+
+@app.get("/receipts/export")
+def export_receipts(request: Request, format: str = "jsonl", rows: str = "receipts",
+                    company: Optional[str] = None, currency: Optional[str] = None,
+                    date_from: Optional[date] = None, date_to: Optional[date] = None,
+                    min_total: Optional[float] = None, max_total: Optional[float] = None,
+                    item: Optional[str] = None):
+    """Every matching receipt (rows=receipts) or line item (rows=items), streamed as JSONL or Parquet"""
+    store = _receipt_store(request)
+    if rows not in ("receipts", "items") or format not in ("jsonl", "parquet"):
+        raise HTTPException(status_code=400, detail="rows must be receipts|items and format jsonl|parquet")
+    chunks = store.export(rows, **_receipt_filters(company, currency, date_from, date_to, min_total, max_total, item))
+    filename = f"{rows}.{format}"
+    if format == "jsonl":
+        return StreamingResponse(jsonl_chunks(chunks), media_type="application/x-ndjson",
+                                 headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    try:
+        body = parquet_chunks(chunks, ITEM_COLUMNS if rows == "items" else RECEIPT_COLUMNS)
+    except ImportError as e:
+        chunks.close()
+        raise HTTPException(status_code=501, detail=str(e))
+    return StreamingResponse(body, media_type="application/vnd.apache.parquet",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+@app.get("/receipts/{conversation_id}")
+def get_receipt(conversation_id: str, request: Request):
+    receipt = _receipt_store(request).get(conversation_id)
+    if receipt is None:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    return receipt
@@ -0,0 +1,95 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+
+from app.config import INTERACTIVE_PRIORITY
+
+# Model calls and queue waits run from milliseconds to minutes
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+
+QUEUE_WAIT = Histogram(
+    "receipt_queue_wait_seconds", "Time a task spent in the queue before a worker picked it up",
+    ["queue", "lane"], buckets=LATENCY_BUCKETS)
+# Per-lane depth is enqueued - dequeued (summed over API and worker replicas); total depth comes from the broker
+TASKS_ENQUEUED = Counter("receipt_tasks_enqueued_total", "Tasks published by the API", ["lane"])
+TASKS_DEQUEUED = Counter("receipt_tasks_dequeued_total", "Tasks delivered to a worker", ["lane"])
+QUEUE_DEPTH = Gauge("receipt_queue_depth", "Messages ready in the queue, as last sampled by this worker", ["queue"])
+STAGE_LATENCY = Histogram(
+    "receipt_stage_seconds", "Latency of one pipeline stage (preprocess, ocr, extract, parse, publish, total)",
+    ["stage"], buckets=LATENCY_BUCKETS)
+MODEL_CALL_LATENCY = Histogram(
+    "receipt_model_call_seconds", "Latency of one chat-completions call", ["model"], buckets=LATENCY_BUCKETS)
+TASKS = Counter("receipt_tasks_total", "Finished image tasks by outcome", ["outcome"])
+REPAIRS = Counter("receipt_output_repairs_total", "Malformed model output by how it was recovered", ["outcome"])
+LOCALIZE = Counter("receipt_localize_total", "Receipt localisation outcomes (cropped, full_frame, low_confidence)",
+                   ["outcome"])
+CROP_RATIO = Histogram("receipt_localize_crop_ratio", "Share of the decoded frame kept by localisation",
+                       buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+ROUTES = Counter("receipt_routes_total", "Extractions by cascade route (direct = Gemma only, ocr_* = olmOCR ran)", ["route"])
+ERRORS = Counter("receipt_errors_total", "Errors by exception type", ["type"])
+RETRIES = Counter("receipt_task_retries_total", "Failed tasks sent to a delay queue, by attempt", ["attempt"])
+DEAD_LETTERS = Counter("receipt_dead_letters_total", "Tasks moved to image_requests.dead (fatal, retries_exhausted, "
+                       "unreadable)", ["kind"])
+ADMISSIONS = Counter("receipt_admissions_total", "Upload admission decisions (admitted, rate_limited, overloaded)",
+                     ["outcome"])
+SUPERVISOR_WORKERS = Gauge("receipt_supervisor_workers", "Worker processes by state (desired, running, draining)", ["state"])
+SUPERVISOR_SIGNALS = Gauge("receipt_supervisor_signal", "Inputs of the last scaling decision", ["signal"])
+SUPERVISOR_DECISIONS = Counter("receipt_supervisor_decisions_total", "Scaling decisions", ["action", "reason"])
+INFLIGHT = Gauge("receipt_inflight", "Work currently in progress", ["component"])
+HTTP_LATENCY = Histogram(
+    "receipt_http_request_seconds", "API request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+
+
+@contextmanager
+def timed(stage: str):
+    """with timed("preprocess"): ... records the block's duration under receipt_stage_seconds"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - started)
+
+
+def lane_of(priority) -> str:
+    return "interactive" if (priority or 0) >= INTERACTIVE_PRIORITY else "bulk"
+
+
+def observe_queue_wait(queue: str, headers: dict, priority: int = None):
+    """Record the wait since the API stamped x-enqueued-at (epoch milliseconds) on the message"""
+    lane = lane_of(priority)
+    TASKS_DEQUEUED.labels(lane).inc()
+    enqueued_at = (headers or {}).get("x-enqueued-at")
+    if enqueued_at is not None:
+        QUEUE_WAIT.labels(queue, lane).observe(max(0.0, time.time() - int(enqueued_at) / 1000))
+
+
+class StatsCollector:
+    """Export stats() dicts of long-lived components (cache, limiters, result store) as gauges"""
+    def __init__(self, prefix: str, source, label: str = None):
+        self.prefix = prefix
+        self.source = source  # callable returning {name: number} or, with label, {label_value: {name: number}}
+        self.label = label
+
+    def describe(self):
+        return []  # names are dynamic; skip the registry's duplicate check
+
+    def collect(self):
+        stats = self.source()
+        rows = stats.items() if self.label else [(None, stats)]
+        families = {}
+        for label_value, values in rows:
+            for name, value in values.items():
+                if not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = GaugeMetricFamily(
+                        f"{self.prefix}_{name}", f"{self.prefix} {name}", labels=[self.label] if self.label else [])
+                family.add_metric([label_value] if self.label else [], value)
+        return list(families.values())
+
+
+def register_stats(prefix: str, source, label: str = None):
+    REGISTRY.register(StatsCollector(prefix, source, label))
@@ -8,8 +8,10 @@
 #     conversation_id: str
 #     message: str
 
-from pydantic import BaseModel, Field
-from typing import Any, Dict, Optional
+import json
+import re
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+from typing import Any, Dict, List, Optional
 
 class ImageRequest(BaseModel):
     conversation_id: str
@@ -17,8 +19,21 @@ class ImageRequest(BaseModel):
 
 class ImageRequestPrompt(BaseModel):
     conversation_id: str
-    image_url: str
+    image_url: str = ""  # base64 or http(s) URL; empty when image_ref is used
     include_items: str
+    image_ref: Optional[str] = None  # claim-check reference into the blob store ("sha256:<hex>")
+    deadline: Optional[float] = None  # epoch seconds; past it the worker answers with a timeout instead of running
+
+class FollowUpQuestion(BaseModel):
+    question: str = Field(min_length=1, max_length=2000)
+
+class FollowUpRequest(BaseModel):
+    """Queue message for a question about an already extracted receipt; answered on followup_responses"""
+    conversation_id: str
+    question_id: str
+    question: str
+    json_data: Any  # the receipt, as published on image_responses
+    history: List[Dict[str, str]] = []  # earlier turns, already trimmed to FOLLOWUP_HISTORY_TOKENS
 
 # class ImageResponse(BaseModel):
 #     conversation_id: str
@@ -29,4 +44,129 @@ class ImageResponse:
     def __init__(self, conversation_id: str, json_data: Any, status: str = "completed"):
         self.conversation_id = conversation_id
         self.json_data = json_data  # 接受任何类型
-        self.status = status
\ No newline at end of file
+        self.status = status
+
+
+# Receipt fields the model is asked for; anything else it returns is kept as an extra field
+NUMERIC_FIELDS = {"price", "quantity", "unit_price", "amount", "total", "subtotal", "tax", "discount"}
+
+
+def _to_number(value: Any) -> Optional[float]:
+    """"$1,234.50" -> 1234.5, "12,50" -> 12.5, "2x" -> 2.0; unreadable values become None"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    text = str(value).strip()
+    if re.fullmatch(r"\D*\d+,\d{1,2}\D*", text):
+        text = text.replace(",", ".")  # decimal comma
+    text = re.sub(r"[^\d.\-]", "", text.replace(",", ""))
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _to_text(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+
+
+class ReceiptItem(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    item_name: Optional[str] = None
+    quantity: Optional[float] = None
+    price: Optional[float] = None
+    unit_price: Optional[float] = None
+    unit: Optional[str] = None
+    company: Optional[str] = None
+    currency: Optional[str] = None
+    notes: Optional[str] = None
+
+    _numbers = field_validator("quantity", "price", "unit_price", mode="before")(_to_number)
+    _texts = field_validator("item_name", "unit", "company", "currency", "notes", mode="before")(_to_text)
+
+
+class Receipt(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    items: List[ReceiptItem] = []
+    company_name: Optional[str] = None
+    date: Optional[str] = None
+    currency: Optional[str] = None
+    subtotal: Optional[float] = None
+    tax: Optional[float] = None
+    total: Optional[float] = None
+    notes: Optional[str] = None
+    needs_ocr: bool = Field(default=False, exclude=True)  # cascade triage: the model asked for the olmOCR pass
+
+    _numbers = field_validator("subtotal", "tax", "total", mode="before")(_to_number)
+    _texts = field_validator("company_name", "date", "currency", "notes", mode="before")(_to_text)
+
+    @classmethod
+    def from_output(cls, data: Any) -> "Receipt":
+        """Normalise the shapes the model produces (item list, JSONL, {"items": [...]}, a single item) into a Receipt"""
+        if isinstance(data, list):
+            items = [entry for entry in data if isinstance(entry, dict)]
+            # JSONL sometimes leads with a header object that holds the item list itself
+            for entry in items:
+                if any(isinstance(v, list) for v in entry.values()):
+                    receipt = cls.from_output(entry)
+                    receipt.items += [ReceiptItem.model_validate(e) for e in items if e is not entry]
+                    return receipt
+            return cls(items=items)
+        if not isinstance(data, dict):
+            raise ValueError(f"Expected a JSON object or array of items, got {type(data).__name__}")
+        lists = [k for k in ("items", "item(s)", "item", "line_items") if isinstance(data.get(k), list)]
+        lists += [k for k, v in data.items() if k not in lists and isinstance(v, list) and v
+                  and all(isinstance(entry, dict) for entry in v)]
+        if lists:
+            header = {k: v for k, v in data.items() if k != lists[0]}
+            return cls.model_validate({**header, "items": [e for e in data[lists[0]] if isinstance(e, dict)]})
+        if data.keys() & {"item_name", "price", "quantity"}:
+            return cls(items=[data])
+        return cls.model_validate(data)
+
+
+def _field_name(name: str) -> str:
+    return re.sub(r"\W+", "_", name.strip().lower()).strip("_")
+
+
+# Receipt-level fields of the schema, in the order they are printed (header, then items, then footer)
+_LEADING_FIELDS = ("company_name", "date", "currency")
+_TRAILING_FIELDS = ("subtotal", "tax", "total", "notes")
+
+
+def _nullable(field: str) -> dict:
+    return {"type": ["number", "null"] if field in NUMERIC_FIELDS else ["string", "null"]}
+
+
+def receipt_json_schema(include_items: str, triage: bool = False) -> dict:
+    """JSON Schema for the extraction answer: the Receipt header and footer fields around
+    {"items": [{<include_items fields>}]} (plus needs_ocr when triaging).
+
+    Strict servers want every property listed as required, so fields a receipt doesn't print are
+    nullable rather than optional; the model answers null for them."""
+    fields = list(dict.fromkeys(f for f in (_field_name(n) for n in include_items.split(",")) if f))
+    item = {
+        "type": "object",
+        "properties": {f: _nullable(f) for f in fields},
+        "required": fields,
+        "additionalProperties": False,
+    }
+    properties = {
+        **{f: _nullable(f) for f in _LEADING_FIELDS},
+        "items": {"type": "array", "items": item},
+        **{f: _nullable(f) for f in _TRAILING_FIELDS},
+    }
+    if triage:
+        # First, so a receipt that needs OCR is settled in a few tokens
+        properties = {"needs_ocr": {"type": "boolean"}, **properties}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
@@ -3,10 +3,12 @@ import json
 import logging
 from typing import Optional, Callable, Any
 import time
+from app.rabbitmq import RESULT_EXCHANGE, RESULT_KINDS
 
 class RabbitMQReceiver:
     def __init__(self, queue_name: str):
         self.queue_name = queue_name
+        self.consume_queue = queue_name
         self.connection = None
         self.channel = None
         self._should_stop = False
@@ -23,16 +25,22 @@ class RabbitMQReceiver:
                 )
             )
             self.channel = self.connection.channel()
-            self.channel.queue_declare(queue=self.queue_name, durable=True)
+            if self.queue_name in RESULT_KINDS:
+                # Results are fanned out: listen on a private queue bound to them instead of taking them from the API
+                self.channel.exchange_declare(exchange=RESULT_EXCHANGE, exchange_type='direct', durable=True)
+                self.consume_queue = self.channel.queue_declare(queue='', exclusive=True).method.queue
+                self.channel.queue_bind(queue=self.consume_queue, exchange=RESULT_EXCHANGE, routing_key=self.queue_name)
+            else:
+                self.channel.queue_declare(queue=self.queue_name, durable=True)
             logging.info(f"Connected to RabbitMQ and listening on queue '{self.queue_name}'")
             return True
         except Exception as e:
             logging.error(f"Connection failed: {e}")
             return False
 
-    def start_consuming(self, callback: Optional[Callable] = None):
+    def start_consuming(self, callback: Optional[Callable] = None, host='localhost'):
         """Start consuming messages with a callback"""
-        if not self.connect():
+        if not self.connect(host):
             raise ConnectionError("Failed to connect to RabbitMQ")
 
         def _wrapped_callback(ch, method, properties, body):
@@ -49,7 +57,7 @@ class RabbitMQReceiver:
                 logging.error(f"Error processing message: {e}")
 
         self.channel.basic_consume(
-            queue=self.queue_name,
+            queue=self.consume_queue,
             on_message_callback=_wrapped_callback,
             auto_ack=True
         )
@@ -57,7 +65,7 @@ class RabbitMQReceiver:
         logging.info(f"Starting consumer for queue '{self.queue_name}'...")
         try:
             while not self._should_stop:
-                self.connection.process_data_events(time_limit=1)  # Non-blocking
+                self.connection.process_data_events(time_limit=1)  # Returns within 1s so stop() is noticed
         except KeyboardInterrupt:
             logging.info("Consumer stopped by user")
         except Exception as e:
@@ -71,21 +79,29 @@ class RabbitMQReceiver:
             raise ConnectionError("Failed to connect to RabbitMQ")
 
         messages = []
-        start_time = time.time()
-        
-        while len(messages) < count and (time.time() - start_time) < timeout:
-            method_frame, _, body = self.channel.basic_get(
-                queue=self.queue_name,
-                auto_ack=True
-            )
+        deadline = time.time() + timeout
+
+        # Push consumer with an inactivity timeout: blocks on the socket instead of spinning on basic_get
+        for method_frame, _, body in self.channel.consume(
+            queue=self.consume_queue,
+            auto_ack=True,
+            inactivity_timeout=max(0.1, min(1.0, timeout))
+        ):
             if method_frame:
-                try:
-                    messages.append(json.loads(body.decode('utf-8')))
-                except json.JSONDecodeError:
-                    messages.append(body.decode('utf-8'))
-        
+                messages.append(self._decode(body))
+            if len(messages) >= count or time.time() >= deadline:
+                break
+        self.channel.cancel()
+
         return messages
 
+    @staticmethod
+    def _decode(body: bytes) -> Any:
+        try:
+            return json.loads(body.decode('utf-8'))
+        except json.JSONDecodeError:
+            return body.decode('utf-8')
+
     def stop(self):
         """Gracefully stop the consumer"""
         self._should_stop = True
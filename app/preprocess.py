@@ -0,0 +1,118 @@
+import base64
+import io
+import logging
+import time
+from typing import Dict, NamedTuple, Tuple
+
+from PIL import Image, ImageOps
+
+from app.config import (
+    GEMMA_GRAYSCALE, GEMMA_IMAGE_FORMAT, GEMMA_IMAGE_QUALITY, GEMMA_MAX_SIDE, LOCALIZE_ENABLED,
+    OLM_GRAYSCALE, OLM_IMAGE_FORMAT, OLM_IMAGE_QUALITY, OLM_MAX_SIDE,
+)
+from app.metrics import CROP_RATIO, LOCALIZE, timed
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+class StageSettings(NamedTuple):
+    """How the image is prepared for one model stage"""
+    max_side: int
+    grayscale: bool = False
+    format: str = "JPEG"
+    quality: int = 85
+
+
+DEFAULT_STAGES = {
+    "ocr": StageSettings(OLM_MAX_SIDE, OLM_GRAYSCALE, OLM_IMAGE_FORMAT.upper(), OLM_IMAGE_QUALITY),
+    "extract": StageSettings(GEMMA_MAX_SIDE, GEMMA_GRAYSCALE, GEMMA_IMAGE_FORMAT.upper(), GEMMA_IMAGE_QUALITY),
+}
+
+
+def sniff_mime(data) -> str:
+    """Image type from the leading magic bytes (JPEG if unrecognised)"""
+    head = bytes(data[:12])
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:3] == b"GIF":
+        return "image/gif"
+    return "image/jpeg"
+
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+class ImagePreprocessor:
+    """Decode an upload once, cut the receipt out of it, then downscale/recompress it separately for each model stage"""
+    def __init__(self, stages: Dict[str, StageSettings] = None, localize: bool = LOCALIZE_ENABLED):
+        self.stages = stages or DEFAULT_STAGES
+        self.localizer = None
+        if localize:
+            try:
+                from app.localize import ReceiptLocalizer
+            except ImportError as e:
+                raise ImportError("LOCALIZE_ENABLED=1 requires numpy (pip install numpy)") from e
+            self.localizer = ReceiptLocalizer()
+
+    def signature(self) -> str:
+        """Stable description of the settings, so cached extractions follow config changes"""
+        stages = ";".join(f"{name}={tuple(s)}" for name, s in sorted(self.stages.items()))
+        return stages + (";" + self.localizer.signature() if self.localizer is not None else "")
+
+    def load(self, image_bytes) -> Image.Image:
+        image = Image.open(io.BytesIO(image_bytes))
+        # Let the JPEG decoder skip DCT scales we would throw away anyway
+        largest = max(s.max_side for s in self.stages.values())
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        return image
+
+    def encode(self, image: Image.Image, settings: StageSettings) -> Tuple[bytes, str]:
+        if settings.grayscale and image.mode != "L":
+            image = image.convert("L")
+        if max(image.size) > settings.max_side:
+            image = image.copy()
+            image.thumbnail((settings.max_side, settings.max_side), Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=settings.format, quality=settings.quality, optimize=True)
+        return buffer.getvalue(), MIME_TYPES.get(settings.format, "application/octet-stream")
+
+    def run(self, image_bytes) -> Tuple[Dict[str, str], dict]:
+        """Returns ({stage: data_url}, report). image_bytes may be any bytes-like buffer (e.g. an mmap view)"""
+        started = time.perf_counter()
+        image = self.load(image_bytes)
+        report = {
+            "original_bytes": len(image_bytes),
+            "original_size": list(image.size),
+            "stages": {},
+        }
+        if self.localizer is not None:
+            with timed("localize"):
+                localization = self.localizer.run(image, max(s.max_side for s in self.stages.values()))
+            image = localization.image
+            LOCALIZE.labels(localization.outcome).inc()
+            CROP_RATIO.observe(localization.crop_ratio)
+            report["localize"] = {k: v for k, v in localization._asdict().items() if k != "image"} | {"size": list(image.size)}
+
+        urls = {}
+        for name, settings in self.stages.items():
+            data, mime = self.encode(image, settings)
+            urls[name] = to_data_url(data, mime)
+            report["stages"][name] = {
+                "bytes": len(data),
+                "bytes_saved": len(image_bytes) - len(data),
+                "mime": mime,
+            }
+        report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        localized = report.get("localize")
+        logging.info(f"Preprocessed image {report['original_size']} {len(image_bytes)}B in {report['elapsed_ms']}ms: "
+                     + (f"{localized['outcome']} to {localized['size']} (crop ratio {localized['crop_ratio']}, "
+                        f"confidence {localized['confidence']}, skew {localized['angle']}, {localized['elapsed_ms']}ms), "
+                        if localized else "")
+                     + ", ".join(f"{n} {s['bytes']}B ({s['bytes_saved']:+d} saved)" for n, s in report["stages"].items()))
+        return urls, report
@@ -0,0 +1,85 @@
+import logging
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+from app.config import PROFILE_INTERVAL, PROFILE_OUTPUT
+
+
+class SamplingProfiler:
+    """Low-overhead wall-clock sampler of every thread's stack, off by default.
+
+    Output is in collapsed-stack format ("frame;frame;frame count"), ready for flamegraph.pl/speedscope.
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.samples = Counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logging.info(f"Sampling profiler started ({self.interval * 1000:.0f}ms interval)")
+
+    def stop(self) -> Counter:
+        if self.running:
+            self._stop.set()
+            self._thread.join()
+            logging.info(f"Sampling profiler stopped ({sum(self.samples.values())} samples)")
+        return self.samples
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def dump(self, path: str = PROFILE_OUTPUT):
+        with open(path, "w") as f:
+            f.write(self.collapsed())
+        logging.info(f"Profile written to {path}")
+
+    def profile_for(self, seconds: float) -> str:
+        """Blocking helper: sample for `seconds` and return the collapsed stacks"""
+        self.start()
+        time.sleep(seconds)
+        self.stop()
+        return self.collapsed()
+
+
+profiler = SamplingProfiler()
+
+
+def install_signal_toggle(signum: int = signal.SIGUSR2):
+    """`kill -USR2 <pid>` starts the profiler; the next one stops it and writes PROFILE_OUTPUT"""
+    def _toggle(_signum, _frame):
+        if profiler.running:
+            threading.Thread(target=lambda: (profiler.stop(), profiler.dump()), daemon=True).start()
+        else:
+            profiler.start()
+    if threading.current_thread() is not threading.main_thread():
+        logging.debug("Profiler signal toggle not installed: not on the main thread")
+        return
+    signal.signal(signum, _toggle)
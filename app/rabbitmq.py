@@ -4,6 +4,35 @@ import logging
 import os
 import time
 from typing import Optional, Callable
+from app.config import RABBITMQ_RECONNECT_MAX, RETRY_DELAYS, TASK_MAX_PRIORITY
+
+DEAD_LETTER_QUEUE = 'image_requests.dead'
+# Results fan out to every consumer: the worker publishes them to this exchange with the kind as routing key,
+# and each API replica (or tool) binds a queue of its own, so none takes results away from another
+RESULT_EXCHANGE = 'image_results'
+RESULT_KINDS = ("image_responses", "image_errors", "image_partials", "followup_responses")
+
+
+def retry_queue(attempt: int) -> str:
+    """Delay queue for retry number `attempt` (1-based); named after its TTL, which RabbitMQ cannot change in place"""
+    return f"image_requests.retry.{int(RETRY_DELAYS[attempt - 1] * 1000)}ms"
+
+
+# Queue topology shared by the blocking client and the async publisher: name -> x-arguments
+QUEUE_ARGUMENTS = {
+    # Interactive uploads overtake bulk imports; priority is set per message by the API
+    'image_requests': {'x-max-priority': TASK_MAX_PRIORITY},
+    # Failed tasks after the last retry (or fatal errors), with x-failure-* headers; replay with `python -m app.replay`
+    DEAD_LETTER_QUEUE: {},
+}
+# Nobody consumes the delay queues: on expiry RabbitMQ dead-letters the task through the default exchange
+# back to image_requests, so a retry never occupies a worker while it waits
+for _attempt in range(1, len(RETRY_DELAYS) + 1):
+    QUEUE_ARGUMENTS[retry_queue(_attempt)] = {
+        'x-message-ttl': int(RETRY_DELAYS[_attempt - 1] * 1000),
+        'x-dead-letter-exchange': '',
+        'x-dead-letter-routing-key': 'image_requests',
+    }
 
 class RabbitMQClient:
     def __init__(self):
@@ -12,7 +41,8 @@ class RabbitMQClient:
         self._shutdown_listeners = []
         self._connection_params = None
         self._should_reconnect = True
-        self._reconnect_delay = 5
+        self._reconnect_delay = 1
+        self._next_reconnect = 0.0
         self._consuming = False
 
     def add_shutdown_listener(self, callback: Callable[[str], None]):
@@ -35,8 +65,7 @@ class RabbitMQClient:
             credentials=credentials,
             heartbeat=600,
             blocked_connection_timeout=300,
-            connection_attempts=5,
-            retry_delay=5
+            connection_attempts=1  # callers back off between attempts
         )
         
         try:
@@ -47,9 +76,9 @@ class RabbitMQClient:
             if not self.connection.is_open:
                 raise pika.exceptions.AMQPConnectionError("Connection not open after creation")
                 
-            self.channel.queue_declare(queue='image_requests', durable=True)
-            self.channel.queue_declare(queue='image_responses', durable=True)
-            self.channel.queue_declare(queue='image_errors', durable=True)
+            for queue, arguments in QUEUE_ARGUMENTS.items():
+                self.channel.queue_declare(queue=queue, durable=True, arguments=arguments or None)
+            self.channel.exchange_declare(exchange=RESULT_EXCHANGE, exchange_type='direct', durable=True)
             
             logging.info("Successfully connected to RabbitMQ")
             return True
@@ -66,18 +95,22 @@ class RabbitMQClient:
             return False
         return True
     
-    def publish(self, queue: str, body: str | dict, persistent=True):
-        """通用发布方法"""
+    def publish(self, queue: str, body: str | bytes | dict, persistent=True, headers: dict = None,
+                content_type: str = 'application/json', priority: int = None, expiration: str = None):
+        """通用发布方法 (bytes bodies with their own headers carry x-version 2.0 tasks, see app.wire).
+        Result kinds (RESULT_KINDS) go to RESULT_EXCHANGE, everything else straight to the named queue"""
         try:
             payload = json.dumps(body) if isinstance(body, dict) else body
             self.channel.basic_publish(
-                exchange='',
+                exchange=RESULT_EXCHANGE if queue in RESULT_KINDS else '',
                 routing_key=queue,
-                body=payload.encode('utf-8'),
+                body=payload.encode('utf-8') if isinstance(payload, str) else payload,
                 properties=pika.BasicProperties(
                     delivery_mode=2 if persistent else 1,
-                    content_type='application/json',
-                    headers={'x-version': '1.0'}
+                    content_type=content_type,
+                    headers=headers or {'x-version': '1.0'},
+                    priority=priority,
+                    expiration=expiration
                 )
             )
             return True
@@ -108,15 +141,20 @@ class RabbitMQClient:
             return False
 
     def _reconnect(self):
-        """Attempt to reconnect to RabbitMQ"""
-        logging.info(f"Attempting to reconnect in {self._reconnect_delay} seconds...")
-        time.sleep(self._reconnect_delay)
+        """Attempt to reconnect to RabbitMQ. Never sleeps: while backing off after a failure it fails fast"""
+        if time.monotonic() < self._next_reconnect:
+            return False
         try:
             self.close()  # Clean up any existing connection
-            return self.connect()
+            if self.connect():
+                self._reconnect_delay = 1
+                return True
         except Exception as e:
             logging.error(f"Reconnect failed: {e}")
-            return False
+        logging.info(f"Next reconnect attempt in {self._reconnect_delay}s")
+        self._next_reconnect = time.monotonic() + self._reconnect_delay
+        self._reconnect_delay = min(self._reconnect_delay * 2, RABBITMQ_RECONNECT_MAX)
+        return False
 
     def close(self):
         """Cleanly close the connection"""
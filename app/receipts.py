@@ -0,0 +1,361 @@
+"""Persistent, queryable store of every extracted receipt (SQLite), behind GET /receipts.
+
+Fed by a ResultStore listener, so it sees each image_responses message the API's result consumer
+drains. The consumer thread only queues the record; a writer thread commits whatever has queued up
+as one transaction (up to RECEIPT_BATCH_SIZE receipts), so batches grow with the load instead of
+each receipt paying for its own commit. Line items are stored one row each, next to the receipt.
+"""
+import base64
+import io
+import json
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, List, Optional
+
+from app.config import RECEIPT_BATCH_SIZE, RECEIPT_DAY_FIRST, RECEIPT_DB_PATH, RECEIPT_MAX_PENDING
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    conversation_id TEXT PRIMARY KEY,
+    company_name TEXT COLLATE NOCASE,
+    date TEXT,
+    date_text TEXT,
+    currency TEXT,
+    subtotal REAL,
+    tax REAL,
+    total REAL,
+    item_count INTEGER NOT NULL,
+    route TEXT,
+    received_at REAL NOT NULL,
+    json_data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_date ON receipts(date);
+CREATE INDEX IF NOT EXISTS receipts_company ON receipts(company_name, date);
+CREATE INDEX IF NOT EXISTS receipts_currency ON receipts(currency, date);
+CREATE INDEX IF NOT EXISTS receipts_total ON receipts(total);
+CREATE INDEX IF NOT EXISTS receipts_received ON receipts(received_at, conversation_id);
+CREATE TABLE IF NOT EXISTS items (
+    conversation_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    item_name TEXT COLLATE NOCASE,
+    quantity REAL,
+    unit TEXT,
+    unit_price REAL,
+    price REAL,
+    currency TEXT,
+    PRIMARY KEY (conversation_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_name ON items(item_name);
+"""
+
+# Exported columns and their types (sqlite affinity; also the Parquet schema)
+RECEIPT_COLUMNS = {
+    "conversation_id": "TEXT", "company_name": "TEXT", "date": "TEXT", "date_text": "TEXT",
+    "currency": "TEXT", "subtotal": "REAL", "tax": "REAL", "total": "REAL", "item_count": "INTEGER",
+    "route": "TEXT", "received_at": "REAL",
+}
+ITEM_COLUMNS = {
+    "conversation_id": "TEXT", "company_name": "TEXT", "date": "TEXT", "position": "INTEGER",
+    "item_name": "TEXT", "quantity": "REAL", "unit": "TEXT", "unit_price": "REAL", "price": "REAL",
+    "currency": "TEXT",
+}
+
+_DATE_TOKEN = re.compile(
+    r"\d{4}年\d{1,2}月\d{1,2}日"
+    r"|\d{1,4}[/.\-]\d{1,2}[/.\-]\d{2,4}"
+    r"|\d{1,2} [A-Za-z]{3,9}\.?,? \d{4}"
+    r"|[A-Za-z]{3,9}\.? \d{1,2},? \d{4}"
+    r"|\b\d{8}\b"
+)
+_DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%Y%m%d", "%Y年%m月%d日",
+                 "%d %b %Y", "%d %B %Y", "%b %d %Y", "%B %d %Y")
+_DAY_FIRST_FORMATS = ("%d/%m/%Y", "%d-%m-%Y", "%d.%m.%Y", "%d/%m/%y", "%d-%m-%y", "%d.%m.%y")
+_MONTH_FIRST_FORMATS = ("%m/%d/%Y", "%m-%d-%Y", "%m.%d.%Y", "%m/%d/%y", "%m-%d-%y", "%m.%d.%y")
+
+# Only symbols that name one currency; a bare "$" is left as printed
+_CURRENCY_SYMBOLS = {"HK$": "HKD", "US$": "USD", "S$": "SGD", "A$": "AUD", "C$": "CAD", "NT$": "TWD",
+                     "MOP$": "MOP", "RMB": "CNY", "€": "EUR", "£": "GBP", "¥": "JPY", "円": "JPY"}
+
+
+def normalise_date(text: Optional[str], day_first: bool = RECEIPT_DAY_FIRST) -> Optional[str]:
+    """ISO yyyy-mm-dd from the date as printed on a receipt, or None when it can't be read"""
+    match = _DATE_TOKEN.search(text or "")
+    if not match:
+        return None
+    token = re.sub(r"\.(?= )", "", match.group(0).replace(",", ""))  # "Mar. 5, 2024"
+    for fmt in _DATE_FORMATS + (_DAY_FIRST_FORMATS if day_first else _MONTH_FIRST_FORMATS):
+        try:
+            return datetime.strptime(token, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return None
+
+
+def normalise_currency(text: Optional[str]) -> Optional[str]:
+    if not text or not text.strip():
+        return None
+    code = text.strip().upper()
+    return _CURRENCY_SYMBOLS.get(code, code)[:8]
+
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def receipt_rows(conversation_id: str, record: dict) -> tuple:
+    """(receipts row, [items rows]) for a completed result record"""
+    data = record["json_data"]
+    items = [item for item in data.get("items") or [] if isinstance(item, dict)]
+    # Receipts read without the header fields still have the shop and currency on their items
+    company = data.get("company_name") or next((item["company"] for item in items if item.get("company")), None)
+    currency = normalise_currency(data.get("currency")) or next(
+        (normalise_currency(item.get("currency")) for item in items if item.get("currency")), None)
+    receipt = (conversation_id, company, normalise_date(data.get("date")), data.get("date"),
+               currency, _number(data.get("subtotal")), _number(data.get("tax")), _number(data.get("total")),
+               len(items), record.get("route"), record.get("received_at") or time.time(), json.dumps(data))
+    rows = [(conversation_id, position, item.get("item_name"), _number(item.get("quantity")), item.get("unit"),
+             _number(item.get("unit_price")), _number(item.get("price")),
+             normalise_currency(item.get("currency")) or currency)
+            for position, item in enumerate(items)]
+    return receipt, rows
+
+
+def encode_cursor(received_at: float, conversation_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([received_at, conversation_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Raises ValueError for a cursor this store didn't hand out"""
+    try:
+        received_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(received_at), str(conversation_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+
+
+def _filters(company: str = None, currency: str = None, date_from: str = None, date_to: str = None,
+             min_total: float = None, max_total: float = None, item: str = None, prefix: str = "") -> tuple:
+    """WHERE clause (or "") and its parameters; company and item match by case-insensitive prefix"""
+    def like(text: str) -> str:
+        return re.sub(r"([\\%_])", r"\\\1", text) + "%"
+
+    clauses, params = [], []
+    if company:
+        clauses.append(f"{prefix}company_name LIKE ? ESCAPE '\\'")
+        params.append(like(company))
+    if currency:
+        clauses.append(f"{prefix}currency = ?")
+        params.append(normalise_currency(currency))
+    if date_from:
+        clauses.append(f"{prefix}date >= ?")
+        params.append(date_from)
+    if date_to:
+        clauses.append(f"{prefix}date <= ?")
+        params.append(date_to)
+    if min_total is not None:
+        clauses.append(f"{prefix}total >= ?")
+        params.append(min_total)
+    if max_total is not None:
+        clauses.append(f"{prefix}total <= ?")
+        params.append(max_total)
+    if item:
+        clauses.append(f"{prefix}conversation_id IN "
+                       f"(SELECT conversation_id FROM items WHERE item_name LIKE ? ESCAPE '\\')")
+        params.append(like(item))
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+class ReceiptStore:
+    """Receipts by conversation_id; a later result for the same conversation replaces the earlier one"""
+    def __init__(self, path: str = RECEIPT_DB_PATH, batch_size: int = RECEIPT_BATCH_SIZE,
+                 max_pending: int = RECEIPT_MAX_PENDING):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        # Only the writer thread uses this one; readers get their own connections (WAL: they never block it)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent; a power cut may lose the last batch
+        self._db.executescript(SCHEMA)
+        self._local = threading.local()
+        self._pending: "queue.Queue" = queue.Queue(maxsize=max_pending)
+        self._counters = {"written": 0, "batches": 0, "largest_batch": 0, "failed": 0, "waits": 0}
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="receipt-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        """Write what is still queued, then stop the writer"""
+        if self._thread:
+            self._pending.put(None)
+            self._thread.join(timeout)
+
+    def listener(self, key: str, record: dict):
+        """ResultStore listener: queue completed extractions for the writer"""
+        if record.get("status") != "completed" or not isinstance(record.get("json_data"), dict):
+            return  # failures, follow-up answers
+        try:
+            self._pending.put_nowait((key, record))
+        except queue.Full:
+            # Hold the result consumer (and so its acks) until the writer catches up rather than drop receipts
+            self._counters["waits"] += 1
+            logging.warning(f"Receipt writer is {self._pending.qsize()} receipts behind; result consumer waiting")
+            self._pending.put((key, record))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._pending.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [entry for entry in batch if entry is not None]
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[tuple]):
+        latest = dict(batch)  # a conversation's last result wins
+        receipts, items = [], []
+        for conversation_id, record in latest.items():
+            try:
+                receipt, rows = receipt_rows(conversation_id, record)
+            except Exception as e:
+                logging.error(f"Skipping receipt {conversation_id}: {type(e).__name__}: {e}")
+                continue
+            receipts.append(receipt)
+            items.extend(rows)
+        try:
+            with self._db:  # one transaction for the whole batch
+                self._db.executemany("DELETE FROM items WHERE conversation_id = ?", [(r[0],) for r in receipts])
+                self._db.executemany(f"INSERT OR REPLACE INTO receipts VALUES ({', '.join('?' * 12)})", receipts)
+                self._db.executemany(f"INSERT INTO items VALUES ({', '.join('?' * 8)})", items)
+        except sqlite3.Error as e:
+            self._counters["failed"] += len(receipts)
+            logging.error(f"Writing {len(receipts)} receipts failed: {type(e).__name__}: {e}")
+            return
+        self._counters["written"] += len(receipts)
+        self._counters["batches"] += 1
+        self._counters["largest_batch"] = max(self._counters["largest_batch"], len(receipts))
+
+    def _reader(self) -> sqlite3.Connection:
+        """A read connection per thread (the endpoints run on the threadpool)"""
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path)
+            db.row_factory = sqlite3.Row
+        return db
+
+    def query(self, limit: int = 50, cursor: str = None, **filters) -> tuple:
+        """(page of receipts without their items, newest first; cursor for the next page or None)"""
+        where, params = _filters(**filters)
+        if cursor:
+            where += (" AND " if where else " WHERE ") + "(received_at, conversation_id) < (?, ?)"
+            params.extend(decode_cursor(cursor))
+        rows = self._reader().execute(
+            f"SELECT {', '.join(RECEIPT_COLUMNS)} FROM receipts{where}"
+            f" ORDER BY received_at DESC, conversation_id DESC LIMIT ?", params + [limit + 1]
+        ).fetchall()
+        page = [dict(row) for row in rows[:limit]]
+        next_cursor = encode_cursor(page[-1]["received_at"], page[-1]["conversation_id"]) if len(rows) > limit else None
+        return page, next_cursor
+
+    def get(self, conversation_id: str) -> Optional[dict]:
+        db = self._reader()
+        row = db.execute(f"SELECT {', '.join(RECEIPT_COLUMNS)} FROM receipts WHERE conversation_id = ?",
+                         (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        receipt = dict(row)
+        receipt["items"] = [dict(item) for item in db.execute(
+            "SELECT position, item_name, quantity, unit, unit_price, price, currency FROM items"
+            " WHERE conversation_id = ? ORDER BY position", (conversation_id,))]
+        return receipt
+
+    def export(self, rows: str = "receipts", chunk_size: int = 1000, **filters) -> Iterator[List[dict]]:
+        """Chunks of matching receipts (or their line items), oldest first, read chunk_size rows at a time.
+
+        Uses its own connection: a streaming response may advance the generator from different threads.
+        """
+        if rows == "items":
+            where, params = _filters(prefix="r.", **filters)
+            columns = ", ".join(f"r.{c}" if c in ("conversation_id", "company_name", "date") else f"i.{c}"
+                                for c in ITEM_COLUMNS)
+            sql = (f"SELECT {columns} FROM receipts r JOIN items i ON i.conversation_id = r.conversation_id"
+                   f"{where} ORDER BY r.received_at, r.conversation_id, i.position")
+        else:
+            where, params = _filters(**filters)
+            sql = f"SELECT {', '.join(RECEIPT_COLUMNS)} FROM receipts{where} ORDER BY received_at, conversation_id"
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        try:
+            result = db.execute(sql, params)
+            while chunk := result.fetchmany(chunk_size):
+                yield [dict(row) for row in chunk]
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        return {"pending": self._pending.qsize(), **self._counters}
+
+
+def jsonl_chunks(chunks: Iterator[List[dict]]) -> Iterator[bytes]:
+    for chunk in chunks:
+        yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in chunk).encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands what was written so far to the response, instead of keeping it"""
+    def __init__(self):
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def take(self) -> bytes:
+        data, self._buffer = bytes(self._buffer), bytearray()
+        return data
+
+
+def parquet_chunks(chunks: Iterator[List[dict]], columns: dict) -> Iterator[bytes]:
+    """Stream a Parquet file, one row group per chunk. Raises ImportError up front without pyarrow"""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Parquet export requires pyarrow (pip install pyarrow)") from e
+    types = {"TEXT": pa.string(), "REAL": pa.float64(), "INTEGER": pa.int64()}
+    schema = pa.schema([(name, types[kind]) for name, kind in columns.items()])
+
+    def generate() -> Iterator[bytes]:
+        sink = _ChunkSink()
+        with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+            for chunk in chunks:
+                writer.write_table(pa.Table.from_pylist(chunk, schema=schema))
+                yield sink.take()
+        yield sink.take()  # footer
+    return generate()
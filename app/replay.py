@@ -0,0 +1,112 @@
+"""Bulk-replay tasks parked in image_requests.dead back onto image_requests.
+
+    # What is in there: counts by failure kind and reason, nothing is moved
+    python -m app.replay --dry-run
+    # After a model server outage
+    python -m app.replay --kind retries_exhausted
+    # After fixing a bug, only the tasks it broke
+    python -m app.replay --reason "Extraction failed" --limit 100
+
+Replayed tasks get a fresh retry budget and queue-wait stamp. Dead letters that don't match the filters are
+moved to the back of the queue, so one pass sees each message once. Unreadable messages are only replayed
+with `--kind unreadable`. Workers still drop tasks whose deadline has passed, and image_ref tasks need their
+blob, which the dead letter keeps referenced for BLOB_TTL_SECONDS after the upload.
+"""
+import argparse
+import logging
+import time
+from collections import Counter
+
+from app.rabbitmq import DEAD_LETTER_QUEUE, RabbitMQClient
+
+# Set by the worker on the way into the dead-letter queue (and the delay queues); dropped on replay
+FAILURE_HEADERS = ('x-failure-kind', 'x-failure-reason', 'x-failed-at', 'x-retry-count', 'x-last-error')
+
+
+def replayed_headers(headers: dict) -> dict:
+    replayed = {k: v for k, v in headers.items() if k not in FAILURE_HEADERS}
+    replayed['x-enqueued-at'] = int(time.time() * 1000)
+    replayed['x-replayed'] = int(headers.get('x-replayed', 0)) + 1
+    return replayed
+
+
+def matches(headers: dict, kind: str = None, reason: str = None) -> bool:
+    failure_kind = headers.get('x-failure-kind')
+    if kind is None and failure_kind == 'unreadable':
+        return False
+    if kind is not None and failure_kind != kind:
+        return False
+    return reason is None or reason in str(headers.get('x-failure-reason', ''))
+
+
+def replay(client: RabbitMQClient, kind: str = None, reason: str = None, limit: int = 0,
+           dry_run: bool = False) -> Counter:
+    """One pass over the messages in the dead-letter queue when it starts. Returns counts by
+    (action, failure kind, failure reason) where action is replayed, skipped or matched (dry run)"""
+    channel = client.channel
+    channel.confirm_delivery()  # a message is only acked off the dead-letter queue once its copy is confirmed
+    pending = channel.queue_declare(queue=DEAD_LETTER_QUEUE, passive=True).method.message_count
+    counts = Counter()
+    replayed = 0
+    for _ in range(pending):
+        if limit and replayed >= limit:
+            break
+        method, properties, body = channel.basic_get(DEAD_LETTER_QUEUE, auto_ack=False)
+        if method is None:
+            break
+        headers = dict(properties.headers or {})
+        key = (headers.get('x-failure-kind', 'unknown'), str(headers.get('x-failure-reason', ''))[:80])
+        wanted = matches(headers, kind, reason)
+        if dry_run:
+            # Left unacked: the broker puts everything back when the channel closes
+            counts[('matched' if wanted else 'skipped', *key)] += 1
+            continue
+
+        if wanted:
+            queue, headers, action = 'image_requests', replayed_headers(headers), 'replayed'
+        else:
+            queue, action = DEAD_LETTER_QUEUE, 'skipped'
+        if not client.publish(queue, body, headers=headers, priority=properties.priority,
+                              content_type=properties.content_type or 'application/json'):
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+            logging.error(f"Stopping: could not publish to {queue}")
+            break
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        counts[(action, *key)] += 1
+        replayed += action == 'replayed'
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kind", choices=("fatal", "retries_exhausted", "unreadable"),
+                        help="only dead letters of this kind (default: all but unreadable)")
+    parser.add_argument("--reason", help="only dead letters whose x-failure-reason contains this text")
+    parser.add_argument("--limit", type=int, default=0, help="replay at most this many (0 = no limit)")
+    parser.add_argument("--dry-run", action="store_true", help="count what would be replayed, move nothing")
+    parser.add_argument("--rabbitmq-host", default="localhost")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    client = RabbitMQClient()
+    if not client.connect(args.rabbitmq_host):
+        raise SystemExit("Cannot connect to RabbitMQ")
+    try:
+        counts = replay(client, args.kind, args.reason, args.limit, args.dry_run)
+    finally:
+        client.close()
+
+    for (action, kind, reason), count in sorted(counts.items()):
+        print(f"{action:<9} {kind:<18} {count:6d}  {reason}")
+    totals = Counter()
+    for (action, _, _), count in counts.items():
+        totals[action] += count
+    print(", ".join(f"{action} {count}" for action, count in sorted(totals.items())) or f"{DEAD_LETTER_QUEUE} is empty")
+    return counts
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set
+
+import pika
+
+from app.config import RESULT_DB_PATH, RESULT_MAX_ENTRIES, RESULT_QUEUE_EXPIRES, RESULT_REPLICA_ID, RESULT_TTL_SECONDS
+from app.rabbitmq import RESULT_EXCHANGE, RESULT_KINDS, RabbitMQClient
+
+
+def replica_queue(replica_id: str = RESULT_REPLICA_ID) -> str:
+    return f"{RESULT_EXCHANGE}.{replica_id or socket.gethostname()}"
+
+
+class ResultStore:
+    """Bounded, TTL-limited index of finished receipts keyed by conversation_id.
+
+    Written from the consumer thread, read from the event loop. Optionally mirrored to SQLite
+    so results survive an API restart.
+    """
+    def __init__(self, max_entries: int = RESULT_MAX_ENTRIES,
+                 ttl_seconds: int = RESULT_TTL_SECONDS,
+                 db_path: str = RESULT_DB_PATH):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._results: "OrderedDict[str, dict]" = OrderedDict()
+        self._batches: "OrderedDict[str, tuple]" = OrderedDict()  # batch_id -> (created, [conversation_id])
+        self._lock = threading.Lock()
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._listeners: List[Callable[[str, dict], None]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+        self._db = None
+        if db_path:
+            if os.path.dirname(db_path):
+                os.makedirs(os.path.dirname(db_path), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " conversation_id TEXT PRIMARY KEY, record TEXT NOT NULL, received_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_received ON results(received_at)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS batches ("
+                " batch_id TEXT PRIMARY KEY, conversation_ids TEXT NOT NULL, created REAL NOT NULL)"
+            )
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def add_listener(self, callback: Callable[[str, dict], None]):
+        """Called (on the consumer thread) for every stored result"""
+        self._listeners.append(callback)
+
+    def put(self, conversation_id: str, record: dict):
+        record.setdefault("received_at", time.time())
+        with self._lock:
+            self._results[conversation_id] = record
+            self._results.move_to_end(conversation_id)
+            self._prune(time.time())
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (conversation_id, record, received_at) VALUES (?, ?, ?)",
+                    (conversation_id, json.dumps(record), record["received_at"]),
+                )
+        for listener in self._listeners:
+            try:
+                listener(conversation_id, record)
+            except Exception as e:
+                logging.error(f"Result listener error: {e}")
+        self.publish_event(conversation_id, "result", record)
+
+    def get(self, conversation_id: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            record = self._results.get(conversation_id)
+            if record is not None:
+                if now - record["received_at"] <= self.ttl_seconds:
+                    return record
+                del self._results[conversation_id]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT record, received_at FROM results WHERE conversation_id = ?", (conversation_id,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    return json.loads(row[0])
+        return None
+
+    def put_batch(self, batch_id: str, conversation_ids: List[str]):
+        now = time.time()
+        with self._lock:
+            self._batches[batch_id] = (now, list(conversation_ids))
+            while self._batches:
+                oldest_id, (created, _) = next(iter(self._batches.items()))
+                if len(self._batches) <= self.max_entries and now - created <= self.ttl_seconds:
+                    break
+                del self._batches[oldest_id]
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO batches (batch_id, conversation_ids, created) VALUES (?, ?, ?)",
+                    (batch_id, json.dumps(conversation_ids), now),
+                )
+
+    def get_batch(self, batch_id: str) -> Optional[List[str]]:
+        now = time.time()
+        with self._lock:
+            entry = self._batches.get(batch_id)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                return entry[1]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT conversation_ids, created FROM batches WHERE batch_id = ?", (batch_id,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    return json.loads(row[0])
+        return None
+
+    def publish_event(self, conversation_id: str, event: str, data: dict):
+        """Thread-safe: hand an event to every open long-poll / SSE subscriber of the conversation"""
+        if self._loop is None or conversation_id not in self._subscribers:
+            return
+        self._loop.call_soon_threadsafe(self._fan_out, conversation_id, event, data)
+
+    def _fan_out(self, conversation_id: str, event: str, data: dict):
+        for queue in self._subscribers.get(conversation_id, ()):
+            queue.put_nowait((event, data))
+
+    def subscribe(self, conversation_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(conversation_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, conversation_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(conversation_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[conversation_id]
+
+    async def wait(self, conversation_id: str, timeout: float) -> Optional[dict]:
+        """Long-poll: return the result as soon as it lands, or None after timeout seconds"""
+        queue = self.subscribe(conversation_id)
+        try:
+            # Subscribe first, then check, so a result arriving in between is not missed
+            record = self.get(conversation_id)
+            deadline = time.monotonic() + timeout
+            while record is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                try:
+                    event, data = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    return None
+                if event == "result":
+                    record = data
+            return record
+        finally:
+            self.unsubscribe(conversation_id, queue)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._results), "batches": len(self._batches),
+                    "subscribers": len(self._subscribers)}
+
+    def _prune(self, now: float):
+        # Caller holds self._lock; entries are in arrival order, so expired ones are at the front
+        while self._results:
+            oldest_id, oldest = next(iter(self._results.items()))
+            if len(self._results) <= self.max_entries and now - oldest["received_at"] <= self.ttl_seconds:
+                break
+            del self._results[oldest_id]
+        if self._db is not None:
+            self._db.execute("DELETE FROM results WHERE received_at < ?", (now - self.ttl_seconds,))
+            self._db.execute("DELETE FROM batches WHERE created < ?", (now - self.ttl_seconds,))
+
+
+def _to_record(queue: str, message: dict) -> dict:
+    if queue == "image_errors":
+        record = {"conversation_id": message.get("conversation_id"), "status": "failed",
+                  "error": message.get("error"), "timestamp": message.get("timestamp")}
+        if message.get("reason"):
+            record["reason"] = message["reason"]
+        return record
+    return message
+
+
+class ResultConsumer:
+    """Background thread draining every result (image_responses / image_errors / image_partials / followup_responses)
+    into a ResultStore.
+
+    Each replica has a durable queue of its own bound to RESULT_EXCHANGE, so every replica sees every result and
+    results published during a restart wait for it. A queue nobody consumes is deleted after RESULT_QUEUE_EXPIRES.
+    """
+    def __init__(self, store: ResultStore, host: str = None, queue: str = None):
+        self.store = store
+        self.host = host or os.getenv("RABBITMQ_HOST", "rabbitmq")
+        self.queue = queue or replica_queue()
+        self.client: Optional[RabbitMQClient] = None
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="result-consumer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._running = False
+        client = self.client
+        if client and client.connection and client.connection.is_open:
+            try:
+                client.connection.add_callback_threadsafe(client.channel.stop_consuming)
+            except Exception as e:
+                logging.error(f"Stopping result consumer failed: {e}")
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _on_message(self, ch, method, properties, body):
+        queue = method.routing_key  # the result kind
+        try:
+            message = json.loads(body)
+            conversation_id = message.get("conversation_id")
+            if conversation_id and queue == "image_partials":
+                # Not stored: only forwarded to clients currently streaming this conversation
+                self.store.publish_event(conversation_id, "item", message)
+            elif queue == "followup_responses" and message.get("question_id"):
+                # Answers are polled by question_id, next to (not over) the receipt itself
+                self.store.put(message["question_id"], message)
+            elif conversation_id:
+                self.store.put(conversation_id, _to_record(queue, message))
+        except Exception as e:
+            logging.error(f"Dropping unreadable message on {queue}: {type(e).__name__}: {e}")
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+    def _run(self):
+        delay = 1
+        while self._running:
+            self.client = RabbitMQClient()
+            try:
+                if not self.client.connect(host=self.host):
+                    raise pika.exceptions.AMQPConnectionError("connect failed")
+                channel = self.client.channel
+                channel.queue_declare(queue=self.queue, durable=True,
+                                      arguments={'x-expires': RESULT_QUEUE_EXPIRES * 1000})
+                for kind in RESULT_KINDS:
+                    channel.queue_bind(queue=self.queue, exchange=RESULT_EXCHANGE, routing_key=kind)
+                channel.basic_qos(prefetch_count=100)
+                channel.basic_consume(queue=self.queue, on_message_callback=self._on_message)
+                delay = 1
+                logging.info(f"Result consumer started on {self.queue}")
+                channel.start_consuming()
+            except Exception as e:
+                if self._running:
+                    logging.error(f"Result consumer error: {type(e).__name__}: {e} - reconnecting in {delay}s")
+                    time.sleep(delay)  # own thread, does not block the event loop
+                    delay = min(delay * 2, 30)
+            finally:
+                self.client.close()
@@ -0,0 +1,297 @@
+"""Autoscaling supervisor for Worker processes on one host.
+
+    python -m app.supervisor
+
+Every SUPERVISOR_INTERVAL seconds it reads the image_requests depth (passive declare) and scrapes each
+worker's /metrics for in-flight tasks and model call latency. ScalingPolicy turns these into a desired
+process count. Workers are scaled down with SIGTERM: they stop consuming, finish in-flight tasks, then exit.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import signal
+import time
+import urllib.request
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from prometheus_client import start_http_server
+from prometheus_client.parser import text_string_to_metric_families
+
+from app.config import (
+    SUPERVISOR_INTERVAL,
+    SUPERVISOR_MAX_MODEL_LATENCY,
+    SUPERVISOR_MAX_WORKERS,
+    SUPERVISOR_METRICS_PORT,
+    SUPERVISOR_MIN_WORKERS,
+    SUPERVISOR_SCALE_DOWN_COOLDOWN,
+    SUPERVISOR_SCALE_DOWN_STABLE,
+    SUPERVISOR_SCALE_DOWN_UTILISATION,
+    SUPERVISOR_SCALE_UP_COOLDOWN,
+    SUPERVISOR_SCALE_UP_UTILISATION,
+    SUPERVISOR_TARGET_BACKLOG,
+    WORKER_CONCURRENCY,
+    WORKER_DRAIN_TIMEOUT,
+    WORKER_METRICS_PORT,
+)
+from app.metrics import SUPERVISOR_DECISIONS, SUPERVISOR_SIGNALS, SUPERVISOR_WORKERS
+from app.rabbitmq import RabbitMQClient
+
+
+class Observation(NamedTuple):
+    depth: Optional[int]  # ready messages in image_requests; None if the broker could not be asked
+    utilisation: Optional[float]  # in-flight tasks / (workers x WORKER_CONCURRENCY); None without worker metrics
+    model_latency: Optional[float]  # mean seconds per model call since the last observation
+
+
+class ScalingPolicy:
+    """Desired worker count from one observation.
+
+    Up: the backlog exceeds SUPERVISOR_TARGET_BACKLOG per worker and the workers are busy. The step goes
+    straight to depth / target, at most doubling. It is held back while the model server is already slow,
+    because more consumers would only queue on it.
+    Down: one worker at a time, after SUPERVISOR_SCALE_DOWN_STABLE consecutive idle observations.
+    Each direction has its own cool-down after any change.
+    """
+    def __init__(self, min_workers: int = SUPERVISOR_MIN_WORKERS, max_workers: int = SUPERVISOR_MAX_WORKERS,
+                 target_backlog: int = SUPERVISOR_TARGET_BACKLOG,
+                 up_utilisation: float = SUPERVISOR_SCALE_UP_UTILISATION,
+                 down_utilisation: float = SUPERVISOR_SCALE_DOWN_UTILISATION,
+                 down_stable: int = SUPERVISOR_SCALE_DOWN_STABLE,
+                 up_cooldown: float = SUPERVISOR_SCALE_UP_COOLDOWN,
+                 down_cooldown: float = SUPERVISOR_SCALE_DOWN_COOLDOWN,
+                 max_model_latency: float = SUPERVISOR_MAX_MODEL_LATENCY):
+        self.min_workers = max(0, min_workers)
+        self.max_workers = max(self.min_workers, max_workers)
+        self.target_backlog = max(1, target_backlog)
+        self.up_utilisation = up_utilisation
+        self.down_utilisation = down_utilisation
+        self.down_stable = down_stable
+        self.up_cooldown = up_cooldown
+        self.down_cooldown = down_cooldown
+        self.max_model_latency = max_model_latency
+        self._last_change = -math.inf
+        self._idle_streak = 0
+
+    def decide(self, current: int, obs: Observation, now: float) -> Tuple[int, str]:
+        """Returns (desired workers, reason)"""
+        if current < self.min_workers:
+            return self._change(self.min_workers, "below_min", now)
+        if current > self.max_workers:
+            return self._change(self.max_workers, "above_max", now)
+        if obs.depth is None:
+            return current, "no_data"
+
+        busy = obs.utilisation is None or obs.utilisation >= self.up_utilisation
+        if obs.depth > self.target_backlog * max(current, 1) and busy:
+            self._idle_streak = 0
+            if current >= self.max_workers:
+                return current, "at_max"
+            if obs.model_latency is not None and obs.model_latency > self.max_model_latency:
+                return current, "model_saturated"
+            if now - self._last_change < self.up_cooldown:
+                return current, "cooldown"
+            wanted = math.ceil(obs.depth / self.target_backlog)
+            return self._change(min(self.max_workers, max(current + 1, min(wanted, current * 2))), "backlog", now)
+
+        idle = obs.depth < self.target_backlog and (obs.utilisation is None and obs.depth == 0
+                                                    or obs.utilisation is not None
+                                                    and obs.utilisation <= self.down_utilisation)
+        if not idle:
+            self._idle_streak = 0
+            return current, "steady"
+        self._idle_streak += 1
+        if current <= self.min_workers:
+            return current, "at_min"
+        if self._idle_streak < self.down_stable:
+            return current, "idle_pending"
+        if now - self._last_change < self.down_cooldown:
+            return current, "cooldown"
+        return self._change(current - 1, "idle", now)
+
+    def _change(self, desired: int, reason: str, now: float) -> Tuple[int, str]:
+        self._last_change = now
+        self._idle_streak = 0
+        return desired, reason
+
+
+def _run_worker(metrics_port: int):
+    """Entry point of a worker process"""
+    from app.worker import Worker
+    Worker(metrics_port=metrics_port).run()
+
+
+class _Scrape(NamedTuple):
+    inflight: float
+    model_seconds: float
+    model_calls: float
+
+
+def _scrape(port: int, timeout: float = 2) -> Optional[_Scrape]:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=timeout) as response:
+            text = response.read().decode("utf-8")
+    except Exception:
+        return None  # still starting, or already gone
+    inflight = seconds = calls = 0.0
+    for family in text_string_to_metric_families(text):
+        for sample in family.samples:
+            if sample.name == "receipt_inflight" and sample.labels.get("component") == "worker":
+                inflight += sample.value
+            elif sample.name == "receipt_model_call_seconds_sum":
+                seconds += sample.value
+            elif sample.name == "receipt_model_call_seconds_count":
+                calls += sample.value
+    return _Scrape(inflight, seconds, calls)
+
+
+class Supervisor:
+    """Spawns, reaps and retires Worker processes to follow ScalingPolicy"""
+    def __init__(self, policy: ScalingPolicy = None, interval: float = SUPERVISOR_INTERVAL,
+                 concurrency: int = WORKER_CONCURRENCY, base_port: int = WORKER_METRICS_PORT,
+                 drain_timeout: float = WORKER_DRAIN_TIMEOUT):
+        self.policy = policy or ScalingPolicy()
+        self.interval = interval
+        self.concurrency = max(1, concurrency)
+        self.base_port = base_port
+        # A worker gets this long after SIGTERM (its own drain plus connection teardown) before it is killed
+        self.kill_after = drain_timeout + 30
+        self.desired = self.policy.min_workers
+        # Fresh interpreters: no inherited broker sockets, locks or model-client pools
+        self._context = multiprocessing.get_context("spawn")
+        self.workers: Dict[int, multiprocessing.Process] = {}  # slot -> running process
+        self.draining: Dict[int, Tuple[multiprocessing.Process, float]] = {}  # slot -> (process, kill deadline)
+        self._previous: Dict[int, _Scrape] = {}
+        self._client: Optional[RabbitMQClient] = None
+        self._running = True
+
+    def _port(self, slot: int) -> int:
+        return self.base_port + slot if self.base_port else 0
+
+    def _spawn(self):
+        slot = next(i for i in range(len(self.workers) + len(self.draining) + 1)
+                    if i not in self.workers and i not in self.draining)
+        process = self._context.Process(target=_run_worker, args=(self._port(slot),), name=f"worker-{slot}")
+        process.start()
+        self.workers[slot] = process
+        self._previous.pop(slot, None)
+        logging.info(f"Started worker {slot} (pid {process.pid}, metrics :{self._port(slot)})")
+
+    def _retire(self, slot: int):
+        process = self.workers.pop(slot)
+        self.draining[slot] = (process, time.monotonic() + self.kill_after)
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+        logging.info(f"Draining worker {slot} (pid {process.pid})")
+
+    def _reap(self):
+        for slot, process in list(self.workers.items()):
+            if not process.is_alive():
+                # Replaced by _reconcile; its unacked deliveries go back to the queue
+                logging.error(f"Worker {slot} (pid {process.pid}) exited unexpectedly with code {process.exitcode}")
+                process.join()
+                del self.workers[slot]
+                SUPERVISOR_DECISIONS.labels("restart", "crashed").inc()
+        for slot, (process, deadline) in list(self.draining.items()):
+            if not process.is_alive():
+                process.join()
+                del self.draining[slot]
+                logging.info(f"Worker {slot} drained and exited with code {process.exitcode}")
+            elif time.monotonic() > deadline:
+                logging.warning(f"Worker {slot} (pid {process.pid}) still busy after {self.kill_after:.0f}s - killing")
+                process.kill()
+
+    def _reconcile(self):
+        while len(self.workers) < self.desired:
+            self._spawn()
+        while len(self.workers) > self.desired:
+            self._retire(max(self.workers))
+        SUPERVISOR_WORKERS.labels("desired").set(self.desired)
+        SUPERVISOR_WORKERS.labels("running").set(len(self.workers))
+        SUPERVISOR_WORKERS.labels("draining").set(len(self.draining))
+
+    def _queue_depth(self) -> Optional[int]:
+        try:
+            if self._client is None or not self._client.connection or not self._client.connection.is_open:
+                self._client = RabbitMQClient()
+                if not self._client.connect(host=os.getenv("RABBITMQ_HOST", "rabbitmq")):
+                    self._client = None
+                    return None
+            return self._client.channel.queue_declare(queue="image_requests", passive=True).method.message_count
+        except Exception as e:
+            logging.warning(f"Cannot read image_requests depth: {e}")
+            self._client = None
+            return None
+
+    def observe(self) -> Observation:
+        inflight, seconds, calls, scraped = 0.0, 0.0, 0.0, 0
+        for slot in list(self.workers):
+            current = _scrape(self._port(slot)) if self.base_port else None
+            if current is None:
+                continue
+            scraped += 1
+            inflight += current.inflight
+            previous = self._previous.get(slot)
+            if previous is not None and current.model_calls >= previous.model_calls:
+                seconds += current.model_seconds - previous.model_seconds
+                calls += current.model_calls - previous.model_calls
+            self._previous[slot] = current
+        return Observation(
+            depth=self._queue_depth(),
+            utilisation=inflight / (scraped * self.concurrency) if scraped else None,
+            model_latency=seconds / calls if calls else None,
+        )
+
+    def step(self):
+        self._reap()
+        obs = self.observe()
+        current = len(self.workers)
+        desired, reason = self.policy.decide(current, obs, time.monotonic())
+        for name, value in obs._asdict().items():
+            if value is not None:
+                SUPERVISOR_SIGNALS.labels(name).set(value)
+        action = "up" if desired > current else "down" if desired < current else "hold"
+        SUPERVISOR_DECISIONS.labels(action, reason).inc()
+        message = (f"Scaling {action} {current} -> {desired} ({reason}): depth={obs.depth} "
+                   f"utilisation={obs.utilisation} model_latency={obs.model_latency}")
+        if action == "hold":
+            logging.debug(message)
+        else:
+            logging.info(message)
+        self.desired = desired
+        self._reconcile()
+
+    def stop(self, *_):
+        self._running = False
+
+    def run(self):
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if SUPERVISOR_METRICS_PORT:
+            start_http_server(SUPERVISOR_METRICS_PORT)
+            logging.info(f"Supervisor metrics on :{SUPERVISOR_METRICS_PORT}/metrics")
+        logging.info(f"Supervisor started ({self.policy.min_workers}..{self.policy.max_workers} workers)")
+        self._reconcile()
+        while self._running:
+            try:
+                self.step()
+            except Exception as e:
+                logging.error(f"Supervisor step failed: {type(e).__name__}: {e}")
+            deadline = time.monotonic() + self.interval
+            while self._running and time.monotonic() < deadline:
+                time.sleep(0.2)
+                self._reap()
+
+        logging.info("Supervisor shutting down - draining all workers")
+        for slot in list(self.workers):
+            self._retire(slot)
+        while self.draining:
+            self._reap()
+            time.sleep(0.2)
+        if self._client is not None:
+            self._client.close()
+
+
+if __name__ == "__main__":
+    Supervisor().run()
@@ -0,0 +1,72 @@
+"""Envelope of image_requests tasks.
+
+x-version 1.0: the ImageRequestPrompt as JSON, with an inline image base64-encoded in image_url.
+x-version 2.0: the task fields travel in AMQP headers and the body is the raw image (optionally
+zstd-compressed). The body is empty when the image is referenced by image_ref or an http(s) URL.
+Priority and x-enqueued-at are ordinary message properties/headers in both versions.
+"""
+import base64
+from typing import Optional, Tuple
+
+from app.config import WIRE_COMPRESSION, WIRE_COMPRESS_MIN_BYTES, WIRE_FORMAT
+from app.models import ImageRequestPrompt
+
+WIRE_VERSION = "2.0"
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("WIRE_COMPRESSION=zstd requires zstandard (pip install zstandard)") from e
+    return zstandard
+
+
+def is_binary(headers: Optional[dict]) -> bool:
+    return str((headers or {}).get("x-version", "1.0")).startswith("2.")
+
+
+def encode_task(task: ImageRequestPrompt, image: Optional[bytes] = None,
+                wire_format: str = WIRE_FORMAT, compression: str = WIRE_COMPRESSION) -> Tuple[bytes, dict, str]:
+    """(body, headers, content_type) for publishing a task; image is the raw upload when it travels inline"""
+    if wire_format == "json":
+        if image is not None:
+            task = task.model_copy(update={"image_url": base64.b64encode(image).decode("utf-8")})
+        return task.model_dump_json().encode("utf-8"), {"x-version": "1.0"}, "application/json"
+
+    headers = {"x-version": WIRE_VERSION, "x-conversation-id": task.conversation_id,
+               "x-include-items": task.include_items}
+    if task.image_ref:
+        headers["x-image-ref"] = task.image_ref
+    if task.image_url:
+        headers["x-image-url"] = task.image_url
+    if task.deadline is not None:
+        headers["x-deadline"] = task.deadline
+    body = bytes(image or b"")
+    if compression == "zstd" and len(body) >= WIRE_COMPRESS_MIN_BYTES:
+        compressed = _zstd().ZstdCompressor(level=3).compress(body)
+        # JPEG/WebP barely shrink; only pay the decompression when it saves something
+        if len(compressed) < len(body) * 0.9:
+            body = compressed
+            headers["x-content-encoding"] = "zstd"
+    return body, headers, "application/octet-stream"
+
+
+def decode_task(headers: dict, body: bytes) -> Tuple[ImageRequestPrompt, Optional[memoryview]]:
+    """Inverse of encode_task for x-version 2.0; the image is a view on the delivery body, not a copy"""
+    image = memoryview(body)
+    if headers.get("x-content-encoding") == "zstd":
+        image = memoryview(_zstd().ZstdDecompressor().decompress(body))
+    task = ImageRequestPrompt(
+        conversation_id=_text(headers["x-conversation-id"]),
+        include_items=_text(headers["x-include-items"]),
+        image_ref=_text(headers.get("x-image-ref")),
+        image_url=_text(headers.get("x-image-url")) or "",
+        deadline=headers.get("x-deadline"),
+    )
+    return task, (image if len(image) else None)
+
+
+def _text(value) -> Optional[str]:
+    # AMQP long strings can arrive as bytes, depending on the client library
+    return value.decode("utf-8") if isinstance(value, bytes) else value
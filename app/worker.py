@@ -1,112 +1,488 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import base64
+import functools
+import signal
+import sqlite3
+import threading
 import pika
-from app.rabbitmq import RabbitMQClient
-from app.agent import LangGraphAgent
-from app.models import ImageRequest, ImageRequestPrompt
+import requests
+from app.rabbitmq import DEAD_LETTER_QUEUE, RabbitMQClient, retry_queue
+from app.agent import ExtractionError, LangGraphAgent
+from app.inference import RETRYABLE_STATUS, InferenceError
+from app.models import FollowUpRequest, ImageRequest, ImageRequestPrompt
+from app.wire import decode_task, is_binary
+from app.cache import ExtractionCache, extraction_key
+from app.config import WORKER_CONCURRENCY, WORKER_PREFETCH, CACHE_ENABLED, PREPROCESS_ENABLED, QUEUE_DEPTH_INTERVAL, CASCADE_ROUTER
+from app.config import PART_CONCURRENCY, WORKER_DRAIN_TIMEOUT, RETRY_DELAYS, RABBITMQ_RECONNECT_MAX
+from app.preprocess import ImagePreprocessor, sniff_mime, to_data_url
+from app.documents import merge_receipts, split_document
+from app.blobstore import create_blob_store
+from app.concurrency import limiter_stats
+from app.metrics import DEAD_LETTERS, ERRORS, INFLIGHT, QUEUE_DEPTH, RETRIES, TASKS, TASKS_ENQUEUED
+from app.metrics import lane_of, observe_queue_wait, register_stats, timed
+from app.profiler import install_signal_toggle
+from app.config import WORKER_METRICS_PORT
+from prometheus_client import start_http_server
+from app import PROMPT_VERSION
 import logging
 import json
 import time
 
+
+def is_retryable(error: Exception) -> bool:
+    """Model server busy or unreachable, broker or SQLite hiccups: worth another attempt later.
+    Anything about the task itself (bad image, unusable model output, 4xx) would fail the same way again"""
+    if isinstance(error, InferenceError):
+        return error.status_code is None or error.status_code == 429 or error.status_code in RETRYABLE_STATUS
+    return isinstance(error, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout,
+                              sqlite3.OperationalError))
+
+
 class Worker:
-    def __init__(self):
+    def __init__(self, concurrency: int = None, prefetch_count: int = None, metrics_port: int = None):
         self.rabbitmq_client = RabbitMQClient()
         self.agent = LangGraphAgent()
         self.rabbitmq_client.add_shutdown_listener(self._handle_shutdown)
         self._running = True
+        self._stopped = threading.Event()  # wakes run() from its reconnect backoff
+
+        # Number of deliveries processed in parallel, and how many the broker may push ahead of acks
+        self.concurrency = max(1, concurrency or WORKER_CONCURRENCY)
+        self.prefetch_count = max(self.concurrency, prefetch_count or WORKER_PREFETCH)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="worker")
+        # Separate pool for the pages/strips of one task, so tasks never wait on their own pool
+        self._part_executor = ThreadPoolExecutor(max_workers=max(1, PART_CONCURRENCY), thread_name_prefix="part")
+        self._inflight = 0
+        self._inflight_lock = threading.Lock()
+
+        # Duplicate uploads are answered from here without calling the models
+        self.cache = ExtractionCache() if CACHE_ENABLED else None
+        # Downscale/recompress uploads per model stage before inference
+        self.preprocessor = ImagePreprocessor() if PREPROCESS_ENABLED else None
+        self.blob_store = create_blob_store()
+        self._last_stats_log = time.monotonic()
+        self._last_depth_sample = 0.0
+        self.metrics_port = WORKER_METRICS_PORT if metrics_port is None else metrics_port
 
     def _handle_shutdown(self, reason: str):
+        # run() reconnects with backoff; unacked deliveries go back to the queue
         logging.error(f"RabbitMQ connection lost: {reason}")
+
+    def stop(self):
+        """Graceful stop, safe from any thread or a signal handler: stop consuming, finish in-flight tasks, exit run()"""
         self._running = False
+        self._stopped.set()
+        connection = self.rabbitmq_client.connection
+        if connection is not None and connection.is_open:
+            connection.add_callback_threadsafe(self.rabbitmq_client.channel.stop_consuming)
 
     def callback(self, ch, method, properties, body):
+        """Hand the delivery to the thread pool; ack happens on the connection thread once results are published"""
+        connection = self.rabbitmq_client.connection
+        observe_queue_wait(method.routing_key, properties.headers, properties.priority)
+        self._sample_queue_depth(ch, method.routing_key)
+        with self._inflight_lock:
+            self._inflight += 1
+        INFLIGHT.labels('worker').inc()
+
+        future = self._executor.submit(self._handle_delivery, body, connection, properties)
+
+        def _on_done(fut):
+            # pika connections are not thread-safe, so publish/ack must run on the connection's own thread
+            try:
+                connection.add_callback_threadsafe(
+                    functools.partial(self._complete, ch, method.delivery_tag, fut)
+                )
+            except Exception as e:
+                # Connection already gone - the broker will redeliver the unacked message
+                logging.error(f"Cannot schedule ack for delivery {method.delivery_tag}: {e}")
+                self._release_slot()
+
+        future.add_done_callback(_on_done)
+
+    def _sample_queue_depth(self, ch, queue: str):
+        """Passive declare on the connection thread, at most every QUEUE_DEPTH_INTERVAL seconds"""
+        now = time.monotonic()
+        if now - self._last_depth_sample < QUEUE_DEPTH_INTERVAL:
+            return
+        self._last_depth_sample = now
+        try:
+            QUEUE_DEPTH.labels(queue).set(ch.queue_declare(queue=queue, passive=True).method.message_count)
+        except Exception as e:
+            logging.warning(f"Cannot sample depth of {queue}: {e}")
+
+    def _handle_delivery(self, body, connection=None, properties=None) -> tuple[list, list]:
+        """Runs on a pool thread. Returns the (queue, payload[, publish options]) messages to publish before
+        acking, and the cleanups (blob release, checkpoint removal) to run once they are published"""
+        headers = properties.headers if properties is not None else None
         try:
             # 先判断消息类型
             logging.info(f"Processing image")
+            if is_binary(headers):
+                # x-version 2.0: fields in headers, raw image body - no JSON parse or base64 over the image
+                request, image_bytes = decode_task(headers, body)
+                return self._image_task(request, connection, image_bytes, body, properties)
             raw_data = json.loads(body)
-            
-            if 'conversation_id' in raw_data and 'image_url' in raw_data:
+
+            if 'conversation_id' in raw_data and ('image_url' in raw_data or 'image_ref' in raw_data):
                 # 处理请求消息
                 request = ImageRequestPrompt.model_validate(raw_data)
-                self._process_image_request(request)
-            elif 'conversation_id' in raw_data and 'json_data' in raw_data:
-                # 处理响应消息（如果有）
-                self._handle_response(raw_data)
+                return self._image_task(request, connection, None, body, properties)
+            elif 'conversation_id' in raw_data and 'question' in raw_data:
+                # Follow-up question about a receipt extracted earlier (the API embeds its json_data)
+                request = FollowUpRequest.model_validate(raw_data)
+                return [self._process_followup(request)], []
             else:
                 logging.error(f"Unknown message format: {raw_data.keys()}")
-                
+                reason = f"Unknown message format: {list(raw_data)[:20]}"
+
         except json.JSONDecodeError as e:
             logging.error(f"Invalid JSON: {str(e)[:200]}")
+            reason = f"Invalid JSON: {e}"
         except Exception as e:
             logging.error(f"Unexpected error: {type(e).__name__}: {str(e)[:200]}")
             if 'raw_data' in locals():
                 logging.debug(f"Raw message: {raw_data}")
+            reason = f"{type(e).__name__}: {e}"
+        # No conversation to report to, but keep the message for inspection
+        return [self._dead_letter(body, properties, reason, 'unreadable')], []
+
+    def _image_task(self, request: ImageRequestPrompt, connection=None, image_bytes=None,
+                    body=None, properties=None) -> tuple[list, list]:
+        cleanups = [functools.partial(self.agent.clear_checkpoints, request.conversation_id)]
+        if request.image_ref and self.blob_store is not None:
+            cleanups.append(functools.partial(self.blob_store.release, request.image_ref, request.conversation_id))
+        with timed("total"):
+            try:
+                outcome = self._process_image_request(request, connection, image_bytes)
+            except Exception as e:
+                # No cleanups: a retry resumes from the checkpoints, and a replay of the dead letter needs the blob.
+                # Both expire on their own (CHECKPOINT_TTL_SECONDS, BLOB_TTL_SECONDS)
+                return self._failure(request, e, body, properties), []
+        return [outcome], cleanups
+
+    def _failure(self, request: ImageRequestPrompt, error: Exception, body=None, properties=None) -> list:
+        """Retryable errors go to the next delay queue. Fatal ones, and retryable ones out of attempts,
+        are reported on image_errors and parked in the dead-letter queue"""
+        ERRORS.labels(type(error).__name__).inc()
+        retries = int(((properties.headers if properties else None) or {}).get('x-retry-count', 0))
+        retryable = is_retryable(error)
+        if retryable and retries < len(RETRY_DELAYS) and body is not None:
+            RETRIES.labels(str(retries + 1)).inc()
+            logging.warning(f"{request.conversation_id} failed ({type(error).__name__}: {str(error)[:200]}) - "
+                            f"retry {retries + 1}/{len(RETRY_DELAYS)} in {RETRY_DELAYS[retries]:g}s")
+            return [self._retry_message(body, properties, retries + 1, error)]
+
+        if isinstance(error, ExtractionError):
+            # Not a result: publishing it as one would hide the failure from the client
+            TASKS.labels('json_error').inc()
+            error_msg = f"Extraction failed: {error}"
+            logging.warning(f"Model returned invalid JSON for {request.conversation_id}: {error}")
+        elif isinstance(error, json.JSONDecodeError):
+            TASKS.labels('json_error').inc()
+            error_msg = f"JSON parsing failed: {str(error)}"
+            logging.error(f"{error_msg}. Raw data: {error.doc[:200]}...")
+        else:
+            TASKS.labels('error').inc()
+            error_msg = f"Processing failed: {type(error).__name__}: {str(error)}"
+            logging.error(error_msg)
+        outcomes = [self._error_message(request.conversation_id, error_msg)]
+        if body is not None:
+            # Dead letter first: if it can't be parked the delivery is requeued before the client hears of
+            # the failure, so a requeue never reports it twice
+            kind = 'retries_exhausted' if retryable else 'fatal'
+            outcomes.insert(0, self._dead_letter(body, properties, error_msg, kind))
+        return outcomes
+
+    @staticmethod
+    def _republish_options(properties, headers: dict) -> dict:
+        """The original message properties, so binary tasks keep their header fields and their lane"""
+        return {"headers": headers, "priority": properties.priority if properties else None,
+                "content_type": (properties.content_type if properties else None) or 'application/json'}
+
+    def _retry_message(self, body, properties, attempt: int, error: Exception) -> tuple:
+        """The original message, bound for retry_queue(attempt); it comes back to image_requests when its TTL expires"""
+        headers = dict(properties.headers or {})
+        headers.update({
+            'x-retry-count': attempt,
+            'x-last-error': f"{type(error).__name__}: {error}"[:500],
+            # Queue wait counts from when the task is due again, not from the failed attempt
+            'x-enqueued-at': int((time.time() + RETRY_DELAYS[attempt - 1]) * 1000),
+        })
+        TASKS_ENQUEUED.labels(lane_of(properties.priority)).inc()
+        return retry_queue(attempt), body, self._republish_options(properties, headers)
 
-    def _process_image_request(self, request: ImageRequestPrompt):
-        """专用方法处理图片请求"""
+    def _dead_letter(self, body, properties, reason: str, kind: str) -> tuple:
+        """The original message plus why it failed, bound for image_requests.dead"""
+        headers = dict((properties.headers if properties else None) or {})
+        headers.update({
+            'x-failure-kind': kind,  # fatal, retries_exhausted or unreadable
+            'x-failure-reason': reason[:500],
+            'x-failed-at': int(time.time() * 1000),
+        })
+        DEAD_LETTERS.labels(kind).inc()
+        return DEAD_LETTER_QUEUE, body, self._republish_options(properties, headers)
+
+    def _complete(self, ch, delivery_tag, future):
+        """Runs on the connection thread: publish results in order, stopping at the first that fails, then ack
+        (or requeue if one failed)"""
         try:
-            # Log start of processing
-            logging.info(f"Starting image processing for conversation: {request.conversation_id}")
-            
-            raw_output = self.agent.process_image(request.image_url, request.include_items)
-
-            json_str = raw_output.strip().removeprefix("```json").removesuffix("```").strip()
-            json_data = json.loads(json_str)
-            
-            # Log parsed data
+            outcomes, cleanups = future.result()
+            with timed("publish"):
+                published = all(
+                    self.rabbitmq_client.publish(queue=queue, body=payload, **(options[0] if options else {}))
+                    for queue, payload, *options in outcomes
+                )
+            if not ch.is_open:
+                logging.error(f"Channel closed before ack of delivery {delivery_tag}")
+            elif published:
+                ch.basic_ack(delivery_tag=delivery_tag)
+                # Task is finished - the uploaded image and the graph checkpoints are no longer needed
+                for cleanup in cleanups:
+                    try:
+                        cleanup()
+                    except Exception as e:
+                        logging.warning(f"Cleanup after delivery {delivery_tag} failed: {e}")
+            else:
+                ch.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        except Exception as e:
+            logging.error(f"Failed to complete delivery {delivery_tag}: {type(e).__name__}: {e}")
+        finally:
+            self._release_slot()
+
+    def _release_slot(self):
+        with self._inflight_lock:
+            self._inflight -= 1
+        INFLIGHT.labels('worker').dec()
+        self._log_stats()
+
+    def _log_stats(self, interval: float = 60):
+        """Periodic snapshot of limiter/cache state for sizing replicas"""
+        now = time.monotonic()
+        if now - self._last_stats_log < interval:
+            return
+        self._last_stats_log = now
+        for name, stats in limiter_stats().items():
+            logging.info(f"Limiter {name}: {stats}")
+        if self.cache is not None:
+            logging.info(f"Extraction cache: {self.cache.stats()}")
+        if self.agent.checkpoints is not None:
+            logging.info(f"Checkpoints: {self.agent.checkpoints.stats()}")
+
+    def _process_image_request(self, request: ImageRequestPrompt, connection=None, image_bytes=None) -> tuple[str, str]:
+        """专用方法处理图片请求 (image_bytes: inline image of an x-version 2.0 task). Failures raise, see _failure"""
+        on_item = self._partial_publisher(request.conversation_id, connection) if connection else None
+        if request.deadline is not None and time.time() > request.deadline:
+            # The client has given up - don't spend two model calls on it
+            TASKS.labels('expired').inc()
+            late = time.time() - request.deadline
+            logging.warning(f"Dropping {request.conversation_id}: deadline passed {late:.1f}s ago")
+            return self._error_message(request.conversation_id,
+                                       f"Deadline exceeded {late:.1f}s before processing started", reason="timeout")
+
+        # Log start of processing
+        logging.info(f"Starting image processing for conversation: {request.conversation_id}")
+        trace = {}  # filled by the agent with the cascade route taken
+
+        if request.image_ref:
+            if self.blob_store is None:
+                raise ValueError("Received image_ref but BLOB_STORE is 'inline'")
+            with self.blob_store.open(request.image_ref) as image_bytes:
+                json_data, cached = self._extract_cached(request, image_bytes, on_item, trace)
+        else:
+            json_data, cached = self._extract_cached(request, image_bytes, on_item, trace)
+
+        # Log parsed data
+        if cached:
+            TASKS.labels('cached').inc()
+            logging.info(f"Cache hit for {request.conversation_id} ({self.cache.stats()})")
+        else:
+            TASKS.labels('success').inc()
             logging.info(f"Successfully processed receipt data for {request.conversation_id}:")
-            
-            response = {
+
+        response = {
+            "conversation_id": request.conversation_id,
+            "json_data": json_data,
+            "status": "completed",
+            "cached": cached,
+            "route": trace.get("route"),
+            "localize": trace.get("localize")  # single-image tasks only
+        }
+        return 'image_responses', json.dumps(response)
+
+    def _process_followup(self, request: FollowUpRequest) -> tuple[str, str]:
+        """One model call over the receipt JSON and the history the API sent along; keyed by question_id"""
+        try:
+            answer = self.agent.process_message(request.question, request.json_data, request.history)
+            TASKS.labels('followup').inc()
+            return 'followup_responses', json.dumps({
                 "conversation_id": request.conversation_id,
-                "json_data": json_data,
+                "question_id": request.question_id,
+                "question": request.question,
+                "answer": answer,
                 "status": "completed"
-            }
-            
-            # Publish and log result
-            if self.rabbitmq_client.publish(
-                queue='image_responses',
-                body=json.dumps(response)
-            ):
-                logging.info(f"Successfully published response for {request.conversation_id}")
-            else:
-                logging.error(f"Failed to publish response for {request.conversation_id}")
-                
-        except json.JSONDecodeError as e:
-            error_msg = f"JSON parsing failed: {str(e)}"
-            logging.error(f"{error_msg}. Raw data: {raw_output[:200]}...")
-            self._publish_error(request.conversation_id, error_msg)
-            
+            })
         except Exception as e:
-            error_msg = f"Processing failed: {type(e).__name__}: {str(e)}"
-            logging.error(error_msg)
-            self._publish_error(request.conversation_id, error_msg)
+            TASKS.labels('error').inc()
+            ERRORS.labels(type(e).__name__).inc()
+            logging.error(f"Follow-up {request.question_id} failed: {type(e).__name__}: {e}")
+            return self._error_message(request.question_id, f"Follow-up failed: {type(e).__name__}: {e}")
 
-    def _publish_error(self, conversation_id: str, error_msg: str):
-        """统一错误发布方法"""
+    def _partial_publisher(self, conversation_id: str, connection):
+        """Callback that forwards each streamed line item to image_partials from the connection thread"""
+        index = 0
+
+        def _emit(item):
+            nonlocal index
+            body = json.dumps({
+                "conversation_id": conversation_id,
+                "index": index,
+                "item": item,
+                "status": "partial"
+            })
+            index += 1
+            try:
+                connection.add_callback_threadsafe(
+                    # Only useful while a client is watching, so it expires from a replica's queue after a minute
+                    functools.partial(self.rabbitmq_client.publish, 'image_partials', body, persistent=False,
+                                      expiration='60000')
+                )
+            except Exception as e:
+                logging.warning(f"Dropping partial item for {conversation_id}: {e}")
+        return _emit
+
+    def _extract(self, request: ImageRequestPrompt, image_bytes: bytes = None, on_item=None, trace: dict = None):
+        """Run the model calls and parse the result; PDF pages and long-receipt strips run concurrently"""
+        if image_bytes is None:
+            return self._extract_part(request, None, on_item, trace, request.conversation_id).model_dump(exclude_none=True)
+        with timed("split"):
+            parts = split_document(image_bytes)
+        if len(parts) == 1:
+            return self._extract_part(request, parts[0].data, on_item, trace,
+                                      request.conversation_id).model_dump(exclude_none=True)
+
+        # Streamed items from parallel parts would interleave and repeat in the overlaps, so only the merge is published
+        started = time.perf_counter()
+        traces = [{} for _ in parts]
+        futures = [self._part_executor.submit(self._extract_part, request, part.data, None, part_trace,
+                                              f"{request.conversation_id}/{part.page}.{part.strip}")
+                   for part, part_trace in zip(parts, traces)]
+        receipt = merge_receipts(parts, [future.result() for future in futures])
+        if trace is not None:
+            routes = [t.get("route") for t in traces]
+            trace["route"] = next((r for r in routes if r != "direct"), "direct")
+            trace["parts"] = len(parts)
+        logging.info(f"{request.conversation_id}: {len(parts)} parts extracted in "
+                     f"{(time.perf_counter() - started) * 1000:.0f}ms, {len(receipt.items)} items after merge")
+        return receipt.model_dump(exclude_none=True)
+
+    def _extract_part(self, request: ImageRequestPrompt, image_bytes=None, on_item=None, trace: dict = None,
+                      thread_id: str = None):
+        """Both model stages for one image (a whole upload, a PDF page or a strip), checkpointed under thread_id"""
+        image_url, ocr_image_url = request.image_url, None
+        if self.preprocessor is not None and image_bytes is not None:
+            with timed("preprocess"):
+                stage_urls, report = self.preprocessor.run(image_bytes)
+            image_url, ocr_image_url = stage_urls["extract"], stage_urls["ocr"]
+            localized = report.get("localize")
+            if localized:
+                logging.info(f"{thread_id}: receipt {localized['outcome']}, crop ratio {localized['crop_ratio']}, "
+                             f"confidence {localized['confidence']}, {localized['elapsed_ms']}ms")
+                if trace is not None:
+                    trace["localize"] = {k: localized[k] for k in ("outcome", "crop_ratio", "elapsed_ms")}
+        elif image_bytes is not None:
+            image_url = to_data_url(image_bytes, sniff_mime(image_bytes))
+
+        started = time.perf_counter()
+        receipt = self.agent.process_image(image_url, request.include_items, ocr_image_url=ocr_image_url,
+                                           on_item=on_item, trace=trace, thread_id=thread_id)
+        logging.info(f"Model calls for {request.conversation_id} took {(time.perf_counter() - started) * 1000:.0f}ms"
+                     f" (preprocessed={ocr_image_url is not None})")
+        return receipt
+
+    def _extract_cached(self, request: ImageRequestPrompt, image_bytes=None, on_item=None, trace: dict = None) -> tuple:
+        """Returns (json_data, cached); concurrent duplicates of the same image share one inference"""
+        if image_bytes is None and not request.image_url.startswith(('http://', 'https://')):
+            image_bytes = base64.b64decode(request.image_url)
+        if self.cache is None:
+            return self._extract(request, image_bytes, on_item, trace), False
+
+        models = (self.agent.olm_model, self.agent.model, CASCADE_ROUTER,
+                  self.preprocessor.signature() if self.preprocessor else "raw")
+        key = extraction_key(image_bytes or request.image_url.encode('utf-8'), request.include_items,
+                             models, PROMPT_VERSION)
+        return self.cache.get_or_compute(key, lambda: self._extract(request, image_bytes, on_item, trace))
+
+    def _error_message(self, conversation_id: str, error_msg: str, reason: str = None) -> tuple[str, str]:
+        """统一错误消息格式"""
         error_data = {
             "conversation_id": conversation_id or "unknown",
             "error": error_msg[:500],  # 限制长度
             "timestamp": datetime.now().isoformat()
         }
-        self.rabbitmq_client.publish(
-            queue='image_errors',
-            body=json.dumps(error_data))
+        if reason:
+            error_data["reason"] = reason
+        return 'image_errors', json.dumps(error_data)
+
+    def _publish_error(self, conversation_id: str, error_msg: str):
+        """统一错误发布方法"""
+        queue, body = self._error_message(conversation_id, error_msg)
+        self.rabbitmq_client.publish(queue=queue, body=body)
+
+    def _drain(self, timeout: float = WORKER_DRAIN_TIMEOUT):
+        """Keep servicing the connection until in-flight deliveries are published and acked"""
+        deadline = time.monotonic() + timeout
+        connection = self.rabbitmq_client.connection
+        while self._inflight > 0 and time.monotonic() < deadline:
+            if not connection or not connection.is_open:
+                break
+            connection.process_data_events(time_limit=0.5)
+        if self._inflight > 0:
+            logging.warning(f"Shutting down with {self._inflight} unacked deliveries (will be redelivered)")
+
+    def _start_metrics(self):
+        """Prometheus endpoint on WORKER_METRICS_PORT plus the SIGUSR2 profiler toggle"""
+        register_stats("receipt_limiter", limiter_stats, label="limiter")
+        if self.cache is not None:
+            register_stats("receipt_cache", self.cache.stats)
+        if self.agent.checkpoints is not None:
+            register_stats("receipt_checkpoints", self.agent.checkpoints.stats)
+        if self.metrics_port:
+            start_http_server(self.metrics_port)
+            logging.info(f"Worker metrics on :{self.metrics_port}/metrics")
+        install_signal_toggle()
+        if threading.current_thread() is threading.main_thread():
+            # SIGTERM (docker stop, supervisor scale-down) drains instead of dropping in-flight work
+            signal.signal(signal.SIGTERM, lambda _signum, _frame: self.stop())
+
     def run(self):
-        logging.basicConfig(level=logging.INFO)
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+        self._start_metrics()
+        delay = 1
         while self._running:
             try:
                 if not self.rabbitmq_client.connect():
-                    time.sleep(5)
+                    logging.info(f"Reconnecting to RabbitMQ in {delay}s")
+                    self._stopped.wait(delay)  # stop() cuts the backoff short
+                    delay = min(delay * 2, RABBITMQ_RECONNECT_MAX)
                     continue
-                    
+                delay = 1
+
+                self.rabbitmq_client.channel.basic_qos(prefetch_count=self.prefetch_count)
                 self.rabbitmq_client.channel.basic_consume(
                     queue='image_requests',
                     on_message_callback=self.callback,
-                    auto_ack=True
+                    auto_ack=False
                 )
-                
-                logging.info("Worker started - Waiting for image tasks")
+
+                logging.info(f"Worker started - Waiting for image tasks "
+                             f"(concurrency={self.concurrency}, prefetch={self.prefetch_count})")
                 try:
                     self.rabbitmq_client.channel.start_consuming()
+                    if not self._running:
+                        logging.info("Worker stopping - finishing in-flight tasks")
+                        self._drain()
                 except pika.exceptions.ConnectionClosedByBroker:
                     logging.error("Connection closed by broker")
                     continue
@@ -116,16 +492,24 @@ class Worker:
                 except pika.exceptions.AMQPConnectionError:
                     logging.error("Connection was closed")
                     continue
-                
+
             except KeyboardInterrupt:
                 self._running = False
                 logging.info("Worker shutting down...")
+                try:
+                    self.rabbitmq_client.channel.stop_consuming()
+                    self._drain()
+                except Exception as e:
+                    logging.error(f"Drain failed: {e}")
                 break
             except Exception as e:
                 logging.critical(f"Unexpected error: {e}")
-                time.sleep(5)  # Prevent tight loop on persistent errors
+                self._stopped.wait(delay)  # Prevent tight loop on persistent errors
+                delay = min(delay * 2, RABBITMQ_RECONNECT_MAX)
             finally:
                 self.rabbitmq_client.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._part_executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
-    Worker().run()
\ No newline at end of file
+    Worker().run()
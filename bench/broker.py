@@ -0,0 +1,345 @@
+"""In-process stand-in for RabbitMQ, covering the subset of pika's BlockingConnection API the app uses.
+
+Install with `install()` before the app connects; every RabbitMQClient then talks to one shared
+InMemoryBroker. Deliveries, acks and add_callback_threadsafe callbacks run on the thread that calls
+start_consuming/process_data_events, as with pika.
+"""
+import collections
+import itertools
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, Optional
+
+import pika
+
+
+class _Queue:
+    def __init__(self, name: str, arguments: Optional[dict]):
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages = collections.deque()  # (body, properties, redelivered, routing_key)
+        self.consumers = []
+        self.published = 0
+        self.bytes_total = 0  # body plus encoded properties, the task payload travels in the headers
+        self.bytes_max = 0
+        self.header_bytes_total = 0
+        self.depth_max = 0
+
+    def stats(self) -> dict:
+        return {
+            "published": self.published,
+            "depth": len(self.messages),
+            "depth_max": self.depth_max,
+            "bytes_total": self.bytes_total,
+            "bytes_max": self.bytes_max,
+            "bytes_avg": self.bytes_total / self.published if self.published else 0,
+            "header_bytes_total": self.header_bytes_total,
+            "header_bytes_avg": self.header_bytes_total / self.published if self.published else 0,
+        }
+
+
+class InMemoryBroker:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues: Dict[str, _Queue] = {}
+        self.bindings: Dict[tuple, set] = collections.defaultdict(set)  # (exchange, routing key) -> queue names
+        self._names = itertools.count(1)
+
+    def declare(self, name: str, arguments: Optional[dict] = None, passive: bool = False) -> _Queue:
+        with self.cond:
+            name = name or f"amq.gen-{next(self._names)}"
+            if name not in self.queues:
+                if passive:
+                    raise pika.exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{name}'")
+                self.queues[name] = _Queue(name, arguments)
+            return self.queues[name]
+
+    def bind(self, queue: str, exchange: str, routing_key: str):
+        with self.cond:
+            self.bindings[(exchange, routing_key)].add(queue)
+
+    def delete(self, name: str):
+        with self.cond:
+            self.queues.pop(name, None)
+            for queues in self.bindings.values():
+                queues.discard(name)
+
+    def publish(self, routing_key: str, body: bytes, properties, exchange: str = '') -> bool:
+        """Direct exchanges only: the default one routes by queue name, named ones through their bindings"""
+        with self.cond:
+            names = self.bindings.get((exchange, routing_key), ()) if exchange else (routing_key,)
+            targets = [self.queues[name] for name in names if name in self.queues]
+            if not targets:
+                return False  # unroutable
+            properties = properties or pika.BasicProperties()
+            header_size = sum(len(chunk) for chunk in properties.encode())
+            entry = (body, properties, False, routing_key)
+            for target in targets:
+                if target.arguments.get('x-max-priority') and properties.priority:
+                    # Ahead of everything with a lower priority, behind its equals (FIFO within a priority)
+                    index = next((i for i, queued in enumerate(target.messages)
+                                  if (queued[1].priority or 0) < properties.priority), len(target.messages))
+                    target.messages.insert(index, entry)
+                else:
+                    target.messages.append(entry)
+                target.published += 1
+                target.bytes_total += len(body) + header_size
+                target.bytes_max = max(target.bytes_max, len(body) + header_size)
+                target.header_bytes_total += header_size
+                target.depth_max = max(target.depth_max, len(target.messages))
+            self.cond.notify_all()
+        for target in targets:
+            ttl = target.arguments.get('x-message-ttl')
+            dead_letter_key = target.arguments.get('x-dead-letter-routing-key')
+            if ttl is not None and dead_letter_key:
+                timer = threading.Timer(ttl / 1000, self._expire, (target, entry, dead_letter_key))
+                timer.daemon = True
+                timer.start()
+        return True
+
+    def _expire(self, target: _Queue, entry: tuple, routing_key: str):
+        """TTL ran out: move the message on through the default exchange, as RabbitMQ's dead-lettering does"""
+        with self.cond:
+            index = next((i for i, queued in enumerate(target.messages) if queued is entry), None)
+            if index is None:
+                return  # consumed before it expired
+            del target.messages[index]
+        body, properties, _, _ = entry
+        self.publish(routing_key, body, properties)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {name: q.stats() for name, q in self.queues.items()}
+
+
+BROKER = InMemoryBroker()
+
+
+class FakeChannel:
+    def __init__(self, connection: "FakeBlockingConnection"):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_open = True
+        self._prefetch = 0
+        self._consumers = []  # (queue, callback, auto_ack)
+        self._unacked: Dict[int, tuple] = {}  # delivery_tag -> (queue, entry)
+        self._exclusive = []  # queue names deleted when the channel closes
+        self._tags = itertools.count(1)
+        self._consuming = False
+
+    def queue_declare(self, queue: str, durable: bool = False, arguments: dict = None, passive: bool = False,
+                      exclusive: bool = False, **kwargs):
+        declared = self.broker.declare(queue, arguments, passive)
+        if exclusive:
+            self._exclusive.append(declared.name)
+        with self.broker.cond:
+            return SimpleNamespace(method=SimpleNamespace(
+                queue=declared.name, message_count=len(declared.messages), consumer_count=len(declared.consumers)))
+
+    def exchange_declare(self, exchange: str, exchange_type: str = 'direct', **kwargs):
+        if exchange_type != 'direct':
+            raise NotImplementedError(f"{exchange_type} exchanges")
+
+    def queue_bind(self, queue: str, exchange: str, routing_key: str = None, **kwargs):
+        self.broker.bind(queue, exchange, routing_key or queue)
+
+    def confirm_delivery(self):
+        pass  # every publish lands (or raises) synchronously
+
+    def basic_qos(self, prefetch_count: int = 0, **kwargs):
+        self._prefetch = prefetch_count
+
+    def basic_consume(self, queue: str, on_message_callback: Callable, auto_ack: bool = False, **kwargs):
+        target = self.broker.declare(queue, passive=True)
+        with self.broker.cond:
+            target.consumers.append(self)
+        self._consumers.append((target, on_message_callback, auto_ack))
+        return f"ctag-{id(self)}-{queue}"
+
+    def basic_publish(self, exchange: str, routing_key: str, body, properties=None, mandatory: bool = False):
+        if not self.is_open:
+            raise pika.exceptions.ChannelWrongStateError("Channel is closed.")
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if not self.broker.publish(routing_key, bytes(body), properties, exchange) and mandatory:
+            raise pika.exceptions.UnroutableError([])
+
+    def basic_get(self, queue: str, auto_ack: bool = False):
+        target = self.broker.declare(queue, passive=True)
+        with self.broker.cond:
+            if not target.messages:
+                return None, None, None
+            entry = target.messages.popleft()
+        body, properties, redelivered, routing_key = entry
+        tag = next(self._tags)
+        if not auto_ack:
+            self._unacked[tag] = (target, entry)
+        method = SimpleNamespace(delivery_tag=tag, routing_key=routing_key, redelivered=redelivered, exchange="")
+        return method, properties, body
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self._unacked.pop(delivery_tag, None)
+        with self.broker.cond:
+            self.broker.cond.notify_all()
+
+    def basic_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        unacked = self._unacked.pop(delivery_tag, None)
+        if unacked and requeue:
+            target, (body, properties, _, routing_key) = unacked
+            with self.broker.cond:
+                target.messages.appendleft((body, properties, True, routing_key))
+                self.broker.cond.notify_all()
+
+    def basic_reject(self, delivery_tag: int, requeue: bool = True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def start_consuming(self):
+        self._consuming = True
+        while self._consuming and self.is_open and self.connection.is_open:
+            self.connection.process_data_events(time_limit=0.2)
+
+    def stop_consuming(self, consumer_tag=None):
+        self._consuming = False
+
+    def _deliverable(self) -> list:
+        """Pop messages this channel may receive now (prefetch permitting). Caller holds broker.cond"""
+        batch = []
+        for target, callback, auto_ack in self._consumers:
+            while target.messages and (auto_ack or not self._prefetch
+                                       or len(self._unacked) + len(batch) < self._prefetch):
+                batch.append((target, callback, auto_ack, target.messages.popleft()))
+        return batch
+
+    def _dispatch(self, batch: list):
+        for target, callback, auto_ack, entry in batch:
+            body, properties, redelivered, routing_key = entry
+            tag = next(self._tags)
+            if not auto_ack:
+                self._unacked[tag] = (target, entry)
+            method = SimpleNamespace(delivery_tag=tag, routing_key=routing_key, redelivered=redelivered, exchange="")
+            callback(self, method, properties, body)
+
+    def close(self):
+        if not self.is_open:
+            return
+        self.is_open = False
+        with self.broker.cond:
+            for target, _, _ in self._consumers:
+                if self in target.consumers:
+                    target.consumers.remove(self)
+            # Unacked messages go back to their queues, as on a real broker
+            for target, (body, properties, _, routing_key) in self._unacked.values():
+                target.messages.appendleft((body, properties, True, routing_key))
+            self._unacked.clear()
+            self.broker.cond.notify_all()
+        for name in self._exclusive:
+            self.broker.delete(name)
+
+
+class FakeBlockingConnection:
+    def __init__(self, parameters=None, broker: InMemoryBroker = None):
+        self.broker = broker or BROKER
+        self.is_open = True
+        self._channels = []
+        self._callbacks: "queue.SimpleQueue[Callable]" = queue.SimpleQueue()
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def channel(self) -> FakeChannel:
+        channel = FakeChannel(self)
+        self._channels.append(channel)
+        return channel
+
+    def add_callback_threadsafe(self, callback: Callable):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionWrongStateError("BlockingConnection.add_callback_threadsafe() called on closed connection")
+        self._callbacks.put(callback)
+        with self.broker.cond:
+            self.broker.cond.notify_all()
+
+    def process_data_events(self, time_limit: float = 0):
+        deadline = time.monotonic() + (time_limit or 0)
+        while True:
+            ran = self._run_callbacks()
+            with self.broker.cond:
+                batches = [(ch, ch._deliverable()) for ch in self._channels if ch.is_open]
+                if not ran and not any(batch for _, batch in batches):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    self.broker.cond.wait(min(remaining, 0.05))
+                    continue
+            for channel, batch in batches:
+                channel._dispatch(batch)
+            if time.monotonic() >= deadline:
+                return
+
+    def _run_callbacks(self) -> bool:
+        ran = False
+        while True:
+            try:
+                callback = self._callbacks.get_nowait()
+            except queue.Empty:
+                return ran
+            callback()
+            ran = True
+
+    def sleep(self, duration: float):
+        self.process_data_events(time_limit=duration)
+
+    def close(self):
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+
+def install(broker: InMemoryBroker = BROKER) -> InMemoryBroker:
+    """Route every pika.BlockingConnection in this process to the in-memory broker"""
+    pika.BlockingConnection = lambda parameters=None: FakeBlockingConnection(parameters, broker)
+    return broker
+
+
+class InProcessPublisher:
+    """Drop-in for AsyncRabbitMQPublisher that publishes straight into the in-memory broker"""
+    def __init__(self, host: str = None, broker: InMemoryBroker = BROKER, **kwargs):
+        self.broker = broker
+        self.is_connected = False
+
+    def start(self):
+        from app.rabbitmq import QUEUE_ARGUMENTS
+        for name, arguments in QUEUE_ARGUMENTS.items():
+            self.broker.declare(name, arguments)
+        self.is_connected = True
+
+    async def publish(self, queue: str, body: bytes, headers: dict = None, content_type: str = 'application/json',
+                      persistent: bool = True, priority: int = None, **kwargs):
+        properties = pika.BasicProperties(headers=headers or {'x-version': '1.0'}, content_type=content_type,
+                                          delivery_mode=2 if persistent else 1, priority=priority)
+        if not self.broker.publish(queue, body, properties):
+            raise pika.exceptions.UnroutableError([])
+
+    async def publish_batch(self, queue: str, messages: list, **kwargs) -> list:
+        results = []
+        for body, options in messages:
+            try:
+                await self.publish(queue, body, **(kwargs | options))
+                results.append(None)
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def publish_image_task(self, request, **kwargs):
+        body = request.encode('utf-8') if isinstance(request, str) else request
+        await self.publish('image_requests', body, **kwargs)
+
+    async def queue_depth(self, queue: str) -> int:
+        declared = self.broker.declare(queue, passive=True)
+        with self.broker.cond:
+            return len(declared.messages)
+
+    async def close(self, drain_timeout: float = 0):
+        self.is_connected = False
@@ -0,0 +1,61 @@
+"""Diff two bench.run reports: python -m bench.compare bench_results/before.json bench_results/after.json"""
+import argparse
+import json
+
+
+def _delta(before, after) -> str:
+    if not before:
+        return ""
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def _row(name: str, before, after, unit: str = ""):
+    if before is None and after is None:
+        return
+    fmt = (lambda v: "-" if v is None else f"{v:.3f}{unit}")
+    print(f"  {name:<42} {fmt(before):>12} {fmt(after):>12} {_delta(before, after) if before is not None and after is not None else '':>9}")
+
+
+def compare(before: dict, after: dict):
+    print(f"before: {before['commit']} {before.get('label', '')}  ({before['timestamp']})")
+    print(f"after:  {after['commit']} {after.get('label', '')}  ({after['timestamp']})")
+
+    print("\nthroughput")
+    _row("receipts/s", before["throughput_per_second"], after["throughput_per_second"])
+    _row("wall", before["wall_seconds"], after["wall_seconds"], "s")
+
+    print("\nend to end")
+    for q in ("p50", "p95", "p99"):
+        _row(q, before["end_to_end"].get(q), after["end_to_end"].get(q), "s")
+
+    print("\nstages (p50 / p95)")
+    for stage in sorted(set(before["stages"]) | set(after["stages"])):
+        b, a = before["stages"].get(stage, {}), after["stages"].get(stage, {})
+        for q in ("p50", "p95"):
+            _row(f"{stage} {q}", b.get(q), a.get(q), "s")
+
+    print("\nmessages and memory")
+    for queue in sorted(set(before["broker"]) | set(after["broker"])):
+        b, a = before["broker"].get(queue, {}), after["broker"].get(queue, {})
+        _row(f"{queue} avg bytes", b.get("bytes_avg"), a.get("bytes_avg"))
+        _row(f"{queue} avg header bytes", b.get("header_bytes_avg"), a.get("header_bytes_avg"))
+    _row("peak RSS MiB", before["memory"]["rss_peak_bytes"] / 2**20, after["memory"]["rss_peak_bytes"] / 2**20)
+
+    if before["outcomes"] != after["outcomes"]:
+        print(f"\noutcomes differ: {before['outcomes']} -> {after['outcomes']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args(argv)
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    compare(before, after)
+
+
+if __name__ == "__main__":
+    main()
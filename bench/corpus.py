@@ -0,0 +1,48 @@
+"""Synthetic receipt images: phone-photo sized JPEGs and PNG screenshots with printed line items."""
+import io
+import random
+from typing import List, Tuple
+
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def render_receipt(rng: random.Random, size: Tuple[int, int], fmt: str) -> bytes:
+    width, height = size
+    # Receipt paper on a darker "table", like a phone photo
+    image = Image.new("RGB", size, (rng.randint(60, 120),) * 3)
+    draw = ImageDraw.Draw(image)
+    left, top = int(width * rng.uniform(0.15, 0.3)), int(height * rng.uniform(0.05, 0.15))
+    right, bottom = width - int(width * rng.uniform(0.15, 0.3)), height - int(height * rng.uniform(0.05, 0.15))
+    draw.rectangle((left, top, right, bottom), fill=(245, 245, 240))
+
+    line_height = max(12, (bottom - top) // 40)
+    y = top + line_height
+    draw.text((left + 20, y), "STUB MART  #%04d" % rng.randint(0, 9999), fill=(20, 20, 20))
+    for _ in range(rng.randint(5, 25)):
+        y += line_height
+        if y > bottom - 3 * line_height:
+            break
+        draw.text((left + 20, y), f"ITEM {rng.randint(100, 999)}", fill=(30, 30, 30))
+        draw.text((right - 120, y), f"{rng.uniform(1, 60):7.2f}", fill=(30, 30, 30))
+    draw.text((left + 20, bottom - 2 * line_height), f"TOTAL {rng.uniform(20, 400):.2f}", fill=(0, 0, 0))
+
+    if fmt == "JPEG":
+        image = image.filter(ImageFilter.GaussianBlur(0.8))  # camera softness, makes JPEGs realistically large
+    buffer = io.BytesIO()
+    image.save(buffer, format=fmt, quality=92)
+    return buffer.getvalue()
+
+
+def build_corpus(count: int, seed: int = 0, photo_ratio: float = 0.7, duplicate_ratio: float = 0.0) -> List[Tuple[str, bytes]]:
+    """[(filename, bytes)]: photo_ratio 12MP JPEGs, the rest 1080x2400 PNG screenshots"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        if corpus and rng.random() < duplicate_ratio:
+            corpus.append(rng.choice(corpus))
+            continue
+        if rng.random() < photo_ratio:
+            corpus.append((f"receipt_{i:04d}.jpg", render_receipt(rng, (3024, 4032), "JPEG")))
+        else:
+            corpus.append((f"receipt_{i:04d}.png", render_receipt(rng, (1080, 2400), "PNG")))
+    return corpus
@@ -0,0 +1,239 @@
+"""Offline end-to-end benchmark: main.app + Worker threads + in-memory broker + stub model server.
+
+    python -m bench.run --receipts 100 --clients 8 --workers 2 --worker-concurrency 4
+    python -m bench.run --env PREPROCESS_ENABLED=0 --label no-preprocess
+
+Writes bench_results/<timestamp>_<commit>.json; compare runs with `python -m bench.compare a.json b.json`.
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from prometheus_client.metrics import Histogram
+
+from bench.broker import BROKER, InProcessPublisher, install
+from bench.corpus import build_corpus
+from bench.stub_model import ModelProfile, StubModelServer
+
+# Every histogram observation in the process (stage timers, queue wait, model calls), for exact percentiles
+SAMPLES = defaultdict(list)
+_observe = Histogram.observe
+
+
+def _capture(self, amount, exemplar=None):
+    SAMPLES[(self._name, self._labelvalues)].append(amount)
+    return _observe(self, amount, exemplar)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {"count": len(ordered), "mean": sum(ordered) / len(ordered),
+            "p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": ordered[-1]}
+
+
+class MemorySampler:
+    """Peak RSS of the whole process (API + workers + broker) sampled every 50ms"""
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _rss(self) -> int:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def _run(self):
+        while not self._stop.wait(0.05):
+            self.peak = max(self.peak, self._rss())
+
+    def start(self):
+        self.peak = self._rss()
+        self._thread.start()
+
+    def stop(self) -> dict:
+        self._stop.set()
+        self._thread.join()
+        return {"rss_peak_bytes": self.peak,
+                "ru_maxrss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--receipts", type=int, default=40)
+    parser.add_argument("--clients", type=int, default=8, help="concurrent uploading clients (closed loop)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker instances (threads in this process)")
+    parser.add_argument("--worker-concurrency", type=int, default=4)
+    parser.add_argument("--photo-ratio", type=float, default=0.7)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0)
+    parser.add_argument("--ocr-ms", type=float, default=800, help="olmOCR median time to first token")
+    parser.add_argument("--gemma-ms", type=float, default=400, help="Gemma median time to first token")
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--need-ocr-rate", type=float, default=0.3,
+                        help="fraction of receipts the stub Gemma sends on to olmOCR (handwriting)")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="fraction of unconstrained stub answers cut off mid-item (run with --env STRUCTURED_OUTPUT=off)")
+    parser.add_argument("--result-timeout", type=float, default=120)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="override app configuration, e.g. --env GEMMA_STREAM=0")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--output-dir", default="bench_results")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+
+    stub = StubModelServer({
+        "ocr": ModelProfile(args.ocr_ms, args.latency_sigma, args.tokens_per_second, error_rate=args.error_rate),
+        "gemma": ModelProfile(args.gemma_ms, args.latency_sigma, args.tokens_per_second, error_rate=args.error_rate,
+                              need_ocr_rate=args.need_ocr_rate, malformed_rate=args.malformed_rate),
+    }, seed=args.seed).start()
+
+    workdir = tempfile.mkdtemp(prefix="receipt-bench-")
+    try:
+        overrides = dict(item.split("=", 1) for item in args.env)
+        # Configuration is read at import time, so it must be in place before app.* is imported
+        os.environ.update({
+            "GEMMA_ENDPOINT": stub.url,
+            "OLM_ENDPOINT": stub.url,
+            "RABBITMQ_HOST": "in-process",
+            "BLOB_DIR": os.path.join(workdir, "blobs"),
+            "CACHE_PATH": os.path.join(workdir, "cache.sqlite3"),
+            "CHECKPOINT_PATH": os.path.join(workdir, "checkpoints.sqlite3"),
+            "WORKER_METRICS_PORT": "0",
+            "LIMITER_SHARED_FILE": "",
+            "RESULT_DB_PATH": "",
+            "RECEIPT_DB_PATH": os.path.join(workdir, "receipts.sqlite3"),
+            "WORKER_CONCURRENCY": str(args.worker_concurrency),
+            "RATE_LIMIT_PER_SECOND": "0",  # every bench client shares one address
+        })
+        os.environ.update(overrides)
+
+        install(BROKER)
+        Histogram.observe = _capture
+
+        import app.main
+        from app.worker import Worker
+        from fastapi.testclient import TestClient
+
+        app.main.AsyncRabbitMQPublisher = InProcessPublisher
+
+        print(f"Rendering {args.receipts} synthetic receipts...", file=sys.stderr)
+        corpus = build_corpus(args.receipts, seed=args.seed, photo_ratio=args.photo_ratio,
+                              duplicate_ratio=args.duplicate_ratio)
+        memory = MemorySampler()
+        memory.start()
+
+        results = []
+        with TestClient(app.main.app) as client:
+            workers = [Worker() for _ in range(args.workers)]
+            threads = [threading.Thread(target=w.run, name=f"bench-worker-{i}", daemon=True)
+                       for i, w in enumerate(workers)]
+            for thread in threads:
+                thread.start()
+
+            def submit(entry):
+                filename, data = entry
+                started = time.perf_counter()
+                response = client.post("/process-image", files={"file": (filename, data)})
+                if response.status_code != 200:
+                    return {"status": f"http_{response.status_code}", "latency": time.perf_counter() - started}
+                conversation_id = response.json()["conversation_id"]
+                deadline = started + args.result_timeout
+                while time.perf_counter() < deadline:
+                    result = client.get(f"/result/{conversation_id}", params={"wait": 10})
+                    if result.status_code == 200:
+                        record = result.json()
+                        return {"status": record.get("status", "completed"), "cached": record.get("cached", False),
+                                "route": record.get("route"), "latency": time.perf_counter() - started}
+                return {"status": "timeout", "latency": time.perf_counter() - started}
+
+            wall_started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as pool:
+                results = list(pool.map(submit, corpus))
+            wall = time.perf_counter() - wall_started
+
+            for worker in workers:
+                worker.stop()
+            for thread in threads:
+                thread.join(10)
+
+        stub.stop()
+        by_status = defaultdict(int)
+        for result in results:
+            by_status[result["status"]] += 1
+
+        stages = {}
+        for (name, labels), values in sorted(SAMPLES.items()):
+            if name.startswith("receipt_http"):
+                continue
+            key = name.removeprefix("receipt_").removesuffix("_seconds") + ("/" + "/".join(labels) if labels else "")
+            stages[key] = percentiles(values)
+
+        report = {
+            "label": args.label,
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "config": {k: v for k, v in vars(args).items() if k != "env"} | {"env": overrides},
+            "wall_seconds": wall,
+            "throughput_per_second": len(results) / wall if wall else 0,
+            "outcomes": dict(by_status),
+            "cached": sum(1 for r in results if r.get("cached")),
+            "routes": dict(Counter(r["route"] for r in results if r.get("route"))),
+            "end_to_end": percentiles([r["latency"] for r in results if r["status"] == "completed"]),
+            "stages": stages,
+            "broker": BROKER.stats(),
+            "model_server": stub.stats(),
+            "memory": memory.stop(),
+            "upload_bytes": {"total": sum(len(d) for _, d in corpus), "max": max(len(d) for _, d in corpus)},
+        }
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        path = os.path.join(args.output_dir, f"{stamp}_{report['commit']}{'_' + args.label if args.label else ''}.json")
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+
+        e2e = report["end_to_end"]
+        print(f"{len(results)} receipts in {wall:.1f}s -> {report['throughput_per_second']:.2f}/s, outcomes {dict(by_status)}")
+        if e2e["count"]:
+            print(f"end-to-end p50 {e2e['p50']:.2f}s p95 {e2e['p95']:.2f}s p99 {e2e['p99']:.2f}s")
+        requests_queue = report["broker"].get("image_requests", {})
+        print(f"image_requests messages: avg {requests_queue.get('bytes_avg', 0):.0f}B "
+              f"({requests_queue.get('header_bytes_avg', 0):.0f}B headers) max {requests_queue.get('bytes_max', 0)}B; "
+              f"peak RSS {report['memory']['rss_peak_bytes'] / 2**20:.0f} MiB")
+        print(f"Report written to {path}")
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
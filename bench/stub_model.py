@@ -0,0 +1,169 @@
+"""Stub OpenAI-compatible chat-completions server with configurable latency, token rate and errors."""
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, NamedTuple
+
+
+class ModelProfile(NamedTuple):
+    prefill_ms: float = 300       # median time to first token
+    prefill_sigma: float = 0.3    # lognormal spread of the time to first token
+    tokens_per_second: float = 80
+    output_tokens: int = 150
+    error_rate: float = 0.0       # fraction of requests answered with HTTP 503
+    need_ocr_rate: float = 0.0    # fraction of cascade first passes that ask for olmOCR
+    malformed_rate: float = 0.0   # fraction of unconstrained (no response_format) answers cut off mid-item
+
+
+def _receipt_json(rng: random.Random, structured: bool, needs_ocr: bool, malformed: bool) -> str:
+    items = [] if needs_ocr else [
+        {"item_name": f"ITEM {rng.randint(100, 999)}", "quantity": rng.randint(1, 3),
+         "price": round(rng.uniform(1, 60), 2), "company": "STUB MART"}
+        for _ in range(rng.randint(3, 12))
+    ]
+    if structured:
+        # Schema-constrained servers answer exactly the requested object, receipt-level fields included
+        subtotal = round(sum(item["price"] for item in items), 2)
+        tax = round(subtotal * 0.08, 2)
+        return json.dumps({
+            "needs_ocr": needs_ocr,
+            "company_name": None if needs_ocr else "STUB MART",
+            "date": None if needs_ocr else f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "currency": None if needs_ocr else "USD",
+            "items": items,
+            "subtotal": None if needs_ocr else subtotal,
+            "tax": None if needs_ocr else tax,
+            "total": None if needs_ocr else round(subtotal + tax, 2),
+            "notes": None,
+        })
+    if needs_ocr:
+        return "NEED_OCR"
+    text = "```json\n" + json.dumps(items) + "\n```"
+    return text[:int(len(text) * rng.uniform(0.5, 0.95))] if malformed else text
+
+
+def _ocr_text(rng: random.Random) -> str:
+    return "\n".join(f"ITEM {rng.randint(100, 999)}  {rng.uniform(1, 60):.2f}" for _ in range(rng.randint(3, 12)))
+
+
+def _tokens(text: str, size: int = 4) -> list:
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class StubModelServer:
+    """Serves /v1/chat/completions on 127.0.0.1. Profiles are matched by substring of the model name"""
+    def __init__(self, profiles: Dict[str, ModelProfile], default: ModelProfile = ModelProfile(), seed: int = 0):
+        self.profiles = profiles
+        self.default = default
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.streamed = 0
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.server.handle_error = lambda request, address: None  # clients hanging up at shutdown
+        self._thread = threading.Thread(target=self.server.serve_forever, name="stub-model", daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def start(self) -> "StubModelServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def profile_for(self, model: str) -> ModelProfile:
+        for key, profile in self.profiles.items():
+            if key in model:
+                return profile
+        return self.default
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "streamed": self.streamed,
+                "max_concurrent": self.max_concurrent}
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                model = payload.get("model", "")
+                profile = stub.profile_for(model)
+                with stub.rng_lock:
+                    stub.requests += 1
+                    stub._concurrent += 1
+                    stub.max_concurrent = max(stub.max_concurrent, stub._concurrent)
+                    fail = stub.rng.random() < profile.error_rate
+                    prefill = stub.rng.lognormvariate(math.log(profile.prefill_ms / 1000), profile.prefill_sigma)
+                    if "ocr" in model:
+                        content = _ocr_text(stub.rng)
+                    else:
+                        triage = "needs_ocr" in json.dumps(payload.get("messages", [])[:1])
+                        content = _receipt_json(stub.rng, "response_format" in payload,
+                                                triage and stub.rng.random() < profile.need_ocr_rate,
+                                                stub.rng.random() < profile.malformed_rate)
+                try:
+                    if fail:
+                        with stub.rng_lock:
+                            stub.errors += 1
+                        self._send(503, {"error": "injected failure"})
+                        return
+                    time.sleep(prefill)
+                    if payload.get("stream"):
+                        self._stream(model, content, profile)
+                    else:
+                        time.sleep(len(_tokens(content)) / profile.tokens_per_second)
+                        self._send(200, {
+                            "object": "chat.completion", "model": model,
+                            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                                         "finish_reason": "stop"}],
+                        })
+                finally:
+                    with stub.rng_lock:
+                        stub._concurrent -= 1
+
+            def _send(self, status: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, model: str, content: str, profile: ModelProfile):
+                with stub.rng_lock:
+                    stub.streamed += 1
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for token in _tokens(content):
+                    chunk = {"object": "chat.completion.chunk", "model": model,
+                             "choices": [{"index": 0, "delta": {"content": token}}]}
+                    self._chunk(f"data: {json.dumps(chunk)}\n\n")
+                    time.sleep(1 / profile.tokens_per_second)
+                self._chunk("data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _chunk(self, text: str):
+                data = text.encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler